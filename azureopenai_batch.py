@@ -0,0 +1,49 @@
+"""
+This sample script illustrates how to use the utils.batch_runner.run_batch function to send the jobs of a
+JSONL file through the retry wrappers, with checkpointing so that an interrupted run can be resumed.
+
+Usage:
+    python azureopenai_batch.py jobs.jsonl results.jsonl --checkpoint jobs.checkpoint --deployment-id gpt-35-turbo
+"""
+import argparse
+from azure.identity import DefaultAzureCredential
+from utils.openai_client import AzureOpenAIClient
+from utils.token_provider import AzureADTokenProvider
+from utils.batch_runner import DEFAULT_MAX_WORKERS, run_batch
+
+if __name__ == '__main__':
+    # Set constants
+    API_BASE_URL = ""
+
+    parser = argparse.ArgumentParser(description="Run the jobs of a JSONL file against Azure OpenAI")
+    parser.add_argument("input_path", help="JSONL file with one completion, chatcompletion or embedding job per line")
+    parser.add_argument("output_path", help="JSONL file the results are appended to")
+    parser.add_argument("--checkpoint", dest="checkpoint_path",
+                        help="SQLite file recording the finished jobs, defaults to <output_path>.checkpoint")
+    parser.add_argument("--errors", dest="errors_path",
+                        help="JSONL file listing the failed jobs of the run, defaults to the output path with .errors "
+                             "before its extension")
+    parser.add_argument("--deployment-id", help="Deployment id of the jobs that do not name one")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS, help="Number of jobs in flight at once")
+    parser.add_argument("--api-base", default=API_BASE_URL, help="Endpoint of the Azure OpenAI instance")
+    parser.add_argument("--api-version", default="2023-05-15", help="Azure OpenAI API version")
+    args = parser.parse_args()
+
+    # Get access token, refreshed in the background before it expires
+    credential = DefaultAzureCredential(exclude_shared_token_cache_credential = True)
+    token_provider = AzureADTokenProvider(credential)
+
+    # Setup the Azure OpenAI client
+    client = AzureOpenAIClient(api_base = args.api_base,
+                               token_provider = token_provider,
+                               api_version = args.api_version)
+
+    print(f"Running jobs from {args.input_path}, writing results to {args.output_path}")
+    counts = run_batch(openai_instance=client,
+                       input_path=args.input_path,
+                       output_path=args.output_path,
+                       checkpoint_path=args.checkpoint_path or f"{args.output_path}.checkpoint",
+                       errors_path=args.errors_path,
+                       default_deployment_id=args.deployment_id,
+                       max_workers=args.max_workers)
+    print(f"Batch finished: {counts['succeeded']} succeeded, {counts['failed']} failed")
@@ -0,0 +1,62 @@
+"""
+This sample script illustrates how to use the utils.benchmark.run_benchmark function with the
+utils.mock_server.MockAzureOpenAIServer to measure the wrappers under latency, injected errors and quota limits.
+
+Usage:
+    python azureopenai_benchmark.py --operation chatcompletion --calls 500 --concurrency 20 --error-rate-429 0.1
+"""
+import argparse
+from utils.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from utils.benchmark import OPERATIONS, format_report, run_benchmark
+from utils.mock_server import DEFAULT_LATENCY_MEDIAN, DEFAULT_LATENCY_SIGMA, DEFAULT_RETRY_AFTER, MockAzureOpenAIServer
+from utils.openai_client import AzureOpenAIClient
+from utils.rate_limiter import RateLimiter
+from utils.retry_policy import DEFAULT_TRIES, RetryPolicy
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the Azure OpenAI wrappers against a local mock server")
+    parser.add_argument("--operation", choices=sorted(OPERATIONS), default="chatcompletion")
+    parser.add_argument("--calls", type=int, default=200, help="Number of wrapper calls")
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of calls in flight at once")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Use the async wrappers")
+    parser.add_argument("--max-tokens", type=int, default=16, help="max_tokens of the completions")
+    parser.add_argument("--tries", type=int, default=DEFAULT_TRIES, help="Attempts of the retry policy")
+
+    # Mock server behavior
+    parser.add_argument("--latency-median", type=float, default=DEFAULT_LATENCY_MEDIAN, help="Median latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=DEFAULT_LATENCY_SIGMA, help="Spread of the latency")
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--error-rate-503", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--retry-after", type=float, default=DEFAULT_RETRY_AFTER, help="Retry-After of injected errors")
+    parser.add_argument("--server-rpm", type=int, help="RPM quota simulated by the server")
+    parser.add_argument("--server-tpm", type=int, help="TPM quota simulated by the server")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency and error draws")
+
+    # Client side rate limiting
+    parser.add_argument("--client-rpm", type=int, help="RPM of the client side rate limiter")
+    parser.add_argument("--client-tpm", type=int, help="TPM of the client side rate limiter")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                        help="Adapt the requests in flight with an AdaptiveConcurrencyLimiter starting at --concurrency")
+    args = parser.parse_args()
+
+    server = MockAzureOpenAIServer(latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                                   error_rate_429=args.error_rate_429, error_rate_503=args.error_rate_503,
+                                   retry_after=args.retry_after, requests_per_minute=args.server_rpm,
+                                   tokens_per_minute=args.server_tpm, seed=args.seed)
+    with server:
+        client = AzureOpenAIClient(api_base=server.api_base, api_key="mock")
+
+        options = {"retry_policy": RetryPolicy(tries=args.tries)}
+        if args.client_rpm or args.client_tpm:
+            options["rate_limiter"] = RateLimiter(args.client_rpm, args.client_tpm)
+        if args.adaptive_concurrency:
+            options["concurrency_limiter"] = AdaptiveConcurrencyLimiter(initial_limit=args.concurrency)
+        if args.operation != "embedding":
+            options["max_tokens"] = args.max_tokens
+
+        print(f"Mock Azure OpenAI server listening on {server.api_base}")
+        report = run_benchmark(client, "benchmark", operation=args.operation, total_calls=args.calls,
+                               concurrency=args.concurrency, use_async=args.use_async, **options)
+
+    print(format_report(report))
+    print(f"  server responses {dict(server.stats)}")
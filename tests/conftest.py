@@ -0,0 +1,63 @@
+# This Script contains the pytest fixtures shared by the tests of the wrapper functions.
+# The tests run against utils/mock_server.py, a local stand-in for an Azure OpenAI instance, so they need no endpoint
+# or key. Run them from the root of the repository with make test.
+
+# import the required libraries
+import time
+from typing import Any, Callable, Iterator, List
+
+import pytest
+
+from utils.metrics import CallRecord, add_hook, remove_hook
+from utils.mock_server import MockAzureOpenAIServer, _error, _retry_headers
+from utils.openai_client import AzureOpenAIClient
+
+# The Retry-After of the errors injected by the tests
+TEST_RETRY_AFTER = 0.01  # seconds
+
+
+@pytest.fixture
+def server()->Iterator[MockAzureOpenAIServer]:
+    """A mock Azure OpenAI instance answering at once, with short embeddings"""
+    with MockAzureOpenAIServer(latency_median=0, token_latency=0, retry_after=TEST_RETRY_AFTER,
+                               embedding_dimensions=8, seed=0) as mock:
+        yield mock
+
+@pytest.fixture
+def client(server: MockAzureOpenAIServer)->Iterator[AzureOpenAIClient]:
+    """A client of the mock instance"""
+    mock_client = AzureOpenAIClient(server.api_base, api_key="key")
+    yield mock_client
+    mock_client.close()
+
+@pytest.fixture
+def records()->Iterator[List[CallRecord]]:
+    """The CallRecords of the wrapper calls made by the test"""
+    collected: List[CallRecord] = []
+    add_hook(collected.append)
+    yield collected
+    remove_hook(collected.append)
+
+@pytest.fixture
+def fail_first(server: MockAzureOpenAIServer)->Callable[..., None]:
+    """
+    Make the mock instance answer its next requests with an error after latency seconds, a 429 carrying a Retry-After
+    or a 503 without one
+    """
+    def fail(count: int, latency: float = 0.0, status: int = 429)->None:
+        handle = server.handle
+        remaining = [count]
+
+        def failing_handle(method: str, path: str, body: Any)->Any:
+            if method == "POST" and remaining[0] > 0:
+                remaining[0] -= 1
+                time.sleep(latency)
+                server._count(str(status))
+                if status == 429:
+                    return 429, _retry_headers(TEST_RETRY_AFTER), _error("429", "Rate limit exceeded (test)")
+                return status, {}, _error("ServiceUnavailable", "The service is overloaded (test)")
+            return handle(method, path, body)
+
+        server.handle = failing_handle
+
+    return fail
@@ -0,0 +1,81 @@
+# This Script contains the tests of the adaptive concurrency limiter: the AIMD cuts and growth of the limit.
+
+# import the required libraries
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pytest
+
+from utils.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from utils.openai_retry import get_completion
+from utils.retry_policy import RetryPolicy
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+
+
+def _complete(client, limiter, callers, calls=1):
+    def run(_):
+        for _ in range(calls):
+            try:
+                get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=2, concurrency_limiter=limiter,
+                               retry_policy=RetryPolicy(tries=1))
+            except (openai.error.RateLimitError, openai.error.ServiceUnavailableError):
+                pass
+
+    with ThreadPoolExecutor(callers) as executor:
+        list(executor.map(run, range(callers)))
+
+def test_overload_cuts_the_limit_once_per_round_trip(client, server, fail_first):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+    # The eight requests are in flight together when their 503s come back
+    fail_first(8, latency=0.1, status=503)
+    _complete(client, limiter, callers=8)
+    assert server.stats["503"] == 8
+    assert limiter.limit((server.api_base, DEPLOYMENT_ID)) == 4
+
+def test_throttling_with_a_retry_after_keeps_the_limit(client, server, fail_first):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+    # Quota throttling is left to the retry policy
+    fail_first(8, latency=0.1)
+    _complete(client, limiter, callers=8)
+    assert server.stats["429"] == 8
+    assert limiter.limit((server.api_base, DEPLOYMENT_ID)) == 8
+
+def test_success_under_load_grows_the_limit(client, server):
+    server.latency_median, server.latency_sigma = 0.02, 0
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=16)
+    _complete(client, limiter, callers=8, calls=5)
+    state = limiter.snapshot()[(server.api_base, DEPLOYMENT_ID)]
+    assert state["limit"] > 2
+    assert state["in_flight"] == 0 and state["waiting"] == 0
+
+def test_latency_spike_cuts_the_limit(client, server):
+    server.latency_median, server.latency_sigma = 0.01, 0
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, min_samples=5)
+    _complete(client, limiter, callers=1, calls=10)
+    limit = limiter.limit((server.api_base, DEPLOYMENT_ID))
+    server.latency_median = 0.2
+    _complete(client, limiter, callers=1)
+    assert limiter.limit((server.api_base, DEPLOYMENT_ID)) == pytest.approx(limit * 0.9)
+
+def test_requests_in_flight_stay_within_the_limit(client, server):
+    server.latency_median, server.latency_sigma = 0.05, 0
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=2)
+    handle, lock = server.handle, threading.Lock()
+    in_flight, peak = [0], [0]
+
+    def counting_handle(method, path, body):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        try:
+            return handle(method, path, body)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    server.handle = counting_handle
+    _complete(client, limiter, callers=8)
+    assert server.stats["200"] == 8
+    assert peak[0] == 2
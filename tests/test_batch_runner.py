@@ -0,0 +1,66 @@
+# This Script contains the tests of the batch runner: results, errors and resuming from the checkpoint.
+
+# import the required libraries
+import json
+
+from utils.batch_runner import run_batch
+from utils.retry_policy import RetryPolicy
+
+JOBS = [
+    {"id": "1", "type": "completion", "prompt": "Hello", "params": {"max_tokens": 2}},
+    {"id": "2", "type": "chatcompletion", "messages": [{"role": "user", "content": "Hello"}],
+     "params": {"max_tokens": 2}},
+    {"id": "3", "type": "embedding", "input": "Hello"},
+]
+
+
+def _write_jsonl(path, lines):
+    with open(path, "a", encoding="utf-8") as jsonl_file:
+        for line in lines:
+            jsonl_file.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+
+def _read_jsonl(path):
+    with open(path, encoding="utf-8") as jsonl_file:
+        return [json.loads(line) for line in jsonl_file]
+
+def _run(client, tmp_path, **options):
+    return run_batch(client, str(tmp_path / "jobs.jsonl"), str(tmp_path / "results.jsonl"),
+                     str(tmp_path / "jobs.checkpoint"), default_deployment_id="gpt-35-turbo",
+                     retry_policy=RetryPolicy(tries=1), **options)
+
+def test_results_and_errors_go_to_separate_files(client, server, tmp_path):
+    _write_jsonl(tmp_path / "jobs.jsonl", JOBS + ["{not json", {"id": "5", "type": "image", "prompt": "Hello"}])
+    assert _run(client, tmp_path) == {"succeeded": 3, "failed": 2}
+    results = {record["id"]: record["result"] for record in _read_jsonl(tmp_path / "results.jsonl")}
+    assert results["1"] == results["2"] == "lorem lorem"
+    assert len(results["3"]) == 8
+    errors = {record["id"]: record["error"] for record in _read_jsonl(tmp_path / "results.errors.jsonl")}
+    assert errors["4"].startswith("JSONDecodeError")
+    assert errors["5"] == "ValueError: Unknown job type image"
+
+def test_lines_that_are_not_objects_are_reported(client, server, tmp_path, capsys):
+    _write_jsonl(tmp_path / "jobs.jsonl", JOBS[:1] + ["[1, 2]", '"x"', "3"])
+    assert _run(client, tmp_path) == {"succeeded": 1, "failed": 3}
+    errors = {record["id"]: record["error"] for record in _read_jsonl(tmp_path / "results.errors.jsonl")}
+    assert errors == {line: "TypeError: the job is not a JSON object" for line in ("2", "3", "4")}
+    # The summary is returned and logged, not printed
+    assert capsys.readouterr().out == ""
+
+def test_a_resumed_run_skips_the_finished_jobs(client, server, tmp_path):
+    _write_jsonl(tmp_path / "jobs.jsonl", JOBS)
+    _run(client, tmp_path)
+    _write_jsonl(tmp_path / "jobs.jsonl", [{"id": "4", "type": "completion", "prompt": "Bye"}])
+    assert _run(client, tmp_path) == {"succeeded": 1, "failed": 0}
+    assert server.stats["200"] == 4
+    assert sorted(record["id"] for record in _read_jsonl(tmp_path / "results.jsonl")) == ["1", "2", "3", "4"]
+
+def test_failed_jobs_are_sent_again_on_resume(client, server, tmp_path):
+    _write_jsonl(tmp_path / "jobs.jsonl", JOBS)
+    server.error_rate_429 = 1.0
+    assert _run(client, tmp_path) == {"succeeded": 0, "failed": 3}
+    assert len(_read_jsonl(tmp_path / "results.errors.jsonl")) == 3
+    server.error_rate_429 = 0.0
+    assert _run(client, tmp_path, max_workers=1) == {"succeeded": 3, "failed": 0}
+    # The errors file lists the jobs failing in the last run only
+    assert _read_jsonl(tmp_path / "results.errors.jsonl") == []
+    assert sorted(record["id"] for record in _read_jsonl(tmp_path / "results.jsonl")) == ["1", "2", "3"]
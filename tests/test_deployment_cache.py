@@ -0,0 +1,108 @@
+# This Script contains the tests of the deployment metadata cache: the entries served from memory, the background
+# refresh, the negative entries of the missing deployments and the invalidation on DeploymentNotFound.
+
+# import the required libraries
+import asyncio
+import time
+
+import openai
+import pytest
+
+from utils.deployment_cache import DEPLOYMENT_NOT_FOUND, DeploymentCache
+from utils.mock_server import _error
+from utils.openai_retry import deployment_retrieve, get_completion
+from utils.openai_retry_async import adeployment_retrieve
+from utils.openai_router import Backend, DeploymentRouter
+from utils.retry_policy import RetryPolicy
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+
+
+def _remove_deployment(server, deployment_id=DEPLOYMENT_ID, code=DEPLOYMENT_NOT_FOUND):
+    """Make the mock instance answer every request to a deployment with a 404 carrying code"""
+    handle = server.handle
+
+    def missing_handle(method, path, body):
+        if path.startswith(f"/openai/deployments/{deployment_id}"):
+            server._count("404")
+            return 404, {}, _error(code, "The API deployment for this resource does not exist (test)")
+        return handle(method, path, body)
+
+    server.handle = missing_handle
+
+def test_a_deployment_is_served_from_memory(client, server):
+    cache = DeploymentCache(refresh_ahead=1)
+    for _ in range(3):
+        assert deployment_retrieve(client, DEPLOYMENT_ID, cache=cache) == (DEPLOYMENT_ID, DEPLOYMENT_ID, "succeeded")
+    assert server.stats["200"] == 1
+    assert cache.hits == 2 and cache.misses == 1
+    assert cache.peek(client, DEPLOYMENT_ID).usable
+
+def test_an_entry_is_refreshed_in_the_background(client, server):
+    cache = DeploymentCache(ttl=0.4, refresh_ahead=0.25)
+    deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    time.sleep(0.15)
+    # Served from memory while the refresh runs
+    deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    time.sleep(0.1)
+    assert server.stats["200"] == 2 and cache.misses == 1
+
+def test_a_missing_deployment_is_remembered(client, server):
+    cache = DeploymentCache(negative_ttl=0.2)
+    _remove_deployment(server)
+    for _ in range(2):
+        with pytest.raises(openai.error.InvalidRequestError):
+            deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    assert server.stats["404"] == 1
+    time.sleep(0.25)
+    with pytest.raises(openai.error.InvalidRequestError):
+        deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    assert server.stats["404"] == 2
+
+def test_other_errors_are_not_cached(client, server):
+    cache = DeploymentCache()
+    _remove_deployment(server, code="NotFound")
+    for _ in range(2):
+        with pytest.raises(openai.error.InvalidRequestError):
+            deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    assert server.stats["404"] == 2
+
+def test_deployment_not_found_drops_the_entry(client, server):
+    cache = DeploymentCache()
+    deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    _remove_deployment(server)
+    with pytest.raises(openai.error.InvalidRequestError):
+        get_completion(client, DEPLOYMENT_ID, "Hello", retry_policy=RetryPolicy(tries=1))
+    assert cache.peek(client, DEPLOYMENT_ID) is None
+    with pytest.raises(openai.error.InvalidRequestError):
+        deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+
+def test_deployment_not_found_drops_the_router_entry(server):
+    backend = Backend(server.api_base, DEPLOYMENT_ID, api_key="key", api_type="azure", api_version="2023-05-15")
+    router = DeploymentRouter([backend])
+    cache = DeploymentCache()
+    deployment_retrieve(router, DEPLOYMENT_ID, cache=cache)
+    assert cache.peek(router, DEPLOYMENT_ID) is not None
+    _remove_deployment(server)
+    with pytest.raises(openai.error.InvalidRequestError):
+        get_completion(router, DEPLOYMENT_ID, "Hello", retry_policy=RetryPolicy(tries=1))
+    assert cache.peek(router, DEPLOYMENT_ID) is None
+
+def test_invalidate_drops_the_entries(client, server):
+    cache = DeploymentCache()
+    for deployment_id in (DEPLOYMENT_ID, "gpt-4"):
+        deployment_retrieve(client, deployment_id, cache=cache)
+    cache.invalidate(client, "gpt-4")
+    assert cache.peek(client, DEPLOYMENT_ID) is not None and cache.peek(client, "gpt-4") is None
+    cache.invalidate()
+    assert cache.peek(client, DEPLOYMENT_ID) is None
+
+def test_the_async_lookup_shares_the_cache(client, server):
+    cache = DeploymentCache(refresh_ahead=1)
+
+    async def main():
+        return [await adeployment_retrieve(client, DEPLOYMENT_ID, cache=cache) for _ in range(2)]
+
+    assert asyncio.run(main()) == [(DEPLOYMENT_ID, DEPLOYMENT_ID, "succeeded")] * 2
+    deployment_retrieve(client, DEPLOYMENT_ID, cache=cache)
+    assert server.stats["200"] == 1
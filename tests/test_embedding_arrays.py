@@ -0,0 +1,63 @@
+# This Script contains the tests of the NumPy output of the embedding wrappers: decoding the base64 embeddings, the
+# batched matrix and the append-only .npy store.
+
+# import the required libraries
+import pytest
+
+# The array output needs numpy, which the wrappers do not require
+np = pytest.importorskip("numpy")
+
+from utils.embedding_arrays import EmbeddingStore, decode_embedding, embeddings_matrix, encode_embedding
+from utils.openai_retry import get_embedding, get_embeddings, store_embeddings
+
+DEPLOYMENT_ID = "text-embedding-ada-002"
+
+
+def test_decode_embedding_reads_base64_and_lists():
+    values = [0.5, -1.25, 3.0]
+    decoded = decode_embedding(encode_embedding(values))
+    assert decoded.dtype == np.float32 and decoded.tolist() == values
+    assert not decoded.flags.writeable
+    assert decode_embedding(values).tolist() == values
+    assert embeddings_matrix([encode_embedding(values), values]).shape == (2, 3)
+    assert embeddings_matrix([]).shape == (0, 0)
+
+def test_array_output_matches_the_float_lists(client, server):
+    embedding = get_embedding(client, DEPLOYMENT_ID, "Hello", as_array=True)
+    assert isinstance(embedding, np.ndarray) and embedding.dtype == np.float32
+    assert np.allclose(embedding, get_embedding(client, DEPLOYMENT_ID, "Hello"))
+    matrix = get_embeddings(client, DEPLOYMENT_ID, ["a", "b", "c"], batch_size=2, as_array=True)
+    assert matrix.shape == (3, 8) and matrix.flags.c_contiguous
+    assert np.allclose(matrix[2], get_embedding(client, DEPLOYMENT_ID, "c"))
+
+def test_the_store_is_a_valid_npy_at_every_append(tmp_path):
+    path = str(tmp_path / "embeddings.npy")
+    with EmbeddingStore(path, 3) as store:
+        assert store.array().shape == (0, 3)
+        store.append([[1, 2, 3]])
+        assert np.load(path).tolist() == [[1, 2, 3]]
+        store.append(np.ones((2, 3)))
+        assert len(store) == 3 and store.array().shape == (3, 3)
+
+def test_the_store_resumes_and_drops_a_partial_row(tmp_path):
+    path = str(tmp_path / "embeddings.npy")
+    with EmbeddingStore(path, 3) as store:
+        store.append([[1, 2, 3]])
+    with open(path, "ab") as npy_file:
+        # Half of a row written by an interrupted append
+        npy_file.write(b"\x00" * 6)
+    with EmbeddingStore(path, 3) as store:
+        assert len(store) == 1
+        store.append([[4, 5, 6]])
+    assert np.load(path).tolist() == [[1, 2, 3], [4, 5, 6]]
+    with pytest.raises(ValueError):
+        EmbeddingStore(path, 4)
+
+def test_store_embeddings_skips_the_stored_inputs(client, server, tmp_path):
+    texts = [f"text {number}" for number in range(7)]
+    with EmbeddingStore(str(tmp_path / "embeddings.npy"), 8) as store:
+        assert store_embeddings(client, DEPLOYMENT_ID, texts[:4], store, batch_size=2) == 4
+        assert store_embeddings(client, DEPLOYMENT_ID, texts, store, batch_size=2, max_workers=2) == 3
+        stored = np.array(store.array())
+    assert server.stats["200"] == 4
+    assert np.allclose(stored, get_embeddings(client, DEPLOYMENT_ID, texts, as_array=True))
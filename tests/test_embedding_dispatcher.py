@@ -0,0 +1,67 @@
+# This Script contains the tests of the embedding dispatcher: merging concurrent single-input calls into batch
+# requests, routing the wrapper functions through it, and coalescing its calls with the calls of the wrappers.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pytest
+
+from utils.embedding_dispatcher import EmbeddingDispatcher
+from utils.openai_retry import get_embedding
+from utils.openai_retry_async import aget_embedding
+from utils.retry_policy import RetryPolicy
+from utils.single_flight import SingleFlight
+
+DEPLOYMENT_ID = "text-embedding-ada-002"
+
+
+def test_concurrent_calls_are_merged_into_one_request(client, server):
+    texts = [f"text {number}" for number in range(8)]
+    with EmbeddingDispatcher(max_wait=0.2) as dispatcher, ThreadPoolExecutor(8) as executor:
+        embeddings = list(executor.map(lambda text: dispatcher.get_embedding(client, DEPLOYMENT_ID, text), texts))
+    assert server.stats["200"] == dispatcher.requests == 1
+    assert embeddings == [get_embedding(client, DEPLOYMENT_ID, text) for text in texts]
+
+def test_the_wrappers_send_through_the_dispatcher(client, server):
+    async def main(dispatcher):
+        return await asyncio.gather(*(aget_embedding(client, DEPLOYMENT_ID, text, dispatcher=dispatcher)
+                                      for text in ("a", "b", "c")))
+
+    with EmbeddingDispatcher(max_batch_size=3, max_wait=1) as dispatcher:
+        embeddings = asyncio.run(main(dispatcher))
+        assert get_embedding(client, DEPLOYMENT_ID, "a", dispatcher=dispatcher) == embeddings[0]
+    # The three async texts filled a batch, the last call waited for the close
+    assert dispatcher.requests == 2 and server.stats["200"] == 2
+
+def test_dispatcher_calls_coalesce_with_the_wrapper_calls(client, server):
+    server.latency_median = 0.2
+    single_flight = SingleFlight()
+    with EmbeddingDispatcher(max_wait=0) as dispatcher:
+        leader = threading.Thread(target=get_embedding, args=(client, DEPLOYMENT_ID, "Hello"),
+                                  kwargs={"as_array": False, "single_flight": single_flight})
+        leader.start()
+        # The leader is in flight for the latency of the server
+        time.sleep(0.05)
+        dispatcher.get_embedding(client, DEPLOYMENT_ID, "Hello", single_flight=single_flight)
+        leader.join()
+    assert single_flight.coalesced == 1
+    assert server.stats["200"] == 1 and dispatcher.requests == 0
+
+def test_a_failed_batch_fails_every_caller(client, server):
+    server.error_rate_429 = 1.0
+    with EmbeddingDispatcher(max_wait=0.2, retry_policy=RetryPolicy(tries=1)) as dispatcher:
+        futures = [dispatcher.submit(client, DEPLOYMENT_ID, text) for text in ("a", "b")]
+        for future in futures:
+            with pytest.raises(openai.error.RateLimitError):
+                future.result()
+    assert server.stats["429"] == 1
+
+def test_a_closed_dispatcher_rejects_new_texts(client):
+    dispatcher = EmbeddingDispatcher()
+    dispatcher.close()
+    with pytest.raises(RuntimeError):
+        dispatcher.get_embedding(client, DEPLOYMENT_ID, "Hello")
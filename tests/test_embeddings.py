@@ -0,0 +1,42 @@
+# This Script contains the tests of the batched embeddings: packing the inputs into requests and retrying per batch.
+
+# import the required libraries
+import openai
+import pytest
+
+from utils.openai_retry import _batch_inputs, get_embedding, get_embeddings
+from utils.rate_limiter import estimate_tokens
+from utils.retry_policy import RetryPolicy
+
+DEPLOYMENT_ID = "text-embedding-ada-002"
+
+
+def test_inputs_are_split_by_count_and_by_tokens():
+    texts = ["a" * 40] * 5
+    assert [(start, len(batch)) for start, batch in _batch_inputs(texts, 2, 1000)] == [(0, 2), (2, 2), (4, 1)]
+    # Each text is over half of the token budget, so every batch holds one text
+    budget = estimate_tokens(texts[0]) * 3 // 2
+    assert [len(batch) for _, batch in _batch_inputs(texts, 16, budget)] == [1] * 5
+    # A text over the budget still gets a batch of its own
+    assert [len(batch) for _, batch in _batch_inputs(["a" * 400, "b"], 16, 10)] == [1, 1]
+
+def test_embeddings_are_returned_in_input_order(client, server):
+    texts = [f"text {number}" for number in range(10)]
+    embeddings = get_embeddings(client, DEPLOYMENT_ID, iter(texts), batch_size=4, max_workers=3)
+    assert server.stats["200"] == 3
+    assert embeddings[9] == get_embedding(client, DEPLOYMENT_ID, "text 9")
+    assert len(embeddings) == 10 and len(set(map(tuple, embeddings))) == 10
+
+def test_a_failed_batch_is_retried_alone(client, server, fail_first, records):
+    texts = [f"text {number}" for number in range(6)]
+    fail_first(1)
+    embeddings = get_embeddings(client, DEPLOYMENT_ID, texts, batch_size=2, max_workers=1)
+    assert len(embeddings) == 6
+    assert server.stats["429"] == 1 and server.stats["200"] == 3
+    assert sorted(record.attempts for record in records) == [1, 1, 2]
+
+def test_a_batch_failing_every_try_raises(client, server):
+    server.error_rate_429 = 1.0
+    with pytest.raises(openai.error.RateLimitError):
+        get_embeddings(client, DEPLOYMENT_ID, ["a", "b"], retry_policy=RetryPolicy(tries=2))
+    assert server.stats["429"] == 2
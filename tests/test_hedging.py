@@ -0,0 +1,93 @@
+# This Script contains the tests of the hedged requests: the first answer of the request and its duplicate, the
+# duplicate answering a failed request, the hedge budget and the calls sent unhedged while the pool is busy.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.hedging import HedgingPolicy
+from utils.openai_retry import get_chatcompletion
+from utils.openai_retry_async import aget_chatcompletion
+from utils.retry_policy import RetryPolicy
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+MESSAGES = [{"role": "user", "content": "Hello"}]
+# The latency of the request held back by the mock instance
+SLOW_LATENCY = 0.5  # seconds
+# The delay of the duplicate requests, long enough for the request to reach the mock instance first
+HEDGE_DELAY = 0.05  # seconds
+
+
+def _policy(**options):
+    """A policy hedging after HEDGE_DELAY from the first call"""
+    policy = HedgingPolicy(percentile=50, min_samples=1, max_delay=HEDGE_DELAY, **options)
+    policy.record(0.001)
+    return policy
+
+def _hold_first(server, count, latency=SLOW_LATENCY):
+    """Make the mock instance answer its next requests after latency seconds"""
+    handle = server.handle
+    remaining, lock = [count], threading.Lock()
+
+    def holding_handle(method, path, body):
+        with lock:
+            held = method == "POST" and remaining[0] > 0
+            remaining[0] -= held
+        if held:
+            time.sleep(latency)
+        return handle(method, path, body)
+
+    server.handle = holding_handle
+
+def test_the_duplicate_answers_a_slow_request(client, server):
+    policy = _policy(budget=1.0)
+    # The first call of a test opens the connections
+    get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2)
+    _hold_first(server, 1)
+    sent = time.monotonic()
+    assert get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2, hedging=policy) == "lorem lorem"
+    assert time.monotonic() - sent < SLOW_LATENCY / 2
+    assert policy.hedges == policy.hedge_wins == 1
+    policy.close()
+
+def test_the_duplicate_answers_a_failed_request(client, server, fail_first):
+    policy = _policy(budget=1.0)
+    # The request fails while its duplicate is still in flight
+    get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2)
+    _hold_first(server, 1, latency=0.3)
+    fail_first(1, latency=0.15)
+    retry_policy = RetryPolicy(tries=1)
+    assert get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2, hedging=policy,
+                              retry_policy=retry_policy) == "lorem lorem"
+    assert policy.hedge_wins == 1 and server.stats["429"] == 1
+    policy.close()
+
+def test_the_budget_caps_the_duplicates(client, server):
+    policy = _policy(budget=0.25, burst=1)
+    for _ in range(8):
+        _hold_first(server, 1, latency=0.15)
+        get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2, hedging=policy)
+    assert policy.calls == 8 and policy.hedges == 2
+    policy.close()
+
+def test_a_busy_pool_sends_the_calls_unhedged(client, server):
+    policy = _policy(budget=10.0, burst=10, max_workers=2)
+    server.latency_median = 0.1
+    with ThreadPoolExecutor(6) as executor:
+        answers = list(executor.map(lambda _: get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2,
+                                                                 hedging=policy), range(6)))
+    assert answers == ["lorem lorem"] * 6
+    # Two threads carry at most two requests, the other calls run on their own thread
+    assert policy.hedges <= 2 and server.stats["200"] <= 6 + 2
+    policy.close()
+
+def test_the_async_duplicate_answers_a_slow_request(client, server):
+    policy = _policy(budget=1.0)
+    get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2)
+    _hold_first(server, 1)
+    sent = time.monotonic()
+    answer = asyncio.run(aget_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2, hedging=policy))
+    assert answer == "lorem lorem" and time.monotonic() - sent < SLOW_LATENCY / 2
+    assert policy.hedge_wins == 1
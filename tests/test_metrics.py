@@ -0,0 +1,100 @@
+# This Script contains the tests of the instrumentation of the wrappers: the call records, the hooks, the in-memory
+# collector and the Prometheus exporter.
+
+# import the required libraries
+import contextvars
+import logging
+import threading
+
+import openai
+import pytest
+
+from utils.metrics import CallRecord, MetricsCollector, _current, add_hook, record_attempt, remove_hook
+from utils.openai_retry import get_completion, get_embedding
+from utils.response_cache import ResponseCache
+from utils.retry_policy import RetryPolicy
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+
+
+@pytest.fixture
+def collector():
+    metrics_collector = MetricsCollector()
+    add_hook(metrics_collector)
+    yield metrics_collector
+    remove_hook(metrics_collector)
+
+def test_a_record_covers_every_attempt_of_a_call(client, server, fail_first, records):
+    fail_first(2)
+    get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=2)
+    record = records[-1]
+    assert record.operation == "completion" and record.deployment == DEPLOYMENT_ID
+    assert record.attempts == 3 and record.retries == {"RateLimitError": 2}
+    assert record.completion_tokens == 2 and record.prompt_tokens > 0
+    assert record.backoff_time > 0 and record.total_time >= record.backoff_time + record.network_time
+    assert record.error is None
+
+def test_the_collector_aggregates_the_records(client, server, collector):
+    cache = ResponseCache()
+    for _ in range(2):
+        get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=2, temperature=0, cache=cache)
+    get_embedding(client, "text-embedding-ada-002", "Hello")
+    server.error_rate_429 = 1.0
+    with pytest.raises(openai.error.RateLimitError):
+        get_completion(client, DEPLOYMENT_ID, "Bye", retry_policy=RetryPolicy(tries=2))
+
+    snapshot = collector.snapshot()
+    completions = snapshot[f"completion/{DEPLOYMENT_ID}"]
+    assert completions["calls"] == 3
+    assert completions["errors"] == {"RateLimitError": 1} and completions["retries"] == {"RateLimitError": 1}
+    assert completions["completion_tokens"] == 2
+    assert completions["latency"]["total"]["count"] == 3
+    assert snapshot["embedding/text-embedding-ada-002"]["calls"] == 1
+    assert snapshot["cache"] == {"completion/miss": 1, "completion/hit": 1}
+    collector.reset()
+    assert collector.snapshot() == {"cache": {}}
+
+def test_a_failing_hook_does_not_fail_the_call(client, server, caplog):
+    def failing_hook(record):
+        raise RuntimeError("hook failed")
+
+    add_hook(failing_hook)
+    try:
+        with caplog.at_level(logging.ERROR, logger="utils.metrics"):
+            assert get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=1) == "lorem"
+    finally:
+        remove_hook(failing_hook)
+    assert "hook failed" in caplog.text
+
+def test_attempts_from_several_threads_are_all_counted():
+    record = CallRecord("chatcompletion")
+    token = _current.set(record)
+    try:
+        # The hedged attempts of a call update its record from pool threads
+        threads = [threading.Thread(target=contextvars.copy_context().run,
+                                    args=(lambda: [record_attempt(DEPLOYMENT_ID, 0.0, 0.001) for _ in range(5000)],))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        _current.reset(token)
+    assert record.attempts == 40000
+    assert record.network_time == pytest.approx(40, rel=1e-6)
+
+def test_the_prometheus_exporter_publishes_the_records(client, server):
+    prometheus_client = pytest.importorskip("prometheus_client")
+    from utils.metrics import PrometheusExporter
+
+    registry = prometheus_client.CollectorRegistry()
+    exporter = PrometheusExporter(registry=registry)
+    add_hook(exporter)
+    try:
+        get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=2)
+    finally:
+        remove_hook(exporter)
+    labels = {"operation": "completion", "deployment": DEPLOYMENT_ID}
+    assert registry.get_sample_value("azure_openai_calls_total", {**labels, "outcome": "success"}) == 1
+    assert registry.get_sample_value("azure_openai_tokens_total", {**labels, "kind": "completion"}) == 2
+    assert registry.get_sample_value("azure_openai_call_seconds_count", {**labels, "phase": "total"}) == 1
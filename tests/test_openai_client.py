@@ -0,0 +1,76 @@
+# This Script contains the tests of the Azure OpenAI client: its own endpoint configuration, the keep-alive session of
+# its sync calls, installed for the thread only while a call runs, and the shared aiohttp session of the async calls.
+
+# import the required libraries
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import openai.api_requestor
+import pytest
+
+from utils.mock_server import MockAzureOpenAIServer
+from utils.openai_client import DEFAULT_POOL_MAXSIZE, AzureOpenAIClient, make_session, pooled_aiosession
+from utils.openai_retry import get_completion
+from utils.openai_retry_async import aget_completion
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+
+
+@pytest.fixture
+def other_server():
+    with MockAzureOpenAIServer(latency_median=0, token_latency=0) as mock:
+        yield mock
+
+def _count_requests(session):
+    sent = []
+    request = session.request
+
+    def counting_request(method, url, **kwargs):
+        sent.append(url)
+        return request(method, url, **kwargs)
+
+    session.request = counting_request
+    return sent
+
+def test_calls_go_through_the_session_of_the_client(server):
+    session = make_session()
+    sent = _count_requests(session)
+    client = AzureOpenAIClient(server.api_base, api_key="key", session=session)
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=1), range(8)))
+    assert len(sent) == 8 and server.stats["200"] == 8
+    assert session.get_adapter(server.api_base)._pool_maxsize == DEFAULT_POOL_MAXSIZE
+
+def test_the_thread_gets_its_own_session_back(client, server):
+    context = openai.api_requestor._thread_context
+    own_session = make_session()
+    context.session = own_session
+    try:
+        get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=1)
+        assert context.session is own_session
+    finally:
+        del context.session
+
+def test_clients_of_different_endpoints_run_side_by_side(server, other_server):
+    clients = [AzureOpenAIClient(server.api_base, api_key="key"), AzureOpenAIClient(other_server.api_base,
+                                                                                    api_key="key")]
+    api_base = openai.api_base
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda number: get_completion(clients[number % 2], DEPLOYMENT_ID, "Hello", max_tokens=1),
+                          range(10)))
+    assert server.stats["200"] == 5 and other_server.stats["200"] == 5
+    # The global settings of the openai module are left alone
+    assert openai.api_base == api_base
+
+def test_async_calls_share_the_pooled_session(client, server):
+    async def main():
+        async with pooled_aiosession() as session:
+            assert openai.aiosession.get() is session
+            await asyncio.gather(*(aget_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=1) for _ in range(5)))
+        return session
+
+    # The session is closed with the context, and the SDK opens its own sessions again
+    assert asyncio.run(main()).closed
+    assert openai.aiosession.get() is None
+    assert server.stats["200"] == 5
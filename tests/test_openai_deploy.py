@@ -0,0 +1,125 @@
+# This Script contains the tests of the declarative deployment provisioning: the plan of the specs against the existing
+# deployments, applying only the changes, polling the operations together and the readiness checks on the data plane.
+# A fake management client stands in for the Azure Resource Manager.
+
+# import the required libraries
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+# The provisioning needs the Azure management SDK, which the wrappers do not require
+pytest.importorskip("azure.mgmt.cognitiveservices")
+pytest.importorskip("azure.identity")
+
+import utils.openai_deploy as openai_deploy
+from utils.openai_deploy import CREATE, REUSE, UNCHANGED, UPDATE, DeploymentProvisioner, DeploymentSpec
+
+RESOURCE_GROUP = "rg"
+ACCOUNT = "account"
+
+
+def _deployment(name, model, version, sku_name="Standard", capacity=1, state="Succeeded"):
+    return SimpleNamespace(name=name, sku=SimpleNamespace(name=sku_name, capacity=capacity),
+                           properties=SimpleNamespace(model=SimpleNamespace(name=model, version=version),
+                                                      provisioning_state=state))
+
+
+class FakePoller:
+    """A long-running operation finishing after polls calls of done()"""
+
+    def __init__(self, deployment, polls=2, error=None):
+        self.deployment = deployment
+        self.polls = polls
+        self.error = error
+
+    def done(self):
+        self.polls -= 1
+        return self.polls <= 0
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.deployment
+
+
+class FakeDeployments:
+    """The deployments operations of one subscription, keyed by account"""
+
+    def __init__(self):
+        self.accounts = {}
+        self.lists = []
+        self.begins = []
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def list(self, resource_group_name, account_name):
+        with self._lock:
+            self.lists.append(account_name)
+            return list(self.accounts.get(account_name, {}).values())
+
+    def begin_create_or_update(self, resource_group_name, account_name, deployment_name, deployment):
+        with self._lock:
+            self.begins.append((account_name, deployment_name))
+            error = self.errors.get(deployment_name)
+            if isinstance(error, ValueError):
+                raise error
+            model, sku = deployment["properties"]["model"], deployment["sku"]
+            created = _deployment(deployment_name, model["name"], model["version"], sku["name"], sku["capacity"])
+            if error is None:
+                self.accounts.setdefault(account_name, {})[deployment_name] = created
+            return FakePoller(created, error=error)
+
+
+@pytest.fixture
+def deployments(monkeypatch):
+    fake = FakeDeployments()
+    monkeypatch.setattr(openai_deploy, "management_client",
+                        lambda credential, subscription_id: SimpleNamespace(deployments=fake))
+    return fake
+
+def _spec(name, model="gpt-35-turbo", version="0613", capacity=1, account=ACCOUNT, openai_instance=None):
+    return DeploymentSpec(RESOURCE_GROUP, account, name, model, version, capacity=capacity,
+                          openai_instance=openai_instance)
+
+def test_the_plan_diffs_the_specs_against_the_existing_deployments(deployments):
+    deployments.accounts[ACCOUNT] = {"chat": _deployment("chat", "gpt-35-turbo", "0613"),
+                                     "embed": _deployment("embed", "text-embedding-ada-002", "2")}
+    specs = [_spec("chat"), _spec("chat", capacity=5), _spec("gpt4", model="gpt-4"),
+             _spec("ada", model="text-embedding-ada-002", version="2"), _spec("other", account="other")]
+    plan = DeploymentProvisioner("credential", "subscription").plan(specs)
+    assert [(action, name) for _, action, name in plan] == [(UNCHANGED, "chat"), (UPDATE, "chat"), (CREATE, "gpt4"),
+                                                            (REUSE, "embed"), (CREATE, "other")]
+    # Every account is listed once
+    assert sorted(deployments.lists) == [ACCOUNT, "other"]
+
+def test_apply_changes_only_the_differing_deployments(deployments):
+    deployments.accounts[ACCOUNT] = {"chat": _deployment("chat", "gpt-35-turbo", "0613")}
+    provisioner = DeploymentProvisioner("credential", "subscription", poll_interval=0.01)
+    specs = [_spec("chat"), _spec("gpt4", model="gpt-4"), _spec("embed", model="text-embedding-ada-002")]
+    results = provisioner.apply(specs)
+    assert [(result["deployment"], result["action"], result["status"]) for result in results] == \
+        [("chat", UNCHANGED, "succeeded"), ("gpt4", CREATE, "succeeded"), ("embed", CREATE, "succeeded")]
+    assert sorted(deployments.begins) == [(ACCOUNT, "embed"), (ACCOUNT, "gpt4")]
+    # Applying the same specs twice changes nothing
+    deployments.begins.clear()
+    assert {result["action"] for result in provisioner.apply(specs)} == {UNCHANGED}
+    assert deployments.begins == []
+
+def test_a_failed_deployment_does_not_stop_the_others(deployments):
+    deployments.errors = {"rejected": ValueError("quota exceeded"), "broken": RuntimeError("provisioning failed")}
+    provisioner = DeploymentProvisioner("credential", "subscription", poll_interval=0.01)
+    results = provisioner.apply([_spec("rejected", model="a"), _spec("broken", model="b"), _spec("chat")])
+    assert [(result["status"], result["error"]) for result in results] == \
+        [("failed", "ValueError: quota exceeded"), ("failed", "RuntimeError: provisioning failed"),
+         ("succeeded", None)]
+
+def test_apply_without_wait_leaves_the_operations_pending(deployments):
+    results = DeploymentProvisioner("credential", "subscription").apply([_spec("chat")], wait=False)
+    assert results[0]["status"] == "pending" and deployments.begins == [(ACCOUNT, "chat")]
+
+def test_the_deployments_are_checked_on_the_data_plane(deployments, client, server):
+    provisioner = DeploymentProvisioner("credential", "subscription", poll_interval=0.01)
+    results = provisioner.apply([_spec("chat", openai_instance=client)])
+    assert results[0]["status"] == "succeeded" and results[0]["error"] is None
+    assert server.stats["200"] == 1
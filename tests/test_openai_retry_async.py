@@ -0,0 +1,111 @@
+# This Script contains the tests of the asyncio wrappers and of the bounded concurrency gather helpers.
+
+# import the required libraries
+import asyncio
+
+import openai
+import pytest
+
+from utils.openai_retry_async import (
+    aget_chatcompletion,
+    aget_completion,
+    aget_embedding,
+    aget_embeddings,
+    adeployment_retrieve,
+    gather_chatcompletions,
+    gather_with_concurrency,
+)
+from utils.openai_router import Backend, DeploymentRouter
+from utils.retry_policy import RetryPolicy
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_async_wrappers_return_the_response(client, server):
+    async def main():
+        return await asyncio.gather(aget_completion(client, "gpt-35-turbo", "Hello", max_tokens=2),
+                                    aget_chatcompletion(client, "gpt-35-turbo", MESSAGES, max_tokens=3),
+                                    aget_embedding(client, "text-embedding-ada-002", "Hello"))
+
+    completion, chatcompletion, embedding = asyncio.run(main())
+    assert completion == "lorem lorem"
+    assert chatcompletion == "lorem lorem lorem"
+    assert len(embedding) == 8
+    assert server.stats["200"] == 3
+
+def test_async_deployment_retrieve_gets_the_deployment(client, server):
+    router = DeploymentRouter([Backend(server.api_base, "gpt-35-turbo", api_key="key", api_type="azure",
+                                       api_version="2023-05-15")])
+
+    async def main():
+        return await asyncio.gather(adeployment_retrieve(client, "gpt-35-turbo"),
+                                    adeployment_retrieve(router, "ignored"))
+
+    assert asyncio.run(main()) == [("gpt-35-turbo", "gpt-35-turbo", "succeeded")] * 2
+    assert server.stats["200"] == 2
+
+def test_async_wrappers_retry_after_the_server_hint(client, server, fail_first, records):
+    fail_first(2)
+    text = asyncio.run(aget_chatcompletion(client, "gpt-35-turbo", MESSAGES, max_tokens=2,
+                                           retry_policy=RetryPolicy(delay=10)))
+    assert text == "lorem lorem"
+    assert records[-1].attempts == 3 and records[-1].retries == {"RateLimitError": 2}
+
+def test_async_wrappers_raise_after_the_last_try(client, server):
+    server.error_rate_429 = 1.0
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(aget_completion(client, "gpt-35-turbo", "Hello", retry_policy=RetryPolicy(tries=2)))
+    assert server.stats["429"] == 2
+
+def test_batched_async_embeddings_keep_the_input_order(client, server):
+    texts = [f"text {number}" for number in range(10)]
+    embeddings = asyncio.run(aget_embeddings(client, "text-embedding-ada-002", texts, batch_size=3,
+                                             max_concurrency=2))
+    single = asyncio.run(aget_embedding(client, "text-embedding-ada-002", "text 7"))
+    assert len(embeddings) == 10 and embeddings[7] == single
+    # Four batches and the single call
+    assert server.stats["200"] == 5
+
+def test_gather_keeps_the_order_and_returns_exceptions(client, server, fail_first):
+    fail_first(1)
+    results = asyncio.run(gather_chatcompletions(client, "gpt-35-turbo", [MESSAGES] * 4, max_concurrency=1,
+                                                 return_exceptions=True, max_tokens=2,
+                                                 retry_policy=RetryPolicy(tries=1)))
+    assert isinstance(results[0], openai.error.RateLimitError)
+    assert results[1:] == ["lorem lorem"] * 3
+
+def test_gather_creates_the_awaitables_as_workers_take_them():
+    created, finished, running, peak = [0], [0], [0], [0]
+
+    async def job(number):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.001)
+        running[0] -= 1
+        finished[0] += 1
+        return number
+
+    def jobs():
+        for number in range(1000):
+            created[0] += 1
+            # The coroutines created and not finished yet never exceed the concurrency
+            assert created[0] - finished[0] <= 4
+            yield job(number)
+
+    results = asyncio.run(gather_with_concurrency(jobs(), max_concurrency=4))
+    assert results == list(range(1000))
+    assert peak[0] == 4
+
+def test_gather_stops_at_the_first_exception():
+    started = []
+
+    async def job(number):
+        started.append(number)
+        await asyncio.sleep(0.01)
+        if number == 2:
+            raise ValueError("failed")
+        return number
+
+    with pytest.raises(ValueError):
+        asyncio.run(gather_with_concurrency((job(number) for number in range(100)), max_concurrency=3))
+    assert len(started) < 10
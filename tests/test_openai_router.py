@@ -0,0 +1,75 @@
+# This Script contains the tests of the deployment router: load balancing, failover and the circuit breaker.
+
+# import the required libraries
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pytest
+
+from utils.mock_server import MockAzureOpenAIServer
+from utils.openai_retry import get_chatcompletion
+from utils.openai_router import Backend, DeploymentRouter
+from utils.retry_policy import RetryPolicy
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+@pytest.fixture
+def other_server():
+    with MockAzureOpenAIServer(latency_median=0, token_latency=0, retry_after=0.01) as mock:
+        yield mock
+
+def _backend(mock, name, weight=1):
+    return Backend(mock.api_base, "gpt-35-turbo", weight=weight, api_key="key", api_type="azure",
+                   api_version="2023-05-15", name=name)
+
+def _chat(router, calls=1, workers=1):
+    def call(_):
+        return get_chatcompletion(router, "ignored", MESSAGES, max_tokens=2, retry_policy=RetryPolicy(tries=1))
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(call, range(calls)))
+
+def test_calls_are_spread_over_the_backends(server, other_server):
+    server.latency_median = other_server.latency_median = 0.05
+    router = DeploymentRouter([_backend(server, "a"), _backend(other_server, "b")])
+    _chat(router, calls=20, workers=4)
+    assert server.stats["200"] + other_server.stats["200"] == 20
+    assert server.stats["200"] >= 5 and other_server.stats["200"] >= 5
+
+def test_a_failing_backend_fails_over_within_the_call(server, other_server, records):
+    server.error_rate_503 = 1.0
+    router = DeploymentRouter([_backend(server, "a"), _backend(other_server, "b")])
+    assert _chat(router, calls=4) == ["lorem lorem"] * 4
+    assert other_server.stats["200"] == 4
+    # The retry policy allowed a single attempt, the failover does not count as a retry
+    assert all(not record.retries for record in records)
+
+def test_the_circuit_opens_after_consecutive_failures(server, other_server):
+    server.error_rate_503 = 1.0
+    router = DeploymentRouter([_backend(server, "a"), _backend(other_server, "b")], failure_threshold=2,
+                              recovery_time=60)
+    _chat(router, calls=10)
+    # Once the circuit is open the failing backend is left alone
+    assert server.stats["503"] <= 2
+    assert [backend.name for backend in router.healthy_backends()] == ["b"]
+
+def test_every_backend_failing_raises_the_last_error(server, other_server):
+    server.error_rate_503 = other_server.error_rate_503 = 1.0
+    router = DeploymentRouter([_backend(server, "a"), _backend(other_server, "b")])
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        _chat(router)
+    assert server.stats["503"] == 1 and other_server.stats["503"] == 1
+
+def test_a_drained_backend_only_takes_the_traffic_left_over(server, other_server):
+    router = DeploymentRouter([_backend(server, "drained", weight=0), _backend(other_server, "b")],
+                              failure_threshold=1, recovery_time=60)
+    _chat(router, calls=5, workers=3)
+    assert server.stats["200"] == 0 and other_server.stats["200"] == 5
+    other_server.error_rate_503 = 1.0
+    _chat(router, calls=3)
+    assert server.stats["200"] == 3
+
+def test_negative_weights_are_rejected(server):
+    with pytest.raises(ValueError):
+        _backend(server, "a", weight=-1)
@@ -0,0 +1,87 @@
+# This Script contains the tests of the streamed completions: the deltas and the aggregate result, the retries before
+# the first chunk, and the permit, slot, router load, call record and rate limiter usage held until the stream ends.
+
+# import the required libraries
+import asyncio
+
+import pytest
+
+from utils.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from utils.openai_retry import get_chatcompletion, get_completion
+from utils.openai_retry_async import aget_chatcompletion
+from utils.openai_router import Backend, DeploymentRouter
+from utils.rate_limiter import RateLimiter, estimate_chat_prompt_tokens
+from utils.scheduler import RequestScheduler
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def _in_flight(limiter):
+    return sum(deployment["in_flight"] for deployment in limiter.snapshot().values())
+
+def test_a_stream_yields_the_deltas_and_aggregates_them(client, server):
+    stream = get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=3, stream=True)
+    assert list(stream) == ["lorem "] * 3
+    assert stream.result.text == "lorem lorem lorem "
+    assert stream.result.finish_reason == "length"
+    assert stream.result.usage["completion_tokens"] == 3
+    result = get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=2, stream=True).collect()
+    assert result.text == "lorem lorem "
+
+def test_errors_before_the_first_chunk_are_retried(client, server, fail_first, records):
+    fail_first(1)
+    stream = get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=2, stream=True)
+    # The call record is emitted when the stream ends
+    assert not records
+    assert stream.collect().text == "lorem lorem "
+    assert records[-1].attempts == 2 and records[-1].completion_tokens == 2
+
+def test_a_stream_holds_its_permit_until_it_ends(client, server):
+    limiter = AdaptiveConcurrencyLimiter()
+    stream = get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=3, stream=True,
+                                concurrency_limiter=limiter)
+    assert _in_flight(limiter) == 1
+    stream.collect()
+    assert _in_flight(limiter) == 0
+
+    # Leaving the loop early also gives the permit back
+    for _ in get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=3, stream=True,
+                                concurrency_limiter=limiter):
+        assert _in_flight(limiter) == 1
+        break
+    assert _in_flight(limiter) == 0
+
+def test_a_stream_holds_its_slot_and_router_load_until_it_ends(server):
+    backend = Backend(server.api_base, DEPLOYMENT_ID, api_key="key", api_type="azure", api_version="2023-05-15")
+    router, scheduler = DeploymentRouter([backend]), RequestScheduler(max_concurrency=1)
+    with scheduler.call(get_chatcompletion, router, DEPLOYMENT_ID, MESSAGES, max_tokens=2, stream=True) as stream:
+        assert scheduler.active == 1 and backend.outstanding == 1
+    assert scheduler.active == 0 and backend.outstanding == 0
+    assert stream.result.text == "lorem "
+
+def test_the_rate_limiter_is_reconciled_with_the_streamed_tokens(client, server):
+    limiter = RateLimiter(tokens_per_minute=1000)
+    prompt_tokens = estimate_chat_prompt_tokens(MESSAGES)
+    stream = get_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=10, stream=True, rate_limiter=limiter)
+    # The estimate is charged until the stream ends
+    assert limiter.remaining_tokens(DEPLOYMENT_ID) == pytest.approx(1000 - prompt_tokens - 10, abs=1)
+    next(iter(stream))
+    stream.close()
+    # A single chunk was read
+    assert limiter.remaining_tokens(DEPLOYMENT_ID) == pytest.approx(1000 - prompt_tokens - 1, abs=1)
+
+def test_async_streams_hold_their_permit_until_they_end(client, server, records):
+    limiter = AdaptiveConcurrencyLimiter()
+
+    async def main():
+        stream = await aget_chatcompletion(client, DEPLOYMENT_ID, MESSAGES, max_tokens=3, stream=True,
+                                           concurrency_limiter=limiter)
+        held = _in_flight(limiter)
+        deltas = [delta async for delta in stream]
+        return held, deltas
+
+    held, deltas = asyncio.run(main())
+    assert held == 1 and _in_flight(limiter) == 0
+    assert deltas == ["lorem "] * 3
+    assert records[-1].completion_tokens == 3
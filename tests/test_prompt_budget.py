@@ -0,0 +1,85 @@
+# This Script contains the tests of the prompt budgeting: the token counts, the fallback to the estimates, shortening
+# the middle of a text and fitting completion prompts and chat messages into the context window of a deployment.
+
+# import the required libraries
+import logging
+
+import pytest
+
+import utils.prompt_budget as prompt_budget
+from utils.openai_retry import get_chatcompletion
+from utils.prompt_budget import DROP_OLDEST, RAISE, TRUNCATE_MIDDLE, TRUNCATION_MARKER, PromptBudget, \
+    count_chat_tokens, count_tokens, get_encoding, truncate_middle
+from utils.rate_limiter import estimate_tokens
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+LONG_TEXT = " ".join(f"word{number}" for number in range(400))
+
+
+class _OfflineTiktoken:
+    """Stands in for tiktoken on a host that cannot download the encoder files"""
+
+    @staticmethod
+    def encoding_for_model(model):
+        raise OSError("cannot download the encoder")
+
+    @staticmethod
+    def get_encoding(name):
+        raise OSError("cannot download the encoder")
+
+
+@pytest.fixture
+def offline_tiktoken(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "tiktoken", _OfflineTiktoken)
+    monkeypatch.setattr(prompt_budget, "_load_failure_logged", False)
+    get_encoding.cache_clear()
+    yield
+    get_encoding.cache_clear()
+
+def test_a_tiktoken_load_failure_falls_back_to_the_estimates(offline_tiktoken, caplog):
+    with caplog.at_level(logging.WARNING, logger="utils.prompt_budget"):
+        assert get_encoding(DEPLOYMENT_ID) is None and get_encoding("gpt-4") is None
+        assert count_tokens(LONG_TEXT) == estimate_tokens(LONG_TEXT)
+    # The failure is logged once
+    assert len(caplog.records) == 1
+
+def test_truncate_middle_keeps_the_start_and_the_end():
+    assert truncate_middle("Hello", 100) == "Hello"
+    shortened = truncate_middle(LONG_TEXT, 50)
+    assert count_tokens(shortened) <= 50
+    assert shortened.startswith("word0 ") and shortened.endswith(" word399") and TRUNCATION_MARKER in shortened
+    assert truncate_middle(LONG_TEXT, 1) == ""
+
+def test_a_prompt_is_shortened_to_fit_the_context_window():
+    budget = PromptBudget(context_limits={DEPLOYMENT_ID: 100})
+    assert budget.fit_prompt(DEPLOYMENT_ID, "Hello", max_tokens=20) == ("Hello", count_tokens("Hello"))
+    prompt, tokens = budget.fit_prompt(DEPLOYMENT_ID, LONG_TEXT, max_tokens=20)
+    assert tokens <= 80 and tokens == count_tokens(prompt)
+    assert budget.truncated == 1
+    with pytest.raises(ValueError):
+        budget.fit_prompt(DEPLOYMENT_ID, "Hello", max_tokens=100)
+    with pytest.raises(ValueError):
+        PromptBudget(context_limits={DEPLOYMENT_ID: 100}, strategy=RAISE).fit_prompt(DEPLOYMENT_ID, LONG_TEXT)
+
+def test_the_oldest_turns_are_dropped_first():
+    messages = [{"role": "system", "content": "You are terse."}]
+    messages += [{"role": "user", "content": LONG_TEXT[:200]} for _ in range(10)]
+    messages.append({"role": "user", "content": "The question"})
+    budget = PromptBudget(context_limits={DEPLOYMENT_ID: 300}, strategy=DROP_OLDEST)
+    fitted, tokens = budget.fit_messages(DEPLOYMENT_ID, messages, max_tokens=100)
+    assert tokens <= 200 and tokens == count_chat_tokens(fitted)
+    assert fitted[0] == messages[0] and fitted[-1] == messages[-1]
+    assert fitted[1:] == messages[len(messages) - len(fitted) + 1:]
+
+def test_the_longest_message_is_shortened_in_the_middle():
+    messages = [{"role": "user", "content": LONG_TEXT}, {"role": "user", "content": "The question"}]
+    budget = PromptBudget(context_limits={DEPLOYMENT_ID: 200}, strategy=TRUNCATE_MIDDLE)
+    fitted, tokens = budget.fit_messages(DEPLOYMENT_ID, messages, max_tokens=100)
+    assert tokens <= 100 and len(fitted) == 2
+    assert TRUNCATION_MARKER in fitted[0]["content"] and fitted[1] == messages[1]
+
+def test_the_wrappers_send_the_fitted_prompt(client, server):
+    budget = PromptBudget(context_limits={DEPLOYMENT_ID: 100})
+    messages = [{"role": "user", "content": LONG_TEXT}]
+    assert get_chatcompletion(client, DEPLOYMENT_ID, messages, max_tokens=2, prompt_budget=budget) == "lorem lorem"
+    assert budget.truncated == 1
@@ -0,0 +1,79 @@
+# This Script contains the tests of the client side rate limiter for the RPM and TPM quotas.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.openai_retry import get_completion
+from utils.rate_limiter import RateLimiter, estimate_completion_tokens
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+
+
+def _drain_requests(limiter, deployment_id):
+    while limiter.try_acquire(deployment_id) == 0:
+        pass
+
+def test_a_request_waits_until_both_buckets_hold_capacity():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+    assert limiter.try_acquire(DEPLOYMENT_ID, 590) == 0
+    # The request bucket is full, the token bucket refills 10 tokens per second
+    assert limiter.try_acquire(DEPLOYMENT_ID, 20) == pytest.approx(1.0, abs=0.05)
+    assert limiter.try_acquire(DEPLOYMENT_ID, 10) == 0
+
+def test_acquire_blocks_until_the_bucket_refills():
+    # 1200 requests per minute refill one request every 50 milliseconds
+    limiter = RateLimiter(requests_per_minute=1200)
+    _drain_requests(limiter, DEPLOYMENT_ID)
+    started = time.monotonic()
+    limiter.acquire(DEPLOYMENT_ID)
+    asyncio.run(limiter.acquire_async(DEPLOYMENT_ID))
+    assert time.monotonic() - started >= 0.08
+
+def test_deployments_have_their_own_limits():
+    limiter = RateLimiter(requests_per_minute=1, limits={"gpt-4": (None, 100)})
+    assert limiter.try_acquire(DEPLOYMENT_ID) == 0
+    assert limiter.try_acquire(DEPLOYMENT_ID) > 0
+    assert limiter.try_acquire("gpt-4", 100) == 0 and limiter.try_acquire("gpt-4") == 0
+    limiter.set_limits(DEPLOYMENT_ID, 5, None)
+    assert limiter.try_acquire(DEPLOYMENT_ID) == 0
+
+def test_concurrent_callers_never_exceed_the_capacity():
+    limiter = RateLimiter(tokens_per_minute=6000)
+    admitted, lock = [0], threading.Lock()
+
+    def take():
+        for _ in range(100):
+            if limiter.try_acquire(DEPLOYMENT_ID, 10) == 0:
+                with lock:
+                    admitted[0] += 1
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 600 requests of 10 tokens fill the bucket, the refill during the test adds a few more
+    assert 600 <= admitted[0] <= 610
+
+def test_the_estimate_is_reconciled_with_the_usage():
+    limiter = RateLimiter(tokens_per_minute=1000)
+    limiter.try_acquire(DEPLOYMENT_ID, 300)
+    limiter.reconcile(DEPLOYMENT_ID, 300, 100)
+    assert limiter.remaining_tokens(DEPLOYMENT_ID) == pytest.approx(900, abs=1)
+    limiter.reconcile(DEPLOYMENT_ID, 100, None)
+    assert limiter.remaining_tokens(DEPLOYMENT_ID) == pytest.approx(900, abs=1)
+
+def test_the_wrappers_charge_the_limiter(client, server):
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=1000)
+    for _ in range(2):
+        get_completion(client, DEPLOYMENT_ID, "Hello", rate_limiter=limiter, max_tokens=2)
+    assert server.stats["200"] == 2
+    # The mock instance reports the same usage as the estimate
+    used = 2 * estimate_completion_tokens("Hello", max_tokens=2)
+    assert limiter.remaining_tokens(DEPLOYMENT_ID) == pytest.approx(1000 - used, abs=1)
+    # The third request of the minute would wait about 30 seconds
+    assert limiter.try_acquire(DEPLOYMENT_ID) > 25
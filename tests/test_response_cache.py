@@ -0,0 +1,56 @@
+# This Script contains the tests of the response cache of the wrappers: hits, misses and bypasses.
+
+# import the required libraries
+from utils.mock_server import MockAzureOpenAIServer
+from utils.openai_client import AzureOpenAIClient
+from utils.openai_retry import get_chatcompletion, get_completion, get_embedding, get_embeddings
+from utils.response_cache import ResponseCache, SQLiteCache
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_deterministic_requests_are_served_from_the_cache(client, server, records):
+    cache = ResponseCache()
+    first = get_chatcompletion(client, "gpt-35-turbo", MESSAGES, cache=cache, temperature=0, max_tokens=2)
+    second = get_chatcompletion(client, "gpt-35-turbo", MESSAGES, cache=cache, temperature=0, max_tokens=2)
+    assert first == second
+    assert server.stats["200"] == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "bypassed": 0, "hit_ratio": 0.5}
+    assert [dict(record.cache) for record in records] == [{"miss": 1}, {"hit": 1}]
+
+def test_sampled_requests_bypass_the_cache(client, server):
+    cache = ResponseCache()
+    for _ in range(2):
+        get_completion(client, "gpt-35-turbo", "Hello", cache=cache, max_tokens=2)
+    assert server.stats["200"] == 2
+    assert cache.stats()["bypassed"] == 2 and cache.stats()["hits"] == 0
+
+def test_parameters_and_endpoints_are_part_of_the_key(client, server):
+    cache = ResponseCache()
+    get_completion(client, "gpt-35-turbo", "Hello", cache=cache, temperature=0, max_tokens=2)
+    get_completion(client, "gpt-35-turbo", "Hello", cache=cache, temperature=0, max_tokens=3)
+    get_completion(client, "gpt-4", "Hello", cache=cache, temperature=0, max_tokens=2)
+    with MockAzureOpenAIServer(latency_median=0, token_latency=0) as other_server:
+        other_client = AzureOpenAIClient(other_server.api_base, api_key="key")
+        get_completion(other_client, "gpt-35-turbo", "Hello", cache=cache, temperature=0, max_tokens=2)
+        assert other_server.stats["200"] == 1
+    assert server.stats["200"] == 3
+    assert cache.stats()["misses"] == 4
+
+def test_a_retried_call_looks_the_cache_up_once(client, server, fail_first, records):
+    cache = ResponseCache()
+    fail_first(2)
+    get_completion(client, "gpt-35-turbo", "Hello", cache=cache, temperature=0, max_tokens=2)
+    assert records[-1].attempts == 3
+    assert dict(records[-1].cache) == {"miss": 1}
+    assert cache.stats()["misses"] == 1
+
+def test_batched_embeddings_send_only_the_missing_inputs(client, server, tmp_path):
+    cache = ResponseCache(SQLiteCache(str(tmp_path / "cache.sqlite")))
+    single = get_embedding(client, "text-embedding-ada-002", "b", cache=cache)
+    embeddings = get_embeddings(client, "text-embedding-ada-002", ["a", "b", "c"], cache=cache)
+    assert embeddings[1] == single
+    assert server.stats["200"] == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+    assert get_embeddings(client, "text-embedding-ada-002", ["a", "b", "c"], cache=cache) == embeddings
+    assert server.stats["200"] == 2
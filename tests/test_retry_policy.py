@@ -0,0 +1,60 @@
+# This Script contains the tests of the retry policy: the wait hints of the service and the retries of the wrappers.
+
+# import the required libraries
+import time
+
+import openai
+import pytest
+
+from utils.openai_retry import get_chatcompletion, get_completion
+from utils.retry_policy import RetryPolicy, quota_exhausted, server_delay
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_server_delay_reads_the_retry_headers():
+    assert server_delay(openai.error.RateLimitError("busy", headers={"retry-after-ms": "1500"})) == 1.5
+    assert server_delay(openai.error.RateLimitError("busy", headers={"retry-after": "2"})) == 2
+    assert server_delay(openai.error.RateLimitError("busy")) is None
+
+def test_server_delay_waits_for_the_exhausted_quota():
+    headers = {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "6s",
+               "x-ratelimit-remaining-requests": "10", "x-ratelimit-reset-requests": "1m"}
+    exception = openai.error.RateLimitError("busy", headers=headers)
+    assert quota_exhausted(exception)
+    assert server_delay(exception) == 6
+
+def test_retry_after_replaces_the_backoff(client, server, fail_first, records):
+    fail_first(2)
+    started = time.monotonic()
+    # The backoff alone would wait 20 seconds
+    text = get_completion(client, "gpt-35-turbo", "Hello", max_tokens=2, retry_policy=RetryPolicy(delay=10))
+    assert text == "lorem lorem"
+    assert time.monotonic() - started < 5
+    assert server.stats["429"] == 2 and server.stats["200"] == 1
+    record = records[-1]
+    assert record.attempts == 3
+    assert record.retries == {"RateLimitError": 2}
+    assert record.backoff_time == pytest.approx(0.02)
+
+def test_retries_stop_after_the_last_try(client, server):
+    server.error_rate_429 = 1.0
+    with pytest.raises(openai.error.RateLimitError):
+        get_chatcompletion(client, "gpt-35-turbo", MESSAGES, max_tokens=2, retry_policy=RetryPolicy(tries=3))
+    assert server.stats["429"] == 3
+
+def test_retries_stop_at_the_deadline(client, server):
+    server.error_rate_429 = 1.0
+    server.retry_after = 1.0
+    with pytest.raises(openai.error.RateLimitError):
+        get_chatcompletion(client, "gpt-35-turbo", MESSAGES, max_tokens=2,
+                           retry_policy=RetryPolicy(tries=10, deadline=0.5))
+    # The first retry would wait past the deadline
+    assert server.stats["429"] == 1
+
+def test_errors_outside_the_policy_are_not_retried(client, server):
+    server.error_rate_429 = 1.0
+    policy = RetryPolicy(exceptions=(openai.error.ServiceUnavailableError,))
+    with pytest.raises(openai.error.RateLimitError):
+        get_completion(client, "gpt-35-turbo", "Hello", max_tokens=2, retry_policy=policy)
+    assert server.stats["429"] == 1
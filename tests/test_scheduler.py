@@ -0,0 +1,81 @@
+# This Script contains the tests of the request scheduler: priority order, tenant turns and deadline drops.
+
+# import the required libraries
+import queue
+import threading
+import time
+
+import pytest
+
+from utils.openai_retry import get_chatcompletion
+from utils.scheduler import BATCH, INTERACTIVE, RequestScheduler
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def _queue_calls(scheduler, calls):
+    """Queue one call per (name, priority, tenant) behind a held slot, return the order they ran in"""
+    order, threads = [], []
+    for name, priority, tenant in calls:
+        thread = threading.Thread(target=scheduler.call, args=(order.append, name),
+                                  kwargs={"priority": priority, "tenant": tenant})
+        thread.start()
+        threads.append(thread)
+        # Queue the calls in the given order
+        while scheduler.queued() < len(threads):
+            time.sleep(0.001)
+    return order, threads
+
+def test_interactive_calls_run_before_batch_calls():
+    scheduler = RequestScheduler(max_concurrency=1)
+    with scheduler.slot():
+        order, threads = _queue_calls(scheduler, [("batch-1", BATCH, "a"), ("batch-2", BATCH, "a"),
+                                                  ("interactive", INTERACTIVE, "a")])
+    for thread in threads:
+        thread.join()
+    assert order == ["interactive", "batch-1", "batch-2"]
+
+def test_tenants_of_a_class_take_turns():
+    scheduler = RequestScheduler(max_concurrency=1)
+    with scheduler.slot():
+        order, threads = _queue_calls(scheduler, [("a-1", BATCH, "a"), ("a-2", BATCH, "a"), ("a-3", BATCH, "a"),
+                                                  ("b-1", BATCH, "b")])
+    for thread in threads:
+        thread.join()
+    assert order == ["a-1", "b-1", "a-2", "a-3"]
+
+def test_reserved_slots_are_kept_for_interactive_calls():
+    scheduler = RequestScheduler(max_concurrency=2, reserved_slots=1)
+    with scheduler.slot(BATCH):
+        with pytest.raises(TimeoutError):
+            # The only free slot is reserved
+            scheduler.call(time.sleep, 0, priority=BATCH, deadline=0.05)
+        scheduler.call(time.sleep, 0, priority=INTERACTIVE, deadline=0.05)
+
+def test_calls_waiting_past_their_deadline_are_dropped():
+    scheduler = RequestScheduler(max_concurrency=1)
+    with scheduler.slot():
+        with pytest.raises(TimeoutError):
+            scheduler.call(time.sleep, 0, deadline=0.05)
+    assert scheduler.dropped == 1 and scheduler.queued() == 0
+
+def test_calls_that_cannot_meet_their_deadline_are_not_sent(client, server):
+    server.latency_median, server.latency_sigma = 0.2, 0
+    scheduler = RequestScheduler(max_concurrency=1)
+    scheduler.call(get_chatcompletion, client, "gpt-35-turbo", MESSAGES, max_tokens=2)
+    # The calls take 0.2 seconds, so a call with a 0.1 second deadline is dropped instead of sent
+    with pytest.raises(TimeoutError):
+        scheduler.call(get_chatcompletion, client, "gpt-35-turbo", MESSAGES, max_tokens=2, deadline=0.1)
+    assert server.stats["200"] == 1
+    assert scheduler.dropped == 1
+
+def test_full_queues_reject_new_calls():
+    scheduler = RequestScheduler(max_concurrency=1, max_queue=1)
+    with scheduler.slot():
+        order, threads = _queue_calls(scheduler, [("batch", BATCH, "a")])
+        with pytest.raises(queue.Full):
+            scheduler.call(order.append, "rejected", priority=BATCH)
+        assert scheduler.pressure(BATCH) == 1
+    for thread in threads:
+        thread.join()
+    assert order == ["batch"] and scheduler.rejected == 1
@@ -0,0 +1,97 @@
+# This Script contains the tests of request coalescing: identical calls in flight share one request.
+
+# import the required libraries
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from utils.openai_retry import get_chatcompletion
+from utils.openai_retry_async import aget_chatcompletion
+from utils.retry_policy import RetryPolicy
+from utils.single_flight import SingleFlight
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+# The number of identical calls started together
+CALLERS = 8
+
+
+def _call_together(call):
+    barrier = threading.Barrier(CALLERS)
+
+    def run(_):
+        barrier.wait()
+        return call()
+
+    with ThreadPoolExecutor(CALLERS) as executor:
+        return list(executor.map(run, range(CALLERS)))
+
+def _text_or_error(client, flight):
+    try:
+        return get_chatcompletion(client, "gpt-35-turbo", MESSAGES, temperature=0, max_tokens=2,
+                                  single_flight=flight, retry_policy=RetryPolicy(tries=1))
+    except openai.error.RateLimitError as exception:
+        return exception
+
+def test_identical_calls_share_one_request(client, server):
+    server.latency_median = 0.2
+    flight = SingleFlight()
+    results = _call_together(lambda: get_chatcompletion(client, "gpt-35-turbo", MESSAGES, temperature=0,
+                                                        max_tokens=2, single_flight=flight))
+    assert results == ["lorem lorem"] * CALLERS
+    assert server.stats["200"] == 1
+    assert flight.coalesced == CALLERS - 1
+
+def test_different_calls_are_not_coalesced(client, server):
+    server.latency_median = 0.1
+    flight = SingleFlight()
+    tokens = iter(range(1, CALLERS + 1))
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            max_tokens = next(tokens)
+        return get_chatcompletion(client, "gpt-35-turbo", MESSAGES, temperature=0, max_tokens=max_tokens,
+                                  single_flight=flight)
+
+    _call_together(call)
+    assert server.stats["200"] == CALLERS
+    assert flight.coalesced == 0
+
+def test_sampled_calls_are_not_coalesced(client, server):
+    server.latency_median = 0.1
+    flight = SingleFlight()
+    _call_together(lambda: get_chatcompletion(client, "gpt-35-turbo", MESSAGES, max_tokens=2, single_flight=flight))
+    assert server.stats["200"] == CALLERS
+    assert flight.coalesced == 0
+
+def test_followers_share_the_error_of_the_leader(client, server, fail_first):
+    fail_first(1, latency=0.2)
+    flight = SingleFlight()
+    results = _call_together(lambda: _text_or_error(client, flight))
+    assert all(isinstance(result, openai.error.RateLimitError) for result in results)
+    assert server.stats["429"] == 1 and server.stats["200"] == 0
+
+def test_followers_resend_after_a_failed_leader(client, server, fail_first):
+    server.latency_median = 0.2
+    fail_first(1, latency=0.2)
+    flight = SingleFlight(share_errors=False)
+    results = _call_together(lambda: _text_or_error(client, flight))
+    # One follower becomes the new leader and the others share its result
+    assert results.count("lorem lorem") == CALLERS - 1
+    assert server.stats["429"] == 1 and server.stats["200"] == 1
+
+def test_identical_async_calls_share_one_request(client, server):
+    server.latency_median = 0.2
+    flight = SingleFlight()
+
+    async def main():
+        calls = [aget_chatcompletion(client, "gpt-35-turbo", MESSAGES, temperature=0, max_tokens=2,
+                                     single_flight=flight) for _ in range(CALLERS)]
+        return await asyncio.gather(*calls)
+
+    assert asyncio.run(main()) == ["lorem lorem"] * CALLERS
+    assert server.stats["200"] == 1
+    assert flight.coalesced == CALLERS - 1
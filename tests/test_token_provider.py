@@ -0,0 +1,99 @@
+# This Script contains the tests of the Azure AD token provider: the cached token, the single refresh shared by the
+# callers, the background refresh, and the request resent with a new token after an AuthenticationError.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.mock_server import _error
+from utils.openai_client import AzureOpenAIClient
+from utils.openai_retry import get_completion
+from utils.openai_retry_async import aget_completion
+from utils.openai_router import Backend, DeploymentRouter
+from utils.token_provider import AzureADTokenProvider
+
+DEPLOYMENT_ID = "gpt-35-turbo"
+
+
+class FakeAccessToken:
+    def __init__(self, token, expires_on):
+        self.token = token
+        self.expires_on = expires_on
+
+
+class FakeCredential:
+    """Issues numbered tokens valid for lifetime seconds, slowly, like a call to Azure AD"""
+
+    def __init__(self, lifetime=3600, latency=0.0):
+        self.lifetime = lifetime
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_token(self, scope):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            return FakeAccessToken(f"token-{self.calls}", time.time() + self.lifetime)
+
+
+def _reject_first(server, count):
+    """Make the mock instance reject the token of its next requests with a 401"""
+    handle = server.handle
+    remaining = [count]
+
+    def rejecting_handle(method, path, body):
+        if method == "POST" and remaining[0] > 0:
+            remaining[0] -= 1
+            return 401, {}, _error("401", "Access token is missing, invalid or expired (test)")
+        return handle(method, path, body)
+
+    server.handle = rejecting_handle
+
+def test_the_token_is_cached():
+    credential = FakeCredential()
+    provider = AzureADTokenProvider(credential, background=False)
+    assert {provider.token() for _ in range(100)} == {"token-1"}
+    assert asyncio.run(provider.atoken()) == "token-1"
+    assert credential.calls == 1
+
+def test_callers_share_one_refresh():
+    # Tokens valid for 0.2 seconds are refreshed after 0.1 seconds
+    credential = FakeCredential(lifetime=0.2, latency=0.05)
+    provider = AzureADTokenProvider(credential, background=False)
+    time.sleep(0.15)
+    with ThreadPoolExecutor(8) as executor:
+        tokens = set(executor.map(lambda _: provider.token(), range(8)))
+    assert tokens == {"token-2"} and credential.calls == 2
+
+def test_the_token_is_refreshed_in_the_background():
+    credential = FakeCredential(lifetime=0.2)
+    provider = AzureADTokenProvider(credential)
+    try:
+        time.sleep(0.35)
+        assert credential.calls >= 3
+    finally:
+        provider.close()
+    calls = credential.calls
+    time.sleep(0.2)
+    assert credential.calls == calls
+
+def test_a_rejected_token_is_replaced_and_the_request_resent(server):
+    credential = FakeCredential()
+    client = AzureOpenAIClient(server.api_base, token_provider=AzureADTokenProvider(credential, background=False))
+    _reject_first(server, 1)
+    assert get_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=1) == "lorem"
+    assert credential.calls == 2 and server.stats["200"] == 1
+    _reject_first(server, 1)
+    assert asyncio.run(aget_completion(client, DEPLOYMENT_ID, "Hello", max_tokens=1)) == "lorem"
+    assert credential.calls == 3
+
+def test_a_router_backend_resends_with_a_new_token(server):
+    credential = FakeCredential()
+    backend = Backend(server.api_base, DEPLOYMENT_ID, api_version="2023-05-15",
+                      token_provider=AzureADTokenProvider(credential, background=False))
+    _reject_first(server, 1)
+    assert get_completion(DeploymentRouter([backend]), DEPLOYMENT_ID, "Hello", max_tokens=1) == "lorem"
+    assert credential.calls == 2
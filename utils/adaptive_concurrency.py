@@ -0,0 +1,303 @@
+# This Script contains an adaptive concurrency limiter for the Azure OpenAI deployments, passed to the wrapper functions
+# as their concurrency_limiter argument.
+# Every deployment gets a limit on the requests in flight that follows additive increase, multiplicative decrease (AIMD):
+# while the calls succeed with a healthy latency the limit grows by one per round trip, and it is cut by a factor on a
+# RateLimitError, a ServiceUnavailableError or a Timeout, or when the recent latency rises well above the long term
+# latency of the deployment (gradient style). Until the first cut the limit doubles every round trip (slow start), so it
+# converges to the real capacity of a deployment without a worker count picked by hand.
+# At most one cut is applied per round trip, the errors of the requests sent before a cut do not cut the limit again.
+# A RateLimitError that reports an exhausted quota in its x-ratelimit-remaining-* headers, or asks for a wait with
+# Retry-After, does not cut the limit: sending fewer requests at once does not refill a per-minute quota, and the retry
+# policy already waits for the time the service asks for.
+# Start from the concurrency the caller already uses, for example the worker count of a thread pool, so the limiter
+# only ever takes concurrency away when the deployment shows it cannot keep up.
+# The limiter is shared across threads and asyncio tasks.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, Iterator, Optional
+
+from openai.error import RateLimitError, ServiceUnavailableError, Timeout
+
+from utils.retry_policy import quota_exhausted, server_delay
+
+# The errors telling that a deployment is overloaded
+OVERLOAD_ERRORS = (RateLimitError, ServiceUnavailableError, Timeout)
+
+# The limit of a deployment before its first call
+DEFAULT_INITIAL_LIMIT = 32
+
+# The lowest and highest limits of a deployment
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 256
+
+# The factor applied to the limit on an overload error
+DEFAULT_ERROR_DECREASE = 0.5
+
+# The factor applied to the limit on a latency spike
+DEFAULT_LATENCY_DECREASE = 0.9
+
+# The ratio of the recent to the long term latency counted as a spike
+DEFAULT_LATENCY_TOLERANCE = 2.0
+
+# The weight of the last latency in the recent and in the long term latency
+SHORT_LATENCY_SMOOTHING = 0.2
+LONG_LATENCY_SMOOTHING = 0.02
+
+# The number of latencies measured before a spike can cut the limit
+DEFAULT_MIN_SAMPLES = 10
+
+
+def is_overload(exception: BaseException)->bool:
+    """Tell whether an error shows that the deployment cannot keep up with the requests in flight"""
+    if not isinstance(exception, OVERLOAD_ERRORS):
+        return False
+    if isinstance(exception, RateLimitError):
+        # Quota throttling is handled by the retry policy
+        return not quota_exhausted(exception) and server_delay(exception) is None
+    return True
+
+
+class _Waiter:
+    """A request waiting for a permit"""
+
+    def __init__(self, loop: Any = None):
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def resolve(self)->None:
+        """Wake the waiting caller, called with the limiter lock held"""
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+
+
+def _resolve_future(future: asyncio.Future)->None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Permit:
+    """
+    A permit in use. The latency judged when it is given back is the time it was held, or the time to the first
+    response when the holder marks it, for a stream that keeps its permit until it ends.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latency: Optional[float] = None
+
+    def responded(self)->None:
+        """Mark the first response of the request"""
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started
+
+
+class _Deployment:
+    """The limit and the latency state of one deployment"""
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.slow_start = True
+        self.samples = 0
+        self.short_latency: Optional[float] = None
+        self.long_latency: Optional[float] = None
+        # The time of the last cut, the requests sent before it cannot cut the limit again
+        self.last_cut = float("-inf")
+        self.waiters: Deque[_Waiter] = deque()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit of the requests in flight per deployment. Hold a permit around a request with permit or apermit.
+
+    Args:
+        initial_limit (float): The limit of a deployment before its first call, at least the concurrency of the caller
+        min_limit (float): The lowest limit of a deployment
+        max_limit (float): The highest limit of a deployment
+        error_decrease (float): The factor applied to the limit on an overload error, see is_overload
+        latency_decrease (float): The factor applied to the limit on a latency spike
+        latency_tolerance (float): The ratio of the recent to the long term latency counted as a spike
+        min_samples (int): The number of latencies measured before a spike can cut the limit
+    """
+
+    def __init__(self, initial_limit: float = DEFAULT_INITIAL_LIMIT, min_limit: float = DEFAULT_MIN_LIMIT,
+                 max_limit: float = DEFAULT_MAX_LIMIT, error_decrease: float = DEFAULT_ERROR_DECREASE,
+                 latency_decrease: float = DEFAULT_LATENCY_DECREASE,
+                 latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE, min_samples: int = DEFAULT_MIN_SAMPLES):
+        if not min_limit <= initial_limit <= max_limit:
+            raise ValueError("AdaptiveConcurrencyLimiter needs min_limit <= initial_limit <= max_limit")
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.error_decrease = error_decrease
+        self.latency_decrease = latency_decrease
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        self._deployments: Dict[Hashable, _Deployment] = {}
+        self._lock = threading.Lock()
+
+    def _deployment(self, key: Hashable)->_Deployment:
+        """Return the state of a deployment, called with the lock held"""
+        deployment = self._deployments.get(key)
+        if deployment is None:
+            deployment = self._deployments[key] = _Deployment(self.initial_limit)
+        return deployment
+
+    def _dispatch(self, deployment: _Deployment)->None:
+        """Grant the free permits to the waiting requests, called with the lock held"""
+        while deployment.waiters and deployment.in_flight < max(int(deployment.limit), 1):
+            deployment.in_flight += 1
+            deployment.waiters.popleft().resolve()
+
+    def _acquire(self, key: Hashable, loop: Any = None)->Optional[_Waiter]:
+        """Take a permit at once when one is free, otherwise queue a waiter"""
+        with self._lock:
+            deployment = self._deployment(key)
+            if not deployment.waiters and deployment.in_flight < max(int(deployment.limit), 1):
+                deployment.in_flight += 1
+                return None
+            waiter = _Waiter(loop)
+            deployment.waiters.append(waiter)
+            return waiter
+
+    def _cut(self, deployment: _Deployment, factor: float, started: float, now: float)->None:
+        """Cut the limit once per round trip, called with the lock held"""
+        if started < deployment.last_cut:
+            return
+        deployment.limit = max(deployment.limit * factor, self.min_limit)
+        deployment.slow_start = False
+        deployment.last_cut = now
+
+    def _release(self, key: Hashable, permit: Permit, exception: Optional[BaseException])->None:
+        """Give a permit back and adapt the limit to the outcome of the request"""
+        now = time.monotonic()
+        started = permit.started
+        latency = now - started if permit.latency is None else permit.latency
+        with self._lock:
+            deployment = self._deployment(key)
+            # The permits in use when the request finished, to grow only a limit that is actually reached
+            busy = deployment.in_flight + len(deployment.waiters)
+            deployment.in_flight -= 1
+            if exception is not None and is_overload(exception):
+                self._cut(deployment, self.error_decrease, started, now)
+            elif exception is None:
+                deployment.samples += 1
+                if deployment.short_latency is None:
+                    deployment.short_latency = deployment.long_latency = latency
+                else:
+                    deployment.short_latency += SHORT_LATENCY_SMOOTHING * (latency - deployment.short_latency)
+                    deployment.long_latency += LONG_LATENCY_SMOOTHING * (latency - deployment.long_latency)
+                if deployment.samples >= self.min_samples and \
+                        deployment.short_latency > self.latency_tolerance * deployment.long_latency:
+                    self._cut(deployment, self.latency_decrease, started, now)
+                elif busy >= deployment.limit / 2:
+                    # One more permit per round trip, or a doubling per round trip in slow start
+                    increase = 1 if deployment.slow_start else 1 / deployment.limit
+                    deployment.limit = min(deployment.limit + increase, self.max_limit)
+            self._dispatch(deployment)
+
+    def _withdraw(self, key: Hashable, waiter: _Waiter)->None:
+        """Take a cancelled waiter out of the queue, or give back the permit it was just granted"""
+        with self._lock:
+            deployment = self._deployment(key)
+            if waiter.granted:
+                deployment.in_flight -= 1
+                self._dispatch(deployment)
+            else:
+                deployment.waiters.remove(waiter)
+
+    @contextmanager
+    def permit(self, key: Hashable)->Iterator[Permit]:
+        """
+        Wait for a permit of a deployment and hold it for the duration of the with block
+
+        Args:
+            key (Hashable): The deployment, for example its api_base and deployment id
+
+        Returns:
+            permit (Permit): The permit held
+        """
+        waiter = self._acquire(key)
+        if waiter is not None:
+            try:
+                waiter.event.wait()
+            except BaseException:
+                self._withdraw(key, waiter)
+                raise
+        permit, exception = Permit(), None
+        try:
+            yield permit
+        except BaseException as error:
+            exception = error
+            raise
+        finally:
+            self._release(key, permit, exception)
+
+    @asynccontextmanager
+    async def apermit(self, key: Hashable)->AsyncIterator[Permit]:
+        """
+        Async wait for a permit of a deployment and hold it for the duration of the async with block
+
+        Args:
+            key (Hashable): The deployment, for example its api_base and deployment id
+
+        Returns:
+            permit (Permit): The permit held
+        """
+        waiter = self._acquire(key, asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.shield(waiter.future)
+            except BaseException:
+                self._withdraw(key, waiter)
+                raise
+        permit, exception = Permit(), None
+        try:
+            yield permit
+        except BaseException as error:
+            exception = error
+            raise
+        finally:
+            self._release(key, permit, exception)
+
+    def limit(self, key: Hashable)->float:
+        """Return the current limit of a deployment"""
+        with self._lock:
+            return self._deployment(key).limit
+
+    def snapshot(self)->Dict[Hashable, Dict[str, Any]]:
+        """
+        Return the state of every deployment
+
+        Returns:
+            snapshot (Dict[Hashable, Dict[str, Any]]): Per deployment, the limit, the requests in flight and waiting,
+                                                       and the recent and long term latency in seconds
+        """
+        with self._lock:
+            return {key: {"limit": deployment.limit, "in_flight": deployment.in_flight,
+                          "waiting": len(deployment.waiters), "short_latency": deployment.short_latency,
+                          "long_latency": deployment.long_latency}
+                    for key, deployment in self._deployments.items()}
+
+    def reset(self)->None:
+        """Forget the limits learned so far, the requests in flight keep their permits"""
+        with self._lock:
+            for deployment in self._deployments.values():
+                deployment.limit = self.initial_limit
+                deployment.slow_start = True
+                deployment.samples = 0
+                deployment.short_latency = deployment.long_latency = None
+                deployment.last_cut = float("-inf")
+                self._dispatch(deployment)
@@ -0,0 +1,214 @@
+# This Script contains a batch runner that sends the jobs of a JSONL file through the Azure OpenAI wrapper functions.
+# The input file is read line by line and at most max_workers jobs are in flight, so memory stays flat whatever the
+# size of the input. Results are appended to the output JSONL file as the jobs finish, and the ids of the finished jobs
+# are recorded in a SQLite checkpoint so that an interrupted run resumes without resending the finished jobs.
+#
+# Every input line is a job such as:
+#   {"id": "1", "type": "completion", "prompt": "...", "params": {"max_tokens": 100}}
+#   {"id": "2", "type": "chatcompletion", "deployment_id": "gpt-35-turbo", "messages": [{"role": "user", "content": "..."}]}
+#   {"id": "3", "type": "embedding", "input": "..."}
+# Every output line holds the id and the result of a succeeded job. The failed jobs, with the error that made them fail
+# after their retries, go to a separate errors file. Failed jobs are not checkpointed, so they are sent again when the
+# run is resumed, and the errors file is rewritten by every run: it lists the jobs still failing, once each.
+# A line that is not a valid JSON object is reported in the errors file under its line number, and the run goes on.
+# The runner prints nothing, the summary of a run is returned and logged with the logging module.
+# With a RequestScheduler the jobs run in its BATCH class, each under the "tenant" field of its job, behind the
+# interactive calls sharing the scheduler.
+
+# import the required libraries
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+import openai
+
+from utils.openai_retry import get_chatcompletion, get_completion, get_embedding
+from utils.scheduler import BATCH, DEFAULT_TENANT, RequestScheduler
+
+# The number of jobs in flight at once
+DEFAULT_MAX_WORKERS = 8
+
+# The number of finished jobs between two checkpoint commits
+DEFAULT_CHECKPOINT_EVERY = 100
+
+# The job types and the wrapper and job field used for each
+JOB_TYPES: Dict[str, Tuple[Callable, str]] = {
+    "completion": (get_completion, "prompt"),
+    "chatcompletion": (get_chatcompletion, "messages"),
+    "embedding": (get_embedding, "input"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """
+    Ids of the finished jobs, stored in a SQLite file so that lookups do not need the ids in memory
+
+    Args:
+        path (str): The path of the SQLite checkpoint file
+    """
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS finished (id TEXT PRIMARY KEY)")
+
+    def __contains__(self, job_id: str)->bool:
+        return self._connection.execute("SELECT 1 FROM finished WHERE id = ?", (job_id,)).fetchone() is not None
+
+    def add(self, job_id: str)->None:
+        """Record a finished job, made durable by the next commit"""
+        self._connection.execute("INSERT OR IGNORE INTO finished (id) VALUES (?)", (job_id,))
+
+    def commit(self)->None:
+        """Make the recorded jobs durable"""
+        self._connection.commit()
+
+    def close(self)->None:
+        """Commit and close the checkpoint file"""
+        self._connection.commit()
+        self._connection.close()
+
+
+def read_jobs(input_path: str, checkpoint: Checkpoint)->Iterator[Dict[str, Any]]:
+    """
+    Read the jobs of a JSONL file lazily, skipping blank lines and the jobs already finished
+
+    Args:
+        input_path (str): The path of the input JSONL file
+        checkpoint (Checkpoint): The checkpoint of the finished jobs
+
+    Returns:
+        jobs (Iterator[Dict[str, Any]]): The jobs left to run. A malformed line, or a line that is not a JSON object,
+                                         is returned as an error record, with its line number as id and the parse
+                                         error as error.
+    """
+    with open(input_path, encoding="utf-8") as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as exception:
+                yield {"id": str(line_number), "error": f"{type(exception).__name__}: {exception}"}
+                continue
+            if not isinstance(job, dict):
+                yield {"id": str(line_number), "error": "TypeError: the job is not a JSON object"}
+                continue
+            job.setdefault("id", str(line_number))
+            job["id"] = str(job["id"])
+            if job["id"] not in checkpoint:
+                yield job
+
+def run_job(openai_instance: openai, job: Dict[str, Any], default_deployment_id: Optional[str],
+            scheduler: Optional[RequestScheduler] = None, **options: Any)->Any:
+    """
+    Run one job through its wrapper function
+
+    Args:
+        openai_instance (openai): The Azure OpenAI instance to use, or a router
+        job (Dict[str, Any]): The job read from the input file
+        default_deployment_id (Optional[str]): The deployment id of the jobs that do not name one
+        scheduler (Optional[RequestScheduler]): The scheduler admitting the job in the BATCH class, under the tenant
+                                                named by the job
+        **options (Any): Wrapper options applied to every job, for example rate_limiter or cache
+
+    Returns:
+        result (Any): The result of the wrapper function
+    """
+    job_type = job.get("type", "completion")
+    if job_type not in JOB_TYPES:
+        raise ValueError(f"Unknown job type {job_type}")
+    wrapper, field = JOB_TYPES[job_type]
+    deployment_id = job.get("deployment_id", default_deployment_id)
+    # The embedding wrapper takes no generation parameters
+    params = job.get("params", {}) if job_type != "embedding" else {}
+
+    if scheduler is not None:
+        return scheduler.call(wrapper, openai_instance, deployment_id, job[field], priority=BATCH,
+                              tenant=job.get("tenant", DEFAULT_TENANT), **options, **params)
+    return wrapper(openai_instance, deployment_id, job[field], **options, **params)
+
+def run_batch(openai_instance: openai, input_path: str, output_path: str, checkpoint_path: str,
+              default_deployment_id: Optional[str] = None, max_workers: int = DEFAULT_MAX_WORKERS,
+              checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY, errors_path: Optional[str] = None,
+              **options: Any)->Dict[str, int]:
+    """
+    Run every job of a JSONL file that is not yet in the checkpoint
+
+    Args:
+        openai_instance (openai): The Azure OpenAI instance to use, or a router
+        input_path (str): The path of the input JSONL file
+        output_path (str): The path of the output JSONL file, the results of the succeeded jobs are appended to it
+        checkpoint_path (str): The path of the SQLite checkpoint file
+        default_deployment_id (Optional[str]): The deployment id of the jobs that do not name one
+        max_workers (int): The number of jobs in flight at once
+        checkpoint_every (int): The number of finished jobs between two checkpoint commits
+        errors_path (Optional[str]): The path of the JSONL file of the failed jobs of this run, rewritten by every run.
+                                     Defaults to the output path with .errors before its extension.
+        **options (Any): Wrapper options applied to every job, for example rate_limiter or cache, and the scheduler
+                         of run_job
+
+    Returns:
+        counts (Dict[str, int]): The number of succeeded and failed jobs of this run
+    """
+    if errors_path is None:
+        root, extension = os.path.splitext(output_path)
+        errors_path = f"{root}.errors{extension}"
+    counts = {"succeeded": 0, "failed": 0}
+    checkpoint = Checkpoint(checkpoint_path)
+    uncommitted = 0
+
+    def fail(record: Dict[str, Any])->None:
+        errors_file.write(json.dumps(record) + "\n")
+        counts["failed"] += 1
+
+    def finish(future: Future, job_id: str)->None:
+        nonlocal uncommitted
+        try:
+            record = {"id": job_id, "result": future.result()}
+        except Exception as exception:
+            fail({"id": job_id, "error": f"{type(exception).__name__}: {exception}"})
+            return
+        counts["succeeded"] += 1
+        output_file.write(json.dumps(record) + "\n")
+        checkpoint.add(job_id)
+        uncommitted += 1
+        if uncommitted >= checkpoint_every:
+            # The results reach the output file before their ids reach the checkpoint
+            output_file.flush()
+            checkpoint.commit()
+            uncommitted = 0
+
+    started = time.monotonic()
+    try:
+        with open(output_path, "a", encoding="utf-8") as output_file, \
+                open(errors_path, "w", encoding="utf-8") as errors_file, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending: Dict[Future, str] = {}
+            for job in read_jobs(input_path, checkpoint):
+                if "error" in job:
+                    # A malformed line
+                    fail(job)
+                    continue
+                if len(pending) >= max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future, pending.pop(future))
+                future = executor.submit(run_job, openai_instance, job, default_deployment_id, **options)
+                pending[future] = job["id"]
+
+            for future in wait(pending).done:
+                finish(future, pending[future])
+            output_file.flush()
+    finally:
+        checkpoint.close()
+
+    logger.info("Batch finished in %.1f seconds: %d succeeded, %d failed", time.monotonic() - started,
+                counts["succeeded"], counts["failed"])
+    return counts
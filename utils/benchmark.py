@@ -0,0 +1,144 @@
+# This Script contains a benchmark harness for the Azure OpenAI wrapper functions.
+# It sends a fixed number of calls through get_completion, get_chatcompletion or get_embedding from a pool of threads,
+# or through their async counterparts on one event loop, and reports the throughput, the latency percentiles of the
+# calls, and the attempts wasted on retries, read from the CallRecords of utils/metrics.py.
+# Run it against utils/mock_server.py to compare retry policies, rate limiter settings and concurrency levels
+# reproducibly before using them in production, see azureopenai_benchmark.py.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from utils import metrics
+from utils.openai_retry import get_chatcompletion, get_completion, get_embedding
+from utils.openai_retry_async import aget_chatcompletion, aget_completion, aget_embedding, gather_with_concurrency
+
+# The operations the benchmark can drive, with the sync and async wrappers and the payload of every call
+OPERATIONS: Dict[str, tuple] = {
+    "completion": (get_completion, aget_completion, "Write a tagline for an ice cream shop."),
+    "chatcompletion": (get_chatcompletion, aget_chatcompletion,
+                       [{"role": "user", "content": "Write a tagline for an ice cream shop."}]),
+    "embedding": (get_embedding, aget_embedding, "Let's encode this text for similarity comparisons"),
+}
+
+# The latency percentiles reported
+PERCENTILES = (50, 90, 99)
+
+
+class _Recorder:
+    """Metrics hook keeping the records of the benchmark calls"""
+
+    def __init__(self):
+        self.records: List[metrics.CallRecord] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record: metrics.CallRecord)->None:
+        with self._lock:
+            self.records.append(record)
+
+
+def run_benchmark(openai_instance: Any, deployment_id: str, operation: str = "chatcompletion",
+                  total_calls: int = 100, concurrency: int = 10, use_async: bool = False,
+                  **options: Any)->Dict[str, Any]:
+    """
+    Send total_calls calls through a wrapper at the given concurrency and measure them
+
+    Args:
+        openai_instance (Any): The Azure OpenAI instance, client or router to benchmark
+        deployment_id (str): The deployment id to call
+        operation (str): "completion", "chatcompletion" or "embedding"
+        total_calls (int): The number of wrapper calls to make
+        concurrency (int): The number of calls in flight at once
+        use_async (bool): Drive the async wrappers on one event loop instead of the sync wrappers on threads
+        **options (Any): Options given to every call, for example rate_limiter, retry_policy or max_tokens
+
+    Returns:
+        report (Dict[str, Any]): The duration, throughput, successful and failed calls, latency percentiles,
+                                 attempts, retries by error class, the share of attempts wasted on retries, and
+                                 the time spent in backoff, on the rate limiter and on concurrency permits
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation {operation}")
+    wrapper, async_wrapper, payload = OPERATIONS[operation]
+    errors: Counter = Counter()
+
+    recorder = _Recorder()
+    metrics.add_hook(recorder)
+    started = time.perf_counter()
+    try:
+        if use_async:
+            async def main()->List[Any]:
+                return await gather_with_concurrency(
+                    (async_wrapper(openai_instance, deployment_id, payload, **options) for _ in range(total_calls)),
+                    max_concurrency=concurrency, return_exceptions=True)
+
+            results = asyncio.run(main())
+            errors.update(type(result).__name__ for result in results if isinstance(result, BaseException))
+        else:
+            def call(_: int)->None:
+                try:
+                    wrapper(openai_instance, deployment_id, payload, **options)
+                except Exception as exception:
+                    errors[type(exception).__name__] += 1
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(call, range(total_calls)))
+    finally:
+        duration = time.perf_counter() - started
+        metrics.remove_hook(recorder)
+
+    records = recorder.records
+    latencies = [record.total_time for record in records if record.error is None]
+    attempts = sum(record.attempts for record in records)
+    retries: Counter = Counter()
+    for record in records:
+        retries.update(record.retries)
+    succeeded = len(records) - sum(errors.values())
+
+    report = {
+        "operation": operation,
+        "calls": total_calls,
+        "concurrency": concurrency,
+        "duration": duration,
+        "throughput": succeeded / duration if duration else 0.0,
+        "succeeded": succeeded,
+        "failed": dict(errors),
+        "latency": {f"p{q}": metrics.percentile(latencies, q) for q in PERCENTILES},
+        "attempts": attempts,
+        "retries": dict(retries),
+        # Attempts that did not produce a successful call
+        "wasted_attempts": attempts - succeeded,
+        "wasted_ratio": (attempts - succeeded) / attempts if attempts else 0.0,
+        "backoff_time": sum(record.backoff_time for record in records),
+        "queue_time": sum(record.queue_time for record in records),
+        "permit_time": sum(record.permit_time for record in records),
+    }
+    return report
+
+def format_report(report: Dict[str, Any])->str:
+    """
+    Format a benchmark report for the console
+
+    Args:
+        report (Dict[str, Any]): The report returned by run_benchmark
+
+    Returns:
+        text (str): The report as text
+    """
+    latency = ", ".join(f"{name} {value * 1000:.0f} ms" for name, value in report["latency"].items())
+    lines = [
+        f"{report['operation']}: {report['calls']} calls at concurrency {report['concurrency']} "
+        f"in {report['duration']:.2f} seconds",
+        f"  throughput      {report['throughput']:.1f} calls/s",
+        f"  succeeded       {report['succeeded']}, failed {report['failed'] or 0}",
+        f"  latency         {latency}",
+        f"  attempts        {report['attempts']}, retries {report['retries'] or 0}",
+        f"  wasted attempts {report['wasted_attempts']} ({report['wasted_ratio']:.1%})",
+        f"  backoff time    {report['backoff_time']:.2f} s",
+        f"  queue time      rate limiter {report['queue_time']:.2f} s, concurrency permit {report['permit_time']:.2f} s",
+    ]
+    return "\n".join(lines)
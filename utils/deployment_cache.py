@@ -0,0 +1,264 @@
+# This Script contains a cache of the deployment metadata returned by Deployment.retrieve.
+# Passed as the cache of deployment_retrieve or adeployment_retrieve, it answers readiness checks from memory: an entry is served for ttl
+# seconds, refreshed on a background thread once it is older than refresh_ahead of its ttl, so hot deployments never
+# wait on the network, and fetched again only when it has expired. A missing deployment is remembered for negative_ttl
+# seconds and its error raised again without a round trip.
+# Entries are keyed by the api_base of the instance and the deployment id. When a data plane call fails with
+# DeploymentNotFound, the wrappers drop the entry of that deployment from every cache, so the next check asks the
+# service again. Lookups through a DeploymentRouter are keyed by the router, since it picks the serving backend, and are
+# dropped when a call through the router fails with DeploymentNotFound.
+
+# import the required libraries
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+# The time a deployment is served from the cache
+DEFAULT_DEPLOYMENT_TTL = 300  # seconds
+
+# The time a missing deployment is remembered
+DEFAULT_NEGATIVE_TTL = 30  # seconds
+
+# The share of the ttl after which an entry is refreshed in the background
+DEFAULT_REFRESH_AHEAD = 0.8
+
+# The error code of Azure OpenAI for a deployment that does not exist
+DEPLOYMENT_NOT_FOUND = "DeploymentNotFound"
+
+logger = logging.getLogger(__name__)
+
+# The caches to invalidate on DeploymentNotFound
+_caches: "weakref.WeakSet[DeploymentCache]" = weakref.WeakSet()
+
+
+def is_deployment_not_found(exception: BaseException)->bool:
+    """Tell whether an error says the deployment does not exist, other 404 errors, for example a wrong path, do not"""
+    return getattr(exception, "code", None) == DEPLOYMENT_NOT_FOUND
+
+def endpoint_of(openai_instance: Any, options: Optional[Dict[str, Any]] = None)->Any:
+    """Return the api_base identifying the instance a request goes to"""
+    if options and options.get("api_base"):
+        return options["api_base"]
+    return getattr(openai_instance, "api_base", None) or id(openai_instance)
+
+def invalidate_deployment(endpoint: Any, deployment_id: str)->None:
+    """
+    Drop a deployment from every DeploymentCache
+
+    Args:
+        endpoint (Any): The api_base of the instance, see endpoint_of
+        deployment_id (str): The deployment id
+    """
+    for cache in list(_caches):
+        cache._drop(endpoint, deployment_id)
+
+
+class DeploymentInfo:
+    """
+    The metadata of a deployment
+
+    Args:
+        deployment_id (str): The deployment id
+        name (Optional[str]): The name of the deployment
+        model (Optional[str]): The base model of the deployment
+        status (Optional[str]): The status of the deployment, "succeeded" once it can be used
+        capacity (Optional[int]): The capacity of the deployment, when the service reports it
+    """
+
+    def __init__(self, deployment_id: str, name: Optional[str] = None, model: Optional[str] = None,
+                 status: Optional[str] = None, capacity: Optional[int] = None):
+        self.deployment_id = deployment_id
+        self.name = name
+        self.model = model
+        self.status = status
+        self.capacity = capacity
+
+    @classmethod
+    def from_response(cls, response: Any)->"DeploymentInfo":
+        """Read the metadata of a Deployment.retrieve response"""
+        scale_settings = response.get("scale_settings") or {}
+        return cls(response.get("id"), response.get("name"), response.get("model"), response.get("status"),
+                   scale_settings.get("capacity"))
+
+    @property
+    def usable(self)->bool:
+        """Whether the deployment can serve requests"""
+        return self.status == "succeeded"
+
+    def __repr__(self)->str:
+        return f"DeploymentInfo({self.deployment_id!r}, model={self.model!r}, status={self.status!r})"
+
+
+class _Entry:
+    """A cached deployment, or the error of a missing one"""
+
+    def __init__(self, info: Optional[DeploymentInfo], error: Optional[BaseException], ttl: float,
+                 refresh_ahead: float):
+        now = time.monotonic()
+        self.info = info
+        self.error = error
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * refresh_ahead
+        self.refreshing = False
+
+
+class DeploymentCache:
+    """
+    TTL cache of deployment metadata with background refresh and negative caching. Pass it as the cache argument of
+    deployment_retrieve or adeployment_retrieve. It is shared across threads and asyncio tasks.
+
+    Args:
+        ttl (float): The seconds a deployment is served from the cache
+        negative_ttl (float): The seconds a missing deployment is remembered
+        refresh_ahead (float): The share of the ttl after which an entry is refreshed in the background, 1 to turn
+                               the background refresh off
+    """
+
+    def __init__(self, ttl: float = DEFAULT_DEPLOYMENT_TTL, negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 refresh_ahead: float = DEFAULT_REFRESH_AHEAD):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[Tuple[Any, str], _Entry] = {}
+        self._tasks: Set[asyncio.Future] = set()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def _store(self, key: Tuple[Any, str], load: Callable[[], DeploymentInfo])->_Entry:
+        """Load a deployment and cache the result, or the error when it is missing"""
+        try:
+            entry = _Entry(load(), None, self.ttl, self.refresh_ahead)
+        except Exception as exception:
+            if not is_deployment_not_found(exception):
+                raise
+            entry = _Entry(None, exception, self.negative_ttl, 1)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    async def _astore(self, key: Tuple[Any, str], load: Callable[[], Awaitable[DeploymentInfo]])->_Entry:
+        """Async load a deployment and cache the result, or the error when it is missing"""
+        try:
+            entry = _Entry(await load(), None, self.ttl, self.refresh_ahead)
+        except Exception as exception:
+            if not is_deployment_not_found(exception):
+                raise
+            entry = _Entry(None, exception, self.negative_ttl, 1)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def _refresh(self, key: Tuple[Any, str], entry: _Entry, load: Callable[[], DeploymentInfo])->None:
+        try:
+            self._store(key, load)
+        except Exception:
+            # Keep serving the current entry, the next lookup after it expires fetches again
+            logger.warning("Background refresh of deployment %s failed", key[1], exc_info=True)
+        finally:
+            entry.refreshing = False
+
+    async def _arefresh(self, key: Tuple[Any, str], entry: _Entry,
+                        load: Callable[[], Awaitable[DeploymentInfo]])->None:
+        try:
+            await self._astore(key, load)
+        except Exception:
+            logger.warning("Background refresh of deployment %s failed", key[1], exc_info=True)
+        finally:
+            entry.refreshing = False
+
+    def _check(self, key: Tuple[Any, str])->Tuple[Optional[_Entry], bool, bool]:
+        """Return the entry of a key, whether it is fresh and whether this caller should refresh it"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and now < entry.expires
+            refresh = fresh and entry.info is not None and now >= entry.refresh_at and not entry.refreshing
+            if refresh:
+                entry.refreshing = True
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry, fresh, refresh
+
+    def lookup(self, openai_instance: Any, deployment_id: str, load: Callable[[], DeploymentInfo])->DeploymentInfo:
+        """
+        Return the metadata of a deployment from memory, loading it when it is missing or expired
+
+        Args:
+            openai_instance (Any): The Azure OpenAI instance or client the deployment belongs to
+            deployment_id (str): The deployment id
+            load (Callable[[], DeploymentInfo]): Fetches the metadata from the service
+
+        Returns:
+            info (DeploymentInfo): The metadata of the deployment. The error of a missing deployment is raised again
+                                   until its negative entry expires.
+        """
+        key = (endpoint_of(openai_instance), deployment_id)
+        entry, fresh, refresh = self._check(key)
+        if refresh:
+            threading.Thread(target=self._refresh, args=(key, entry, load), daemon=True).start()
+        if not fresh:
+            entry = self._store(key, load)
+        if entry.error is not None:
+            raise entry.error
+        return entry.info
+
+    async def alookup(self, openai_instance: Any, deployment_id: str,
+                      load: Callable[[], Awaitable[DeploymentInfo]])->DeploymentInfo:
+        """
+        Async lookup, the background refresh runs as a task of the running event loop
+
+        Args:
+            openai_instance (Any): The Azure OpenAI instance or client the deployment belongs to
+            deployment_id (str): The deployment id
+            load (Callable[[], Awaitable[DeploymentInfo]]): Fetches the metadata from the service
+
+        Returns:
+            info (DeploymentInfo): The metadata of the deployment, see lookup
+        """
+        key = (endpoint_of(openai_instance), deployment_id)
+        entry, fresh, refresh = self._check(key)
+        if refresh:
+            task = asyncio.ensure_future(self._arefresh(key, entry, load))
+            # Keep a reference so the task is not collected before it finishes
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if not fresh:
+            entry = await self._astore(key, load)
+        if entry.error is not None:
+            raise entry.error
+        return entry.info
+
+    def peek(self, openai_instance: Any, deployment_id: str)->Optional[DeploymentInfo]:
+        """Return the cached metadata of a deployment without any network call, None when it is not cached"""
+        with self._lock:
+            entry = self._entries.get((endpoint_of(openai_instance), deployment_id))
+        if entry is None or time.monotonic() >= entry.expires:
+            return None
+        return entry.info
+
+    def invalidate(self, openai_instance: Any = None, deployment_id: Optional[str] = None)->None:
+        """
+        Drop cached deployments
+
+        Args:
+            openai_instance (Any): The instance or client, None to drop every deployment
+            deployment_id (Optional[str]): The deployment id, None to drop every deployment of the instance
+        """
+        if openai_instance is None:
+            with self._lock:
+                self._entries.clear()
+            return
+        self._drop(endpoint_of(openai_instance), deployment_id)
+
+    def _drop(self, endpoint: Any, deployment_id: Optional[str])->None:
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key[0] == endpoint and (deployment_id is None or key[1] == deployment_id)]:
+                del self._entries[key]
@@ -0,0 +1,169 @@
+# This Script contains the NumPy output of the embedding wrapper functions.
+# With as_array=True the wrappers request encoding_format="base64", so the service sends every embedding as the base64
+# of its float32 bytes. The bytes are read into float32 arrays with np.frombuffer instead of parsing a JSON list of
+# floats into Python objects, and batched calls return one contiguous 2-D matrix.
+# EmbeddingStore appends embeddings to a .npy file that can be memory-mapped, so large indexing runs keep their
+# results on disk instead of in memory, see utils.openai_retry.store_embeddings.
+# NumPy is only needed when these features are used.
+
+# import the required libraries
+import base64
+import os
+import struct
+from typing import Any, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The encoding requested from the service for array output
+ARRAY_ENCODING_FORMAT = "base64"
+
+# The .npy header of an EmbeddingStore, rewritten in place as rows are appended. The row count is padded to a fixed
+# width so the header never changes size.
+_NPY_MAGIC = b"\x93NUMPY\x01\x00"
+_NPY_HEADER = "{{'descr': '<f4', 'fortran_order': False, 'shape': ({rows:>20}, {dimensions}), }}"
+_NPY_ALIGNMENT = 64
+
+
+def _require_numpy()->None:
+    if np is None:
+        raise ImportError("Embedding arrays need the numpy package")
+
+def decode_embedding(embedding: Any)->"np.ndarray":
+    """
+    Convert an embedding of the service into a float32 array
+
+    Args:
+        embedding (Any): The base64 string of the float32 bytes, or the list of floats when the service ignored the
+                         requested encoding
+
+    Returns:
+        embedding (np.ndarray): The 1-D float32 array. A decoded base64 embedding is a read-only view of its bytes.
+    """
+    _require_numpy()
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+    return np.asarray(embedding, dtype=np.float32)
+
+def embeddings_matrix(embeddings: List[Any])->"np.ndarray":
+    """
+    Decode embeddings into one contiguous float32 matrix, each embedding copied once into its row
+
+    Args:
+        embeddings (List[Any]): The embeddings, as base64 strings, lists of floats or arrays
+
+    Returns:
+        matrix (np.ndarray): The (number of embeddings, dimensions) float32 matrix
+    """
+    _require_numpy()
+    if not embeddings:
+        return np.empty((0, 0), dtype=np.float32)
+    first = decode_embedding(embeddings[0])
+    matrix = np.empty((len(embeddings), first.shape[0]), dtype=np.float32)
+    matrix[0] = first
+    for row, embedding in enumerate(embeddings[1:], start=1):
+        matrix[row] = decode_embedding(embedding)
+    return matrix
+
+def encode_embedding(embedding: List[float])->str:
+    """
+    Encode a list of floats the way the service does with encoding_format="base64"
+
+    Args:
+        embedding (List[float]): The embedding
+
+    Returns:
+        embedding (str): The base64 string of the little-endian float32 bytes
+    """
+    return base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode("ascii")
+
+
+class EmbeddingStore:
+    """
+    Append-only float32 .npy file of embeddings. The file is a valid .npy at every append, so np.load(path,
+    mmap_mode="r") or the array method map the rows written so far without reading them into memory.
+
+    Args:
+        path (str): The path of the .npy file, created when missing and appended to otherwise
+        dimensions (int): The size of the embeddings
+    """
+
+    def __init__(self, path: str, dimensions: int):
+        _require_numpy()
+        self.path = path
+        self.dimensions = dimensions
+        self._row_bytes = dimensions * 4
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            self._file.seek(0)
+            np.lib.format.read_magic(self._file)
+            shape, _, _ = np.lib.format.read_array_header_1_0(self._file)
+            if shape[1:] != (dimensions,):
+                raise ValueError(f"{path} holds embeddings of shape {shape[1:]}, not ({dimensions},)")
+            self._header_size = self._file.tell()
+            # Drop a partial row left by an interrupted append
+            self.rows = shape[0]
+            self._file.truncate(self._header_size + self.rows * self._row_bytes)
+        else:
+            self.rows = 0
+            self._header_size = len(self._header())
+            self._write_header()
+
+    def _header(self)->bytes:
+        header = _NPY_HEADER.format(rows=self.rows, dimensions=self.dimensions)
+        # Pad with spaces and end with a newline so the data starts on an aligned offset
+        padding = -(len(_NPY_MAGIC) + 2 + len(header) + 1) % _NPY_ALIGNMENT
+        header = (header + " " * padding + "\n").encode("latin1")
+        return _NPY_MAGIC + struct.pack("<H", len(header)) + header
+
+    def _write_header(self)->None:
+        self._file.seek(0)
+        self._file.write(self._header())
+
+    def append(self, embeddings: Any)->None:
+        """
+        Append embeddings after the rows already written
+
+        Args:
+            embeddings (Any): A (rows, dimensions) matrix, or a list of embeddings in any form decode_embedding accepts
+        """
+        matrix = embeddings if isinstance(embeddings, np.ndarray) else embeddings_matrix(list(embeddings))
+        if matrix.size == 0:
+            return
+        matrix = np.ascontiguousarray(matrix, dtype="<f4").reshape(-1, self.dimensions)
+        self._file.seek(self._header_size + self.rows * self._row_bytes)
+        self._file.write(matrix.tobytes())
+        self.rows += matrix.shape[0]
+        # The rows are written before the header counts them
+        self._file.flush()
+        self._write_header()
+        self._file.flush()
+
+    def array(self)->"np.ndarray":
+        """
+        Map the rows written so far
+
+        Returns:
+            embeddings (np.ndarray): The read-only (rows, dimensions) memory-mapped matrix
+        """
+        self._file.flush()
+        if not self.rows:
+            return np.empty((0, self.dimensions), dtype=np.float32)
+        return np.load(self.path, mmap_mode="r")
+
+    def __len__(self)->int:
+        return self.rows
+
+    def close(self)->None:
+        """Flush and close the file"""
+        self._file.close()
+
+    def __enter__(self)->"EmbeddingStore":
+        return self
+
+    def __exit__(self, *exc_info: Any)->None:
+        self.close()
+
@@ -0,0 +1,223 @@
+# This Script contains a dispatcher that merges concurrent single-input embedding calls into multi-input requests.
+# Callers keep calling get_embedding one text at a time, from many threads or tasks, passing the dispatcher as its
+# dispatcher argument, or call the get_embedding method of the dispatcher with the same arguments. The dispatcher
+# queues the texts and a background thread sends them as one Embedding.create request once max_batch_size texts are
+# waiting or the oldest text has waited max_wait seconds, then hands every caller the embedding of its own text. Texts are grouped by openai instance, deployment id, rate
+# limiter, cache, encoding, concurrency limiter and retry policy, so calls with different arguments are never merged.
+# With a SingleFlight, identical calls in flight share one queued text, also with the calls of the wrapper functions.
+
+# import the required libraries
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from utils.embedding_arrays import ARRAY_ENCODING_FORMAT, decode_embedding
+from utils.openai_retry import (
+    DEFAULT_EMBEDDING_BATCH_SIZE,
+    DEFAULT_EMBEDDING_BATCH_TOKENS,
+    DEFAULT_EMBEDDING_WORKERS,
+    _get_embedding_batch,
+    get_embedding,
+)
+from utils.openai_retry_async import aget_embedding
+from utils.rate_limiter import RateLimiter, estimate_tokens
+from utils.response_cache import ResponseCache
+from utils.retry_policy import RetryPolicy
+from utils.single_flight import SingleFlight
+
+# The longest time a text waits for other texts before its batch is sent
+DEFAULT_MAX_WAIT = 0.01  # seconds
+
+
+class _Pending:
+    """A text waiting to be sent, and the future of its embedding"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+
+class EmbeddingDispatcher:
+    """
+    Background dispatcher batching single-input embedding calls. Use its get_embedding or aget_embedding method in
+    place of the wrapper functions, and close it, or use it as a context manager, to send the texts still queued.
+
+    Args:
+        max_batch_size (int): The maximum number of inputs sent in one request
+        max_wait (float): The seconds a text waits for other texts before its batch is sent
+        batch_tokens (int): The maximum number of estimated tokens sent in one request
+        max_workers (int): The maximum number of requests in flight at once
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the batch requests, unless a call gives its own
+    """
+
+    def __init__(self, max_batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE, max_wait: float = DEFAULT_MAX_WAIT,
+                 batch_tokens: int = DEFAULT_EMBEDDING_BATCH_TOKENS, max_workers: int = DEFAULT_EMBEDDING_WORKERS,
+                 retry_policy: Optional[RetryPolicy] = None):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_tokens = batch_tokens
+        self.retry_policy = retry_policy
+        self.requests = 0
+        self._groups: Dict[Tuple, Tuple[tuple, List[_Pending]]] = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread = threading.Thread(target=self._run, name="EmbeddingDispatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, openai_instance: Any, deployment_id: str, input_text: str,
+               rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+               as_array: bool = False, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+               retry_policy: Optional[RetryPolicy] = None)->Future:
+        """
+        Queue a text to embed
+
+        Args:
+            openai_instance (Any): The Azure OpenAI instance, client or router to use
+            deployment_id (str): The base model deployment id to use, ignored with a router
+            input_text (str): The text to be presented to the model for the model to generate embedding
+            rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the batch request
+            cache (Optional[ResponseCache]): The response cache serving repeated inputs
+            as_array (bool): Request the base64 encoding and return a float32 NumPy array, needs numpy
+            concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+            retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the batch request
+
+        Returns:
+            future (Future): The future of the embedding
+        """
+        pending = _Pending(input_text)
+        retry_policy = retry_policy or self.retry_policy
+        arguments = (openai_instance, deployment_id, rate_limiter, cache, as_array, concurrency_limiter, retry_policy)
+        key = (id(openai_instance), deployment_id, id(rate_limiter), id(cache), as_array, id(concurrency_limiter),
+               id(retry_policy))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("EmbeddingDispatcher is closed")
+            _, items = self._groups.setdefault(key, (arguments, []))
+            items.append(pending)
+            # Wake the dispatcher to start the timer of a new batch or to send a full one
+            if len(items) == 1 or len(items) >= self.max_batch_size:
+                self._condition.notify()
+        return pending.future
+
+    def get_embedding(self, openai_instance: Any, deployment_id: str, input_text: str,
+                      rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                      as_array: bool = False, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                      retry_policy: Optional[RetryPolicy] = None, single_flight: Optional[SingleFlight] = None)->List:
+        """
+        Embed a text as part of a batch, with the arguments of utils.openai_retry.get_embedding
+
+        Args:
+            openai_instance (Any): The Azure OpenAI instance, client or router to use
+            deployment_id (str): The base model deployment id to use, ignored with a router
+            input_text (str): The text to be presented to the model for the model to generate embedding
+            rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the batch request
+            cache (Optional[ResponseCache]): The response cache serving repeated inputs
+            as_array (bool): Request the base64 encoding and return a float32 NumPy array, needs numpy
+            concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+            retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the batch request
+            single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+
+        Returns:
+            embedding (List): The returned embedding from Azure OpenAI, a float32 np.ndarray with as_array
+        """
+        return get_embedding(openai_instance, deployment_id, input_text, rate_limiter=rate_limiter, cache=cache,
+                             as_array=as_array, concurrency_limiter=concurrency_limiter, retry_policy=retry_policy,
+                             dispatcher=self, single_flight=single_flight)
+
+    async def aget_embedding(self, openai_instance: Any, deployment_id: str, input_text: str,
+                             rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                             as_array: bool = False, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                             retry_policy: Optional[RetryPolicy] = None,
+                             single_flight: Optional[SingleFlight] = None)->List:
+        """
+        Async embed a text as part of a batch, with the arguments of utils.openai_retry_async.aget_embedding
+
+        Args:
+            openai_instance (Any): The Azure OpenAI instance, client or router to use
+            deployment_id (str): The base model deployment id to use, ignored with a router
+            input_text (str): The text to be presented to the model for the model to generate embedding
+            rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the batch request
+            cache (Optional[ResponseCache]): The response cache serving repeated inputs
+            as_array (bool): Request the base64 encoding and return a float32 NumPy array, needs numpy
+            concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+            retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the batch request
+            single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+
+        Returns:
+            embedding (List): The returned embedding from Azure OpenAI, a float32 np.ndarray with as_array
+        """
+        return await aget_embedding(openai_instance, deployment_id, input_text, rate_limiter=rate_limiter, cache=cache,
+                                    as_array=as_array, concurrency_limiter=concurrency_limiter,
+                                    retry_policy=retry_policy, dispatcher=self, single_flight=single_flight)
+
+    def _take_batch(self, items: List[_Pending])->List[_Pending]:
+        """Remove the next batch from a queue, capped by item count and estimated tokens"""
+        count, tokens = 0, 0
+        for pending in items:
+            if count and (count >= self.max_batch_size or tokens + pending.tokens > self.batch_tokens):
+                break
+            count += 1
+            tokens += pending.tokens
+        batch = items[:count]
+        del items[:count]
+        return batch
+
+    def _run(self)->None:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                for key in list(self._groups):
+                    arguments, items = self._groups[key]
+                    while items and (self._closed or len(items) >= self.max_batch_size
+                                     or now - items[0].enqueued >= self.max_wait):
+                        self._executor.submit(self._send, arguments, self._take_batch(items))
+                        self.requests += 1
+                    if items:
+                        wait = items[0].enqueued + self.max_wait - now
+                        timeout = wait if timeout is None else min(timeout, wait)
+                    else:
+                        del self._groups[key]
+                if self._closed and not self._groups:
+                    return
+                self._condition.wait(timeout)
+
+    def _send(self, arguments: tuple, batch: List[_Pending])->None:
+        """Send a batch and resolve the futures of its texts"""
+        batch = [pending for pending in batch if pending.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        # A text queued several times is sent once
+        texts = list(dict.fromkeys(pending.text for pending in batch))
+        openai_instance, deployment_id, rate_limiter, cache, as_array, concurrency_limiter, retry_policy = arguments
+        try:
+            embeddings = _get_embedding_batch(openai_instance, deployment_id, texts, rate_limiter, cache,
+                                              ARRAY_ENCODING_FORMAT if as_array else None,
+                                              concurrency_limiter=concurrency_limiter, retry_policy=retry_policy)
+        except BaseException as exception:
+            for pending in batch:
+                pending.future.set_exception(exception)
+            return
+        by_text = dict(zip(texts, embeddings))
+        for pending in batch:
+            embedding = by_text[pending.text]
+            pending.future.set_result(decode_embedding(embedding) if as_array else embedding)
+
+    def close(self)->None:
+        """Send the queued texts, wait for their requests and stop the dispatcher"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self)->"EmbeddingDispatcher":
+        return self
+
+    def __exit__(self, *exc_info: Any)->None:
+        self.close()
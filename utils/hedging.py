@@ -0,0 +1,184 @@
+# This Script contains the hedging policy of the ChatCompletion wrapper functions.
+# A hedged call sends its request as usual, and when no answer has come back once the call has taken longer than a
+# latency percentile of the previous calls, sends a duplicate request, to another deployment when openai_instance is a
+# DeploymentRouter. The first answer wins and the other request is cancelled.
+# The synchronous wrappers send the request and its duplicate on the thread pool of the policy while the calling
+# thread waits for the first answer. A blocking HTTP request cannot be interrupted, so the request that lost keeps
+# running on its thread until it finishes and its answer is dropped. A call is sent unhedged on the calling thread
+# while every thread of the pool is busy, which bounds the abandoned requests. A budget caps the share of calls allowed
+# to send a duplicate, so a slow region cannot double the traffic and the quota spent.
+# Pass a HedgingPolicy as the hedging argument of get_chatcompletion or aget_chatcompletion, it is shared across calls.
+
+# import the required libraries
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from utils.metrics import percentile
+
+# The latency percentile after which a duplicate request is sent
+DEFAULT_HEDGE_PERCENTILE = 95
+
+# The share of calls allowed to send a duplicate request
+DEFAULT_HEDGE_BUDGET = 0.05
+
+# The number of unused hedges the budget can save up
+DEFAULT_HEDGE_BURST = 10
+
+# The number of latencies kept to compute the percentile
+DEFAULT_LATENCY_WINDOW = 1000
+
+# The number of latencies measured before the first hedge
+DEFAULT_MIN_SAMPLES = 20
+
+# The number of threads running the requests of the synchronous hedged calls
+DEFAULT_HEDGE_WORKERS = 32
+
+# The number of new latencies after which the hedge delay is computed again
+_REFRESH_EVERY = 16
+
+
+class HedgingPolicy:
+    """
+    Hedge delay and budget shared by the hedged calls
+
+    Args:
+        percentile (float): The latency percentile, between 0 and 100, after which a duplicate request is sent
+        budget (float): The share of calls allowed to send a duplicate request, 0.05 adds at most 5% more requests
+        burst (float): The number of unused hedges the budget can save up for a burst of slow calls
+        min_delay (float): The shortest hedge delay in seconds
+        max_delay (Optional[float]): The longest hedge delay in seconds, None for no cap
+        window (int): The number of latencies kept to compute the percentile
+        min_samples (int): The number of latencies measured before the first hedge
+        max_workers (int): The number of threads running the requests of the synchronous hedged calls, a call is sent
+                           unhedged on the calling thread while they are all busy
+    """
+
+    def __init__(self, percentile: float = DEFAULT_HEDGE_PERCENTILE, budget: float = DEFAULT_HEDGE_BUDGET,
+                 burst: float = DEFAULT_HEDGE_BURST, min_delay: float = 0.0, max_delay: Optional[float] = None,
+                 window: int = DEFAULT_LATENCY_WINDOW, min_samples: int = DEFAULT_MIN_SAMPLES,
+                 max_workers: int = DEFAULT_HEDGE_WORKERS):
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies: deque = deque(maxlen=window)
+        self._new_latencies = 0
+        self._delay: Optional[float] = None
+        self._credits = 0.0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # The requests of the synchronous calls still running, won, lost or abandoned
+        self._running = 0
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self)->ThreadPoolExecutor:
+        """The thread pool running the requests of the synchronous hedged calls, started on first use"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedging")
+            return self._executor
+
+    def start(self)->Optional[float]:
+        """
+        Count a new call and earn its share of the budget
+
+        Returns:
+            delay (Optional[float]): The seconds after which the call may be hedged, None before min_samples latencies
+                                     are measured
+        """
+        with self._lock:
+            self.calls += 1
+            self._credits = min(self.burst, self._credits + self.budget)
+            if len(self._latencies) < self.min_samples:
+                return None
+            if self._delay is None or self._new_latencies >= _REFRESH_EVERY:
+                delay = max(percentile(list(self._latencies), self.percentile), self.min_delay)
+                self._delay = delay if self.max_delay is None else min(delay, self.max_delay)
+                self._new_latencies = 0
+            return self._delay
+
+    def try_hedge(self)->bool:
+        """
+        Spend one hedge of the budget
+
+        Returns:
+            allowed (bool): True when the budget allows a duplicate request
+        """
+        with self._lock:
+            if self._credits < 1:
+                return False
+            self._credits -= 1
+            self.hedges += 1
+            return True
+
+    def submit_request(self, function: Callable[..., Any], *args: Any)->Optional[Future]:
+        """
+        Run the request of a synchronous hedged call on the thread pool
+
+        Args:
+            function (Callable[..., Any]): Sends the request, called with args
+
+        Returns:
+            future (Optional[Future]): The request, None when every thread of the pool is busy
+        """
+        return self._submit(False, function, *args)
+
+    def submit_hedge(self, function: Callable[..., Any], *args: Any)->Optional[Future]:
+        """
+        Spend one hedge of the budget and run a duplicate request on the thread pool
+
+        Args:
+            function (Callable[..., Any]): Sends the duplicate request, called with args
+
+        Returns:
+            future (Optional[Future]): The duplicate request, None when the budget is spent or every thread of the pool
+                                       is busy
+        """
+        return self._submit(True, function, *args)
+
+    def _submit(self, hedge: bool, function: Callable[..., Any], *args: Any)->Optional[Future]:
+        with self._lock:
+            if self._running >= self.max_workers or (hedge and self._credits < 1):
+                return None
+            if hedge:
+                self._credits -= 1
+                self.hedges += 1
+            self._running += 1
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self._request_done)
+        return future
+
+    def _request_done(self, future: Future)->None:
+        with self._lock:
+            self._running -= 1
+
+    def record(self, latency: float)->None:
+        """
+        Record the latency of a successful request, original or duplicate
+
+        Args:
+            latency (float): The seconds the request took
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            self._new_latencies += 1
+
+    def hedge_won(self)->None:
+        """Count a call answered first by its duplicate request"""
+        with self._lock:
+            self.hedge_wins += 1
+
+    def close(self)->None:
+        """Stop the thread pool, the abandoned requests still finish"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,437 @@
+# This Script contains the instrumentation of the Azure OpenAI wrapper functions.
+# Every wrapper call produces a CallRecord with its latency split into queue time (waiting on the rate limiter), permit
+# time (waiting on the adaptive concurrency limiter), backoff time (sleeping between retries) and network time (waiting
+# on the service), the retries by error class, the
+# token usage reported by the service and the cache outcomes. The records are passed to the hooks registered with
+# add_hook, and nothing is measured while no hook is registered. A call returning a stream is measured until the stream
+# ends, with the usage counted from its chunks.
+# MetricsCollector aggregates the records in memory. PrometheusExporter and OpenTelemetryExporter publish them through
+# the prometheus_client and opentelemetry-api packages, which are only needed when those exporters are used.
+
+# import the required libraries
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from utils.openai_stream import on_stream_end
+
+# The upper bounds of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds
+
+# The phases of the latency of a call
+LATENCY_PHASES = ("total", "queue", "permit", "backoff", "network")
+
+logger = logging.getLogger(__name__)
+
+
+class CallRecord:
+    """
+    Measurements of one wrapper call, passed to the hooks when the call ends
+
+    Args:
+        operation (str): The wrapper operation, for example "completion", "chatcompletion", "embedding" or "deployment"
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        # The deployment id, or the backend name with a router, of the last attempt
+        self.deployment: Optional[str] = None
+        self.started = time.time()
+        self.attempts = 0
+        self.retries: Dict[str, int] = defaultdict(int)
+        self.queue_time = 0.0
+        self.permit_time = 0.0
+        self.backoff_time = 0.0
+        self.network_time = 0.0
+        self.total_time = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # The number of cache lookups by outcome, "hit", "miss" or "bypass"
+        self.cache: Dict[str, int] = defaultdict(int)
+        # The class name of the error that ended the call, None if it succeeded
+        self.error: Optional[str] = None
+        # Guards the updates of a call whose attempts run on several threads, such as a hedged call
+        self._lock = threading.Lock()
+
+    def latency(self, phase: str)->float:
+        """Return the seconds spent in a phase of LATENCY_PHASES"""
+        return getattr(self, f"{phase}_time")
+
+    def __repr__(self)->str:
+        return (f"CallRecord({self.operation!r}, deployment={self.deployment!r}, attempts={self.attempts}, "
+                f"total_time={self.total_time:.3f}, error={self.error!r})")
+
+
+# The registered hooks and the record of the call running in the current thread or task
+_hooks: List[Callable[[CallRecord], None]] = []
+_current: contextvars.ContextVar = contextvars.ContextVar("openai_call_record", default=None)
+
+
+def add_hook(hook: Callable[[CallRecord], None])->None:
+    """
+    Register a callable receiving the CallRecord of every wrapper call when the call ends
+
+    Args:
+        hook (Callable[[CallRecord], None]): The hook, for example a MetricsCollector or an exporter
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook: Callable[[CallRecord], None])->None:
+    """
+    Unregister a hook
+
+    Args:
+        hook (Callable[[CallRecord], None]): The hook given to add_hook
+    """
+    _hooks.remove(hook)
+
+def _emit(record: CallRecord)->None:
+    for hook in list(_hooks):
+        try:
+            hook(record)
+        except Exception:
+            logger.exception("Metrics hook %r failed", hook)
+
+def _measure_stream(record: CallRecord, started: float, result: Any)->bool:
+    """Emit the record of a call returning a stream once the stream ends, False when the result is not a stream"""
+    returned = time.perf_counter()
+
+    def end(exception: Optional[BaseException])->None:
+        ended = time.perf_counter()
+        with record._lock:
+            # The rest of the stream was read after the call returned
+            record.network_time += ended - returned
+            record.total_time = ended - started
+            record.prompt_tokens += result.result.usage.get("prompt_tokens", 0)
+            record.completion_tokens += result.result.usage.get("completion_tokens", 0)
+            if exception is not None:
+                record.error = type(exception).__name__
+        _emit(record)
+
+    return on_stream_end(result, end)
+
+def instrumented(operation: str)->Callable:
+    """
+    Decorator producing a CallRecord for every call of a wrapper function or coroutine function. It is applied above
+    the retries of the call so that one record covers every attempt of the call. The record of a call returning a
+    stream is emitted when the stream ends.
+
+    Args:
+        operation (str): The wrapper operation stored in the records
+
+    Returns:
+        decorator (Callable): The decorator to apply
+    """
+    def decorator(func: Callable)->Callable:
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any)->Any:
+                if not _hooks:
+                    return await func(*args, **kwargs)
+                record = CallRecord(operation)
+                token = _current.set(record)
+                started, streamed = time.perf_counter(), False
+                try:
+                    result = await func(*args, **kwargs)
+                    streamed = _measure_stream(record, started, result)
+                    return result
+                except BaseException as exception:
+                    record.error = type(exception).__name__
+                    raise
+                finally:
+                    _current.reset(token)
+                    if not streamed:
+                        record.total_time = time.perf_counter() - started
+                        _emit(record)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any)->Any:
+            if not _hooks:
+                return func(*args, **kwargs)
+            record = CallRecord(operation)
+            token = _current.set(record)
+            started, streamed = time.perf_counter(), False
+            try:
+                result = func(*args, **kwargs)
+                streamed = _measure_stream(record, started, result)
+                return result
+            except BaseException as exception:
+                record.error = type(exception).__name__
+                raise
+            finally:
+                _current.reset(token)
+                if not streamed:
+                    record.total_time = time.perf_counter() - started
+                    _emit(record)
+
+        return wrapper
+
+    return decorator
+
+def record_retry(exception: BaseException, delay: float)->None:
+    """
+    Count a retry of the current call and the backoff before it
+
+    Args:
+        exception (BaseException): The error that triggered the retry
+        delay (float): The seconds waited before the next attempt
+    """
+    record = _current.get()
+    if record is not None:
+        with record._lock:
+            record.retries[type(exception).__name__] += 1
+            record.backoff_time += delay
+
+def record_attempt(deployment: str, queue_time: float, network_time: float, response: Any = None,
+                   permit_time: float = 0.0)->None:
+    """
+    Add one request attempt to the current call
+
+    Args:
+        deployment (str): The deployment id, or the backend name with a router, the attempt was sent to
+        queue_time (float): The seconds waited on the rate limiter
+        network_time (float): The seconds waited on the service
+        response (Any): The response of the attempt, None if it failed
+        permit_time (float): The seconds waited for a permit of the adaptive concurrency limiter
+    """
+    record = _current.get()
+    if record is None:
+        return
+    usage = response.get("usage") if isinstance(response, dict) else None
+    with record._lock:
+        record.deployment = deployment
+        record.attempts += 1
+        record.queue_time += queue_time
+        record.permit_time += permit_time
+        record.network_time += network_time
+        if usage:
+            record.prompt_tokens += usage.get("prompt_tokens", 0)
+            record.completion_tokens += usage.get("completion_tokens", 0)
+
+def record_cache(outcome: str, deployment: str)->None:
+    """
+    Count a response cache lookup of the current call
+
+    Args:
+        outcome (str): "hit", "miss" or "bypass"
+        deployment (str): The deployment id of the lookup, kept for calls served from the cache
+    """
+    record = _current.get()
+    if record is not None:
+        with record._lock:
+            record.cache[outcome] += 1
+            if record.deployment is None:
+                record.deployment = deployment
+
+def percentile(values: List[float], q: float)->float:
+    """
+    Return the q-th percentile of values, interpolating between the closest ranks
+
+    Args:
+        values (List[float]): The measured values
+        q (float): The percentile, between 0 and 100
+
+    Returns:
+        value (float): The percentile, 0 when there are no values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class _Histogram:
+    """Per-bucket counts, sum and count of observed values"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float)->None:
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float)->float:
+        """Return the upper bound of the bucket holding the q quantile, inf beyond the last bucket"""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsCollector:
+    """
+    Hook aggregating the call records in memory, per operation and deployment
+
+    Args:
+        buckets (Sequence[float]): The upper bounds of the latency histogram buckets in seconds
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self)->None:
+        """Drop the aggregated measurements"""
+        with self._lock:
+            self.calls: Dict[Tuple[str, str], int] = defaultdict(int)
+            self.errors: Dict[Tuple[str, str, str], int] = defaultdict(int)
+            self.retries: Dict[Tuple[str, str, str], int] = defaultdict(int)
+            self.tokens: Dict[Tuple[str, str, str], int] = defaultdict(int)
+            self.cache: Dict[Tuple[str, str], int] = defaultdict(int)
+            self.latency: Dict[Tuple[str, str, str], _Histogram] = {}
+
+    def __call__(self, record: CallRecord)->None:
+        key = (record.operation, record.deployment or "")
+        with self._lock:
+            self.calls[key] += 1
+            if record.error is not None:
+                self.errors[key + (record.error,)] += 1
+            for error, count in record.retries.items():
+                self.retries[key + (error,)] += count
+            self.tokens[key + ("prompt",)] += record.prompt_tokens
+            self.tokens[key + ("completion",)] += record.completion_tokens
+            for outcome, count in record.cache.items():
+                self.cache[(record.operation, outcome)] += count
+            for phase in LATENCY_PHASES:
+                histogram = self.latency.setdefault(key + (phase,), _Histogram(self.buckets))
+                histogram.observe(record.latency(phase))
+
+    def snapshot(self)->Dict[str, Any]:
+        """
+        Return the aggregated measurements
+
+        Returns:
+            snapshot (Dict[str, Any]): The calls, errors, retries by error class, tokens and cache lookups, and the
+                                       count, mean, p50 and p99 bucket bound of each latency phase, keyed by
+                                       "operation/deployment"
+        """
+        with self._lock:
+            snapshot: Dict[str, Any] = {}
+            for (operation, deployment), calls in self.calls.items():
+                name = f"{operation}/{deployment}"
+                entry = {"calls": calls,
+                         "errors": {error: count for (op, dep, error), count in self.errors.items()
+                                    if (op, dep) == (operation, deployment)},
+                         "retries": {error: count for (op, dep, error), count in self.retries.items()
+                                     if (op, dep) == (operation, deployment)},
+                         "prompt_tokens": self.tokens[(operation, deployment, "prompt")],
+                         "completion_tokens": self.tokens[(operation, deployment, "completion")],
+                         "latency": {}}
+                for phase in LATENCY_PHASES:
+                    histogram = self.latency[(operation, deployment, phase)]
+                    entry["latency"][phase] = {"count": histogram.count,
+                                               "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                                               "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99)}
+                snapshot[name] = entry
+            snapshot["cache"] = {f"{operation}/{outcome}": count for (operation, outcome), count in self.cache.items()}
+            return snapshot
+
+
+class PrometheusExporter:
+    """
+    Hook publishing the call records as Prometheus metrics. Needs the prometheus_client package.
+
+    Args:
+        registry (Optional[Any]): The prometheus_client registry, the default registry when None
+        buckets (Sequence[float]): The upper bounds of the latency histogram buckets in seconds
+        prefix (str): The prefix of the metric names
+    """
+
+    def __init__(self, registry: Optional[Any] = None, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+                 prefix: str = "azure_openai"):
+        try:
+            import prometheus_client
+        except ImportError as exception:
+            raise ImportError("PrometheusExporter needs the prometheus_client package") from exception
+
+        registry = registry if registry is not None else prometheus_client.REGISTRY
+        labels = ["operation", "deployment"]
+        self.calls = prometheus_client.Counter(f"{prefix}_calls", "Wrapper calls", labels + ["outcome"],
+                                               registry=registry)
+        self.latency = prometheus_client.Histogram(f"{prefix}_call_seconds", "Wrapper call latency by phase",
+                                                   labels + ["phase"], buckets=buckets, registry=registry)
+        self.retries = prometheus_client.Counter(f"{prefix}_retries", "Retries by error class", labels + ["error"],
+                                                 registry=registry)
+        self.tokens = prometheus_client.Counter(f"{prefix}_tokens", "Tokens reported by the service",
+                                                labels + ["kind"], registry=registry)
+        self.cache = prometheus_client.Counter(f"{prefix}_cache_lookups", "Response cache lookups",
+                                               ["operation", "outcome"], registry=registry)
+
+    def __call__(self, record: CallRecord)->None:
+        labels = (record.operation, record.deployment or "")
+        self.calls.labels(*labels, "error" if record.error else "success").inc()
+        for phase in LATENCY_PHASES:
+            self.latency.labels(*labels, phase).observe(record.latency(phase))
+        for error, count in record.retries.items():
+            self.retries.labels(*labels, error).inc(count)
+        self.tokens.labels(*labels, "prompt").inc(record.prompt_tokens)
+        self.tokens.labels(*labels, "completion").inc(record.completion_tokens)
+        for outcome, count in record.cache.items():
+            self.cache.labels(record.operation, outcome).inc(count)
+
+
+class OpenTelemetryExporter:
+    """
+    Hook publishing the call records as OpenTelemetry metrics and a span per call. Needs the opentelemetry-api
+    package, and an SDK configured by the application for the data to be exported.
+
+    Args:
+        meter_provider (Optional[Any]): The meter provider, the global one when None
+        tracer_provider (Optional[Any]): The tracer provider, the global one when None
+    """
+
+    def __init__(self, meter_provider: Optional[Any] = None, tracer_provider: Optional[Any] = None):
+        try:
+            from opentelemetry import metrics, trace
+        except ImportError as exception:
+            raise ImportError("OpenTelemetryExporter needs the opentelemetry-api package") from exception
+
+        self._trace = trace
+        meter = metrics.get_meter(__name__, meter_provider=meter_provider)
+        self.tracer = trace.get_tracer(__name__, tracer_provider=tracer_provider)
+        self.latency = meter.create_histogram("azure_openai.call.duration", unit="s",
+                                              description="Wrapper call latency by phase")
+        self.retries = meter.create_counter("azure_openai.retries", description="Retries by error class")
+        self.tokens = meter.create_counter("azure_openai.tokens", description="Tokens reported by the service")
+        self.cache = meter.create_counter("azure_openai.cache.lookups", description="Response cache lookups")
+
+    def __call__(self, record: CallRecord)->None:
+        attributes = {"operation": record.operation, "deployment": record.deployment or ""}
+        for phase in LATENCY_PHASES:
+            self.latency.record(record.latency(phase), {**attributes, "phase": phase})
+        for error, count in record.retries.items():
+            self.retries.add(count, {**attributes, "error": error})
+        self.tokens.add(record.prompt_tokens, {**attributes, "kind": "prompt"})
+        self.tokens.add(record.completion_tokens, {**attributes, "kind": "completion"})
+        for outcome, count in record.cache.items():
+            self.cache.add(count, {"operation": record.operation, "outcome": outcome})
+
+        # The span is created once the call has ended, with the start and end times of the call
+        start = int(record.started * 1e9)
+        span = self.tracer.start_span(f"azure_openai.{record.operation}", start_time=start, attributes={
+            **attributes, "attempts": record.attempts, "queue_time": record.queue_time,
+            "permit_time": record.permit_time, "backoff_time": record.backoff_time, "network_time": record.network_time,
+            "prompt_tokens": record.prompt_tokens, "completion_tokens": record.completion_tokens})
+        if record.error is not None:
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, record.error))
+        span.end(end_time=start + int(record.total_time * 1e9))
@@ -0,0 +1,250 @@
+# This Script contains a local stand-in for an Azure OpenAI instance, used to load test the wrapper functions.
+# It serves the Completions, ChatCompletions, Embeddings and Deployments endpoints of any deployment id with a
+# configurable latency distribution, injects 429 and 503 errors carrying Retry-After headers at configurable rates, and
+# simulates the RPM and TPM quota of every deployment, answering 429 with the time until the quota frees up.
+# Start it with MockAzureOpenAIServer().start() and point an AzureOpenAIClient at its api_base with any API key.
+
+# import the required libraries
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+from utils.embedding_arrays import encode_embedding
+from utils.rate_limiter import RateLimiter, estimate_chat_tokens, estimate_completion_tokens, estimate_tokens
+
+# The median latency of a response
+DEFAULT_LATENCY_MEDIAN = 0.2  # seconds
+
+# The spread of the log-normal latency distribution, 0 for a constant latency
+DEFAULT_LATENCY_SIGMA = 0.5
+
+# The extra latency per generated token
+DEFAULT_TOKEN_LATENCY = 0.01  # seconds
+
+# The Retry-After of the injected errors
+DEFAULT_RETRY_AFTER = 1.0  # seconds
+
+# The size of the returned embeddings
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+
+# The number of tokens generated when a request does not set max_tokens
+DEFAULT_MAX_TOKENS = 16
+
+_DEPLOYMENT_PATH = re.compile(r"^/openai/deployments/([^/?]+)(/[a-z/]+)?$")
+
+
+class MockAzureOpenAIServer:
+    """
+    Local HTTP server mimicking the Azure OpenAI data plane, running on a background thread
+
+    Args:
+        host (str): The interface to listen on
+        port (int): The port to listen on, 0 for a free port
+        latency_median (float): The median latency of a response in seconds
+        latency_sigma (float): The spread of the log-normal latency distribution
+        token_latency (float): The extra latency per generated token in seconds
+        error_rate_429 (float): The share of requests answered with an injected 429
+        error_rate_503 (float): The share of requests answered with an injected 503
+        retry_after (float): The Retry-After of the injected errors in seconds
+        requests_per_minute (Optional[int]): The RPM quota of every deployment, None for no request limit
+        tokens_per_minute (Optional[int]): The TPM quota of every deployment, None for no token limit
+        embedding_dimensions (int): The size of the returned embeddings
+        seed (Optional[int]): The seed of the latency and error draws, for reproducible runs
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_median: float = DEFAULT_LATENCY_MEDIAN,
+                 latency_sigma: float = DEFAULT_LATENCY_SIGMA, token_latency: float = DEFAULT_TOKEN_LATENCY,
+                 error_rate_429: float = 0.0, error_rate_503: float = 0.0, retry_after: float = DEFAULT_RETRY_AFTER,
+                 requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 embedding_dimensions: int = DEFAULT_EMBEDDING_DIMENSIONS, seed: Optional[int] = None):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.token_latency = token_latency
+        self.error_rate_429 = error_rate_429
+        self.error_rate_503 = error_rate_503
+        self.retry_after = retry_after
+        self.embedding_dimensions = embedding_dimensions
+        self.quota = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.stats: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self)->str:
+        """The endpoint to give to the client"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self)->"MockAzureOpenAIServer":
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self)->None:
+        """Stop serving and close the socket"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self)->"MockAzureOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any)->None:
+        self.stop()
+
+    def _count(self, outcome: str)->None:
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _draw(self)->Tuple[float, float]:
+        """Return a uniform draw for error injection and a log-normal latency draw"""
+        with self._lock:
+            error_draw = self._random.random()
+            latency = self._random.lognormvariate(math.log(self.latency_median), self.latency_sigma) \
+                if self.latency_median > 0 else 0.0
+        return error_draw, latency
+
+    def handle(self, method: str, path: str, body: Dict[str, Any])->Tuple[int, Dict[str, str], Any]:
+        """
+        Answer one request
+
+        Args:
+            method (str): The HTTP method
+            path (str): The request path without the query string
+            body (Dict[str, Any]): The JSON body of the request
+
+        Returns:
+            status (int): The HTTP status
+            headers (Dict[str, str]): The response headers
+            payload (Any): The JSON payload, or the list of stream chunks when the request set stream
+        """
+        match = _DEPLOYMENT_PATH.match(path)
+        if match is None:
+            self._count("404")
+            return 404, {}, _error("NotFound", "Resource not found")
+        deployment_id, operation = match.group(1), match.group(2) or ""
+
+        if method == "GET" and not operation:
+            self._count("200")
+            return 200, {}, {"id": deployment_id, "object": "deployment", "model": deployment_id,
+                             "status": "succeeded", "name": deployment_id}
+        if method != "POST" or operation not in ("/completions", "/chat/completions", "/embeddings"):
+            self._count("404")
+            return 404, {}, _error("NotFound", "Resource not found")
+
+        error_draw, latency = self._draw()
+        if error_draw < self.error_rate_429:
+            self._count("429")
+            return 429, _retry_headers(self.retry_after), _error("429", "Requests to the deployment have exceeded "
+                                                                 "the rate limit (injected)")
+        if error_draw < self.error_rate_429 + self.error_rate_503:
+            self._count("503")
+            return 503, _retry_headers(self.retry_after), _error("ServiceUnavailable", "The service is temporarily "
+                                                                 "unavailable (injected)")
+
+        # Charge the quota the way Azure OpenAI does, with the prompt and the max_tokens of the request
+        if operation == "/embeddings":
+            inputs = body.get("input", "")
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            prompt_tokens = sum(estimate_tokens(text) for text in inputs)
+            charged, completion_tokens = prompt_tokens, 0
+        else:
+            completion_tokens = body.get("max_tokens") or DEFAULT_MAX_TOKENS
+            if operation == "/chat/completions":
+                charged = estimate_chat_tokens(body.get("messages", []), max_tokens=completion_tokens)
+            else:
+                charged = estimate_completion_tokens(str(body.get("prompt", "")), max_tokens=completion_tokens)
+            prompt_tokens = charged - completion_tokens
+        wait_time = self.quota.try_acquire(deployment_id, charged)
+        if wait_time > 0:
+            self._count("429")
+            headers = {"retry-after-ms": str(int(wait_time * 1000)), "retry-after": str(math.ceil(wait_time)),
+                       "x-ratelimit-remaining-tokens": "0"}
+            return 429, headers, _error("429", f"Requests to the deployment have exceeded the rate limit, retry after "
+                                               f"{wait_time:.3f} seconds")
+
+        time.sleep(latency + self.token_latency * completion_tokens)
+        self._count("200")
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        remaining = self.quota.remaining_tokens(deployment_id)
+        headers = {"x-ratelimit-remaining-tokens": str(int(remaining))} if remaining != float("inf") else {}
+
+        if operation == "/embeddings":
+            encode = encode_embedding if body.get("encoding_format") == "base64" else list
+            data = [{"object": "embedding", "index": index, "embedding": encode(self._embedding(text))}
+                    for index, text in enumerate(inputs)]
+            return 200, headers, {"object": "list", "model": deployment_id, "data": data, "usage": usage}
+
+        words = ["lorem"] * completion_tokens
+        if operation == "/chat/completions":
+            if body.get("stream"):
+                chunks = [{"choices": [{"index": 0, "delta": {"content": f"{word} "}, "finish_reason": None}]}
+                          for word in words]
+                chunks.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "length"}]})
+                return 200, headers, chunks
+            message = {"role": "assistant", "content": " ".join(words)}
+            return 200, headers, {"object": "chat.completion", "model": deployment_id, "usage": usage,
+                                  "choices": [{"index": 0, "message": message, "finish_reason": "length"}]}
+        if body.get("stream"):
+            chunks = [{"choices": [{"index": 0, "text": f"{word} ", "finish_reason": None}]} for word in words]
+            chunks.append({"choices": [{"index": 0, "text": "", "finish_reason": "length"}]})
+            return 200, headers, chunks
+        return 200, headers, {"object": "text_completion", "model": deployment_id, "usage": usage,
+                              "choices": [{"index": 0, "text": " ".join(words), "finish_reason": "length"}]}
+
+    def _embedding(self, text: str)->list:
+        generator = random.Random(text)
+        return [generator.uniform(-1, 1) for _ in range(self.embedding_dimensions)]
+
+
+def _error(code: str, message: str)->Dict[str, Any]:
+    return {"error": {"code": code, "message": message}}
+
+def _retry_headers(retry_after: float)->Dict[str, str]:
+    return {"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(math.ceil(retry_after))}
+
+def _handler(server: MockAzureOpenAIServer)->type:
+    """Build the request handler class bound to a mock server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, method: str)->None:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+            status, headers, payload = server.handle(method, self.path.split("?", 1)[0], body)
+            if status == 200 and body.get("stream"):
+                content = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in payload) + "data: [DONE]\n\n"
+                content_type = "text/event-stream"
+            else:
+                content = json.dumps(payload)
+                content_type = "application/json"
+            data = content.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self)->None:
+            self._reply("GET")
+
+        def do_POST(self)->None:
+            self._reply("POST")
+
+        def log_message(self, *args: Any)->None:
+            pass
+
+    return Handler
@@ -0,0 +1,199 @@
+# This Script contains a client object for Azure OpenAI that carries its own endpoint configuration, so it can be passed
+# as the openai_instance of the wrapper functions instead of the openai module, without setting openai.api_key,
+# openai.api_base or openai.api_version. Clients for different endpoints can be used from different threads at once.
+# Every client owns a keep-alive requests session for its sync calls, shared by all the threads using the client, so
+# workers reuse their TLS connections instead of opening new ones. The openai SDK sends a request through the session of
+# the current thread, so a client installs its session for the thread only while one of its calls runs, and the
+# global settings of the openai module are never changed. pooled_aiosession shares an aiohttp session between the async
+# calls made inside it.
+# The openai SDK sends its requests with requests and aiohttp, neither of which speaks HTTP/2, so the pools use HTTP/1.1.
+
+# import the required libraries
+import asyncio
+import contextlib
+import functools
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, Tuple, Union
+import openai
+import openai.api_requestor
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.token_provider import AzureADTokenProvider
+
+# The number of hosts the sync session keeps a connection pool for
+DEFAULT_POOL_CONNECTIONS = 10
+
+# The number of keep-alive connections kept per host, at least the number of worker threads
+DEFAULT_POOL_MAXSIZE = 32
+
+# The number of connections the async session opens per host
+DEFAULT_ASYNC_LIMIT_PER_HOST = 100
+
+# The connect and read timeouts of a request
+DEFAULT_REQUEST_TIMEOUT = (10, 600)  # seconds
+
+# The number of times a request is resent when the connection fails before any data was sent
+DEFAULT_CONNECTION_RETRIES = 2
+
+# The API version used by the clients
+DEFAULT_API_VERSION = "2023-05-15"
+
+
+def make_session(pool_connections: int = DEFAULT_POOL_CONNECTIONS, pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 max_retries: int = DEFAULT_CONNECTION_RETRIES)->requests.Session:
+    """
+    Create a session with a keep-alive connection pool sized for multi-threaded workers
+
+    Args:
+        pool_connections (int): The number of hosts to keep a connection pool for
+        pool_maxsize (int): The number of connections kept per host
+        max_retries (int): The number of times a request is resent when the connection fails
+
+    Returns:
+        session (requests.Session): The session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@contextlib.contextmanager
+def _session_scope(session: requests.Session)->Iterator[None]:
+    """
+    Make the openai SDK send the sync requests of the current thread through a session while the context runs, and
+    give the thread its own session back afterwards
+    """
+    context = openai.api_requestor._thread_context
+    previous = context.__dict__.copy()
+    context.session = session
+    # A fresh creation time keeps the SDK from closing the session as expired
+    context.session_create_time = time.time()
+    try:
+        yield
+    finally:
+        context.__dict__.clear()
+        context.__dict__.update(previous)
+
+@contextlib.asynccontextmanager
+async def pooled_aiosession(limit_per_host: int = DEFAULT_ASYNC_LIMIT_PER_HOST)->AsyncIterator[Any]:
+    """
+    Send the async requests made inside the context through one shared aiohttp session. By default the SDK opens a new
+    session, and so a new connection, for every async request.
+
+    Args:
+        limit_per_host (int): The number of connections opened per host
+
+    Returns:
+        session (aiohttp.ClientSession): The shared session, closed when the context exits
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=limit_per_host, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+
+
+class _Resource:
+    """An openai resource class whose methods are called with the configuration of a client"""
+
+    def __init__(self, resource: Any, options: Callable[[], Dict[str, Any]],
+                 aoptions: Callable[[], Awaitable[Dict[str, Any]]], session: requests.Session):
+        self._resource = resource
+        self._options = options
+        self._aoptions = aoptions
+        self._session = session
+
+    def __getattr__(self, name: str)->Any:
+        attribute = getattr(self._resource, name)
+        if not callable(attribute):
+            return attribute
+
+        if asyncio.iscoroutinefunction(attribute):
+            @functools.wraps(attribute)
+            async def amethod(*args: Any, **kwargs: Any)->Any:
+                return await attribute(*args, **{**(await self._aoptions()), **kwargs})
+
+            return amethod
+
+        @functools.wraps(attribute)
+        def method(*args: Any, **kwargs: Any)->Any:
+            # Arguments given to the call take precedence over the client configuration
+            with _session_scope(self._session):
+                return attribute(*args, **{**self._options(), **kwargs})
+
+        return method
+
+
+class AzureOpenAIClient:
+    """
+    Azure OpenAI endpoint configuration that can be passed as the openai_instance of the wrapper functions. It exposes
+    the Completion, ChatCompletion, Embedding and Deployment resources of the openai module, called with its own
+    endpoint, key, API type, API version and timeout instead of the global settings of the module.
+
+    Args:
+        api_base (str): The endpoint of the Azure OpenAI instance
+        api_key (Optional[str]): The API key or Azure AD token of the instance
+        api_type (Optional[str]): "azure" for an API key, "azure_ad" for an Azure AD token. Defaults to "azure_ad" with
+                                  a token provider and "azure" otherwise.
+        api_version (str): The API version to use
+        request_timeout (Union[float, Tuple[float, float]]): The timeout of a request, or its connect and read timeouts
+        session (Optional[requests.Session]): The session of the sync requests of the client, a new session from
+                                              make_session when it is not given. Clients may share a session.
+        token_provider (Optional[AzureADTokenProvider]): Supplies a fresh Azure AD token for every call, used instead
+                                                         of api_key
+    """
+
+    def __init__(self, api_base: str, api_key: Optional[str] = None, api_type: Optional[str] = None,
+                 api_version: str = DEFAULT_API_VERSION,
+                 request_timeout: Union[float, Tuple[float, float]] = DEFAULT_REQUEST_TIMEOUT,
+                 session: Optional[requests.Session] = None, token_provider: Optional[AzureADTokenProvider] = None):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.api_type = api_type or ("azure_ad" if token_provider is not None else "azure")
+        self.token_provider = token_provider
+        self.api_version = api_version
+        self.request_timeout = request_timeout
+        self.session = session if session is not None else make_session()
+
+        self.Completion = _Resource(openai.Completion, self.options, self.aoptions, self.session)
+        self.ChatCompletion = _Resource(openai.ChatCompletion, self.options, self.aoptions, self.session)
+        self.Embedding = _Resource(openai.Embedding, self.options, self.aoptions, self.session)
+        self.Deployment = _Resource(openai.Deployment, self.options, self.aoptions, self.session)
+
+    def options(self)->Dict[str, Any]:
+        """
+        Return the connection parameters passed to the openai create and retrieve methods
+
+        Returns:
+            options (Dict[str, Any]): The api_base, api_key, api_type, api_version and request_timeout of the client
+        """
+        api_key = self.token_provider.token() if self.token_provider is not None else self.api_key
+        return self._with_key(api_key)
+
+    async def aoptions(self)->Dict[str, Any]:
+        """
+        Async options, the token is read with atoken so that a refresh does not block the event loop
+
+        Returns:
+            options (Dict[str, Any]): The api_base, api_key, api_type, api_version and request_timeout of the client
+        """
+        api_key = await self.token_provider.atoken() if self.token_provider is not None else self.api_key
+        return self._with_key(api_key)
+
+    def _with_key(self, api_key: Optional[str])->Dict[str, Any]:
+        options = {"api_base": self.api_base, "api_key": api_key, "api_type": self.api_type,
+                   "api_version": self.api_version, "request_timeout": self.request_timeout}
+        return {key: value for key, value in options.items() if value is not None}
+
+    def close(self)->None:
+        """Close the connections of the session of the client"""
+        self.session.close()
+
+    def __repr__(self)->str:
+        return f"AzureOpenAIClient({self.api_base!r}, api_type={self.api_type!r}, api_version={self.api_version!r})"
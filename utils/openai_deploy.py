@@ -1,15 +1,285 @@
+"""This module can be used to deploy base models with custom deployment names.
 
+deployment_model_with_custom_name deploys one model and waits for it. DeploymentProvisioner brings a list of
+DeploymentSpec, possibly spread over several subscriptions, accounts and regions, to the declared state: the existing
+deployments of every account are listed once, only the missing or changed deployments are created or updated, all the
+long-running operations run at once and are polled together, and readiness is checked with deployment_retrieve on the
+data plane. Applying the same specs twice changes nothing. An account allows only one deployment of a model version, so a
+spec whose model version is already deployed under another name reuses that deployment.
+"""
 
-"""This module can be used to deploy a base model with a custom deployment name."""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
+import openai
 from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
 from azure.identity import AzureCliCredential
 
-def deployment_model_with_custom_name(credential: AzureCliCredential, subscription_id: str,cog_rg: str, openai_instance_name: str, deployment_name: str, model: str, model_version: str)->str:
+from utils.openai_retry import deployment_retrieve
+
+# The number of management and data plane calls sent at once
+DEFAULT_PROVISIONING_WORKERS = 8
+
+# The interval between two polls of the long-running operations and of the readiness checks
+DEFAULT_POLL_INTERVAL = 5  # seconds
+
+# The time to wait for the deployments to be created and ready
+DEFAULT_PROVISIONING_TIMEOUT = 1800  # seconds
+
+# The outcomes of the diff of a spec against the existing deployments
+CREATE = "create"
+UPDATE = "update"
+UNCHANGED = "unchanged"
+REUSE = "reuse"
+
+# The management clients, one per subscription, reused by every call
+_clients: Dict[Tuple[int, str], CognitiveServicesManagementClient] = {}
+_clients_lock = threading.Lock()
+
+
+def management_client(credential: Any, subscription_id: str)->CognitiveServicesManagementClient:
+    """
+    Return the management client of a subscription, created on first use and reused afterwards
+
+    Args:
+        credential (Any): Azure authentication credentials to use, for example AzureCliCredential
+        subscription_id (str): Azure subscription id the Azure OpenAI instances reside
+
+    Returns:
+        client (CognitiveServicesManagementClient): The shared management client
+    """
+    key = (id(credential), subscription_id)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = CognitiveServicesManagementClient(credential=credential,
+                                                                       subscription_id=subscription_id)
+        return client
+
+
+class DeploymentSpec:
+    """
+    The declared state of one deployment
+
+    Args:
+        resource_group (str): The Cognitive Services Resource Group the Azure OpenAI instance resides
+        account_name (str): The name of the Azure OpenAI instance
+        deployment_name (str): The custom name the deployment should use
+        model (str): The Azure OpenAI base model to deploy
+        model_version (str): The Azure OpenAI base model version to deploy
+        sku_name (str): The SKU of the deployment, for example "Standard"
+        capacity (int): The capacity of the deployment, in thousands of tokens per minute for Standard
+        subscription_id (Optional[str]): The subscription of the instance, None for the one of the provisioner
+        openai_instance (Any): The data plane client of the instance, for example an AzureOpenAIClient, used to check
+                               that the deployment answers. None to rely on the provisioning state only.
+    """
+
+    def __init__(self, resource_group: str, account_name: str, deployment_name: str, model: str, model_version: str,
+                 sku_name: str = "Standard", capacity: int = 1, subscription_id: Optional[str] = None,
+                 openai_instance: Any = None):
+        self.resource_group = resource_group
+        self.account_name = account_name
+        self.deployment_name = deployment_name
+        self.model = model
+        self.model_version = model_version
+        self.sku_name = sku_name
+        self.capacity = capacity
+        self.subscription_id = subscription_id
+        self.openai_instance = openai_instance
+
+    def body(self)->Dict[str, Any]:
+        """Return the deployment resource sent to begin_create_or_update"""
+        return {
+            "properties": {
+                "model": {
+                    "format": "OpenAI",
+                    "name": self.model,
+                    "version": self.model_version
+                },
+                "scaleSettings": {
+                    "scaleType": "Standard",
+                }
+            },
+            "sku": {
+                "name": self.sku_name,
+                "capacity": self.capacity
+            }
+        }
+
+    def same_model(self, deployment: Any)->bool:
+        """Tell whether an existing deployment serves the declared model and version"""
+        model = deployment.properties.model
+        return model.name == self.model and model.version == self.model_version
+
+    def matches(self, deployment: Any)->bool:
+        """Tell whether an existing deployment already has the declared model, version, SKU and capacity"""
+        sku = deployment.sku
+        return self.same_model(deployment) and sku is not None and sku.name == self.sku_name \
+            and sku.capacity == self.capacity
+
+    def __repr__(self)->str:
+        return f"DeploymentSpec({self.account_name!r}, {self.deployment_name!r}, {self.model!r})"
+
+
+class DeploymentProvisioner:
+    """
+    Declarative, concurrent provisioning of Azure OpenAI deployments
+
+    Args:
+        credential (Any): Azure authentication credentials to use, for example AzureCliCredential
+        subscription_id (str): Azure subscription id of the specs that do not name one
+        max_workers (int): The number of management and data plane calls sent at once
+        poll_interval (float): The seconds between two polls of the operations and of the readiness checks
+    """
+
+    def __init__(self, credential: Any, subscription_id: str, max_workers: int = DEFAULT_PROVISIONING_WORKERS,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self.credential = credential
+        self.subscription_id = subscription_id
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+
+    def _client(self, spec: DeploymentSpec)->CognitiveServicesManagementClient:
+        return management_client(self.credential, spec.subscription_id or self.subscription_id)
+
+    def _account(self, spec: DeploymentSpec)->Tuple[str, str, str]:
+        return spec.subscription_id or self.subscription_id, spec.resource_group, spec.account_name
+
+    def plan(self, specs: List[DeploymentSpec])->List[Tuple[DeploymentSpec, str, str]]:
+        """
+        Diff the specs against the existing deployments, listing every account once
+
+        Args:
+            specs (List[DeploymentSpec]): The declared deployments
+
+        Returns:
+            plan (List[Tuple[DeploymentSpec, str, str]]): Every spec with CREATE, UPDATE, UNCHANGED or REUSE, and the
+                                                          name of the deployment serving it, the name of an existing
+                                                          deployment of the same model version for REUSE
+        """
+        accounts = {self._account(spec): spec for spec in specs}
+
+        def list_account(spec: DeploymentSpec)->Dict[str, Any]:
+            deployments = self._client(spec).deployments.list(resource_group_name=spec.resource_group,
+                                                              account_name=spec.account_name)
+            return {deployment.name: deployment for deployment in deployments}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            existing = dict(zip(accounts, executor.map(list_account, accounts.values())))
+
+        plan = []
+        for spec in specs:
+            deployments = existing[self._account(spec)]
+            deployment = deployments.get(spec.deployment_name)
+            if deployment is None:
+                same_model = [name for name, other in deployments.items() if spec.same_model(other)]
+                if same_model:
+                    plan.append((spec, REUSE, same_model[0]))
+                else:
+                    plan.append((spec, CREATE, spec.deployment_name))
+            elif not spec.matches(deployment):
+                plan.append((spec, UPDATE, spec.deployment_name))
+            else:
+                plan.append((spec, UNCHANGED, spec.deployment_name))
+        return plan
+
+    def apply(self, specs: List[DeploymentSpec], wait: bool = True,
+              timeout: float = DEFAULT_PROVISIONING_TIMEOUT)->List[Dict[str, Any]]:
+        """
+        Create or update the deployments that differ from their spec, all at once, and wait until they are ready
+
+        Args:
+            specs (List[DeploymentSpec]): The declared deployments
+            wait (bool): Wait for the operations to finish and for the deployments to answer
+            timeout (float): The seconds to wait for the operations and the readiness checks
+
+        Returns:
+            results (List[Dict[str, Any]]): For every spec, in order, the account, the name of the deployment serving
+                                            the spec, to use as deployment_id, the action, the status ("succeeded",
+                                            "failed", "pending" or the provisioning state) and the error of a failed
+                                            deployment
+        """
+        plan = self.plan(specs)
+        results = [{"account": spec.account_name, "deployment": name, "action": action,
+                    "status": "pending" if action in (CREATE, UPDATE) else "succeeded", "error": None}
+                   for spec, action, name in plan]
+        changed = [position for position, (_, action, _) in enumerate(plan) if action in (CREATE, UPDATE)]
+
+        def begin(spec: DeploymentSpec)->Any:
+            return self._client(spec).deployments.begin_create_or_update(
+                resource_group_name=spec.resource_group,
+                account_name=spec.account_name,
+                deployment_name=spec.deployment_name,
+                deployment=spec.body())
+
+        pollers = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {position: executor.submit(begin, plan[position][0]) for position in changed}
+            for position, future in futures.items():
+                try:
+                    pollers[position] = future.result()
+                except Exception as exception:
+                    results[position].update(status="failed", error=f"{type(exception).__name__}: {exception}")
+        if not wait:
+            return results
+
+        # Poll the long-running operations together instead of blocking on each in turn
+        deadline = time.monotonic() + timeout
+        while pollers and time.monotonic() < deadline:
+            for position in [position for position, poller in pollers.items() if poller.done()]:
+                poller = pollers.pop(position)
+                try:
+                    deployment = poller.result()
+                except Exception as exception:
+                    results[position].update(status="failed", error=f"{type(exception).__name__}: {exception}")
+                else:
+                    results[position]["status"] = str(deployment.properties.provisioning_state).lower()
+            if pollers:
+                time.sleep(self.poll_interval)
+
+        ready = [position for position, (spec, _, _) in enumerate(plan)
+                 if spec.openai_instance is not None and results[position]["status"] == "succeeded"]
+        self._wait_ready([plan[position][0] for position in ready],
+                         [results[position] for position in ready], deadline)
+        return results
+
+    def _wait_ready(self, specs: List[DeploymentSpec], results: List[Dict[str, Any]], deadline: float)->None:
+        """
+        Check the deployments with deployment_retrieve until they all answer with status succeeded. The error of the
+        last check is kept in the result of a deployment that does not answer yet.
+        """
+        def status(item: Tuple[DeploymentSpec, Dict[str, Any]])->Tuple[str, Optional[str]]:
+            spec, result = item
+            try:
+                _, _, model_status = deployment_retrieve(spec.openai_instance, result["deployment"])
+                return model_status, None
+            except openai.error.InvalidRequestError:
+                # The data plane may not know the deployment yet
+                return "notfound", None
+            except openai.error.OpenAIError as exception:
+                # A throttled or failing check is tried again at the next poll
+                return "pending", f"{type(exception).__name__}: {exception}"
+
+        waiting = list(zip(specs, results))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while waiting:
+                statuses = list(executor.map(status, waiting))
+                for (_, result), (model_status, error) in zip(waiting, statuses):
+                    result.update(status=model_status, error=error)
+                waiting = [item for item, (model_status, _) in zip(waiting, statuses) if model_status != "succeeded"]
+                if not waiting or time.monotonic() >= deadline:
+                    return
+                time.sleep(self.poll_interval)
+
+
+def deployment_model_with_custom_name(credential: AzureCliCredential, subscription_id: str,cog_rg: str, openai_instance_name: str, deployment_name: str, model: str, model_version: str,
+                                      sku_name: str = "Standard", capacity: int = 1)->str:
     """
     This function deploys a specified base Azure OpenAI model to the Azure OpenAI instance with a custom deployment name.
-            
-    Args: 
+
+    Args:
         credential (AzureCliCredential): Azure authentication credentials to use
         subscription_id (str): Azure subscription id the Azure OpenAI instance resides
         cog_rg (str): The Cognitive Services Resource Group the Azure OpenAI instance resides
@@ -17,35 +287,23 @@ def deployment_model_with_custom_name(credential: AzureCliCredential, subscripti
         deployment_name (str): The custom name the deployment should use
         model (str): The Azure OpenAI base model to deploy
         model_version (str): The Azure OpenAI base model version to deploy
+        sku_name (str): The SKU of the deployment
+        capacity (int): The capacity of the deployment
 
-    Returns: 
+    Returns:
         deployment_id (str): The deployment id to use to interact with the model. Note, deployment_id should be the same as
                             the specified deployment_name
-    """    
-    
-    client = CognitiveServicesManagementClient(credential=credential, subscription_id=subscription_id)
+    """
+
+    client = management_client(credential, subscription_id)
+    spec = DeploymentSpec(cog_rg, openai_instance_name, deployment_name, model, model_version, sku_name, capacity)
 
     deployment = client.deployments.begin_create_or_update(
         resource_group_name=cog_rg,
         account_name=openai_instance_name,
         deployment_name=deployment_name,
         content_type = 'application/json',
-        deployment={
-            "properties": {
-            "model": {
-                "format": "OpenAI",
-                "name": model,
-                "version": model_version
-            },
-            "scaleSettings": {
-                "scaleType": "Standard",
-            }
-            },
-            "sku": {
-                "name": "Standard",
-                "capacity": 1
-            }
-        }
+        deployment=spec.body()
     )
     result = deployment.result()
     print("Deployment Sucessful:")
@@ -53,4 +311,3 @@ def deployment_model_with_custom_name(credential: AzureCliCredential, subscripti
     deployment_id = result.name
 
     return deployment_id
-
@@ -2,143 +2,734 @@
 # The retry logic is used to handle the following errors: RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout
 # The list of errors could be revised based on the errors encountered in production. Certain errors are excluded from retry logic as the outcome of the retry would be the same, for example access denied errors.
 # Script covers completions, chat completions, embeddings and deployments.
+# The openai_instance of a wrapper is the openai module, an AzureOpenAIClient from utils/openai_client.py carrying its own
+# endpoint configuration, or a DeploymentRouter from utils/openai_router.py.
+# Every wrapper call is measured for the hooks registered in utils/metrics.py: latency by phase, retries and tokens.
 
 # import the required libraries
-from retry import retry
-from typing import Union, List, Any
+import contextvars
+import time
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Union, List, Any, Callable, Iterable, Iterator, Optional, Tuple
 import openai
 
-# Error codes handled by the retry logic
-from openai.error import RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout
- 
-# Default parameters for the retry logic
+# NumPy output of the embeddings
+from utils.embedding_arrays import ARRAY_ENCODING_FORMAT, EmbeddingStore, decode_embedding, embeddings_matrix
 
-# The number of times to retry the API call
-DEFAULT_TRIES = 4
+# Load balancing over several deployments
+from utils.openai_router import DeploymentRouter
 
-# The delay between retries
-DEFAULT_DELAY = 2  # seconds
+# Response caching
+from utils.response_cache import ResponseCache, cache_key
 
-# The backoff factor to increase the delay between retries
-DEFAULT_BACKOFF = 2
+# Streaming
+from utils.openai_stream import CompletionStream, chat_delta, completion_delta, hold_until_stream_end, on_stream_end
 
-# The maximum delay between retries
-DEFAULT_MAX_DELAY = 20  # seconds
- 
-# OpenAI Completions wrapper
-@retry(
-        exceptions=(RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout),
-        tries=DEFAULT_TRIES,
-        delay=DEFAULT_DELAY,
-        jitter=(0, 2),
-        backoff=DEFAULT_BACKOFF,
-        max_delay=DEFAULT_MAX_DELAY,
- 
+# Instrumentation
+from utils.metrics import instrumented, record_attempt, record_cache
+
+# Request coalescing
+from utils.single_flight import coalesced
+
+# Prompt budgeting
+from utils.prompt_budget import PromptBudget
+
+# Hedged requests
+from utils.hedging import HedgingPolicy
+
+# Deployment metadata cache
+from utils.deployment_cache import DeploymentCache, DeploymentInfo, endpoint_of, invalidate_deployment, \
+    is_deployment_not_found
+
+# Adaptive concurrency control
+from utils.adaptive_concurrency import AdaptiveConcurrencyLimiter
+
+# Azure AD tokens
+from utils.token_provider import AzureADTokenProvider
+
+# Client side rate limiting
+from utils.rate_limiter import (
+    DEFAULT_COMPLETION_TOKENS,
+    RateLimiter,
+    estimate_chat_prompt_tokens,
+    estimate_tokens,
+    usage_tokens,
 )
-def get_completion(openai_instance: openai, deployment_id: str, prompt_text: str, **kwargs: Any)->str:
+
+# Retry policy, error codes handled by the retry logic and its default parameters
+from utils.retry_policy import (
+    DEFAULT_BACKOFF,
+    DEFAULT_DELAY,
+    DEFAULT_MAX_DELAY,
+    DEFAULT_TRIES,
+    RETRYABLE_ERRORS,
+    RetryPolicy,
+    retry_with_policy,
+)
+
+# Retry policy of each wrapper. A policy can be tuned here for all calls of a wrapper,
+# or replaced for a single call with the retry_policy keyword argument.
+# The wrappers served from the response cache retry the request only, so that a call looks the cache up once.
+COMPLETION_RETRY_POLICY = RetryPolicy()
+CHATCOMPLETION_RETRY_POLICY = RetryPolicy()
+EMBEDDING_RETRY_POLICY = RetryPolicy()
+DEPLOYMENT_RETRY_POLICY = RetryPolicy()
+
+# Default parameters for batched embeddings
+
+# The maximum number of inputs sent in one Embedding.create request
+DEFAULT_EMBEDDING_BATCH_SIZE = 16
+
+# The maximum number of estimated tokens sent in one Embedding.create request
+DEFAULT_EMBEDDING_BATCH_TOKENS = 100000
+
+# The number of embedding requests sent concurrently
+DEFAULT_EMBEDDING_WORKERS = 4
+
+# Request dispatch shared by the wrappers
+def _send(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, request: Callable[..., Any],
+          rate_limiter: Optional[RateLimiter] = None, estimated_tokens: int = 0, tried: Optional[List] = None,
+          concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->Any:
+    """
+    Send one request attempt, through the router when openai_instance is a DeploymentRouter
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance or the router to use
+        deployment_id (str): The deployment id to use, ignored with a router which picks the deployment
+        request (Callable[..., Any]): Sends the request, called with the openai instance, the deployment id and the
+                                      connection options of the backend as keyword arguments
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        estimated_tokens (int): The estimated tokens of the request for the rate limiter
+        tried (Optional[List]): The router backends already used by this call, the request goes to another one
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): The adaptive limit of the requests in flight
+
+    Returns:
+        response (Any): The Azure OpenAI response
+    """
+    if isinstance(openai_instance, DeploymentRouter):
+        router_limiter = rate_limiter or openai_instance.rate_limiter
+        try:
+            return openai_instance.execute(
+                lambda backend: _send_to(backend.openai_instance, backend.deployment_id, request, router_limiter,
+                                         estimated_tokens, backend.name, backend.options(), concurrency_limiter,
+                                         backend.token_provider),
+                tried)
+        except Exception as exception:
+            if is_deployment_not_found(exception):
+                # The lookups through the router are cached under the router, not the backend that failed
+                invalidate_deployment(endpoint_of(openai_instance), deployment_id)
+            raise
+
+    return _send_to(openai_instance, deployment_id, request, rate_limiter, estimated_tokens, deployment_id, {},
+                    concurrency_limiter)
+
+def _can_hedge(openai_instance: Union[openai, DeploymentRouter], tried: List)->bool:
+    """Tell whether a duplicate request has somewhere to go: another backend in rotation, or the same deployment"""
+    if isinstance(openai_instance, DeploymentRouter):
+        return any(backend not in tried for backend in openai_instance.healthy_backends())
+    return True
+
+def _send_hedged(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, request: Callable[..., Any],
+                 rate_limiter: Optional[RateLimiter], estimated_tokens: int, hedging: HedgingPolicy,
+                 concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->Any:
+    """
+    Send one request attempt, and a duplicate request when no answer came back within the hedge delay of the policy
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance or the router to use
+        deployment_id (str): The deployment id to use, ignored with a router which picks the deployment
+        request (Callable[..., Any]): Sends the request, see _send
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the requests
+        estimated_tokens (int): The estimated tokens of each request for the rate limiter
+        hedging (HedgingPolicy): The hedge delay and budget
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): The adaptive limit of the requests in flight
+
+    Returns:
+        response (Any): The first successful Azure OpenAI response. The other request is abandoned.
+    """
+    delay = hedging.start()
+    tried: List = []
+
+    def attempt()->Any:
+        sent = time.perf_counter()
+        response = _send(openai_instance, deployment_id, request, rate_limiter, estimated_tokens, tried,
+                         concurrency_limiter)
+        hedging.record(time.perf_counter() - sent)
+        return response
+
+    # The requests run on the policy threads, each in a copy of the context of the call for its metrics record
+    primary = hedging.submit_request(contextvars.copy_context().run, attempt) if delay is not None else None
+    if primary is None:
+        # Not hedged yet, or every thread of the policy is busy
+        return attempt()
+
+    requests = {primary: False}
+    try:
+        done, _ = wait(requests, timeout=delay)
+        if not done and _can_hedge(openai_instance, tried):
+            duplicate = hedging.submit_hedge(contextvars.copy_context().run, attempt)
+            if duplicate is not None:
+                requests[duplicate] = True
+
+        pending, last_exception = set(requests), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    last_exception = future.exception()
+                    continue
+                if requests[future]:
+                    hedging.hedge_won()
+                return future.result()
+        raise last_exception
+    finally:
+        # A request not started yet is dropped, a running one is abandoned
+        for future in requests:
+            future.cancel()
+
+def _send_to(openai_instance: openai, deployment_id: str, request: Callable[..., Any],
+             rate_limiter: Optional[RateLimiter], estimated_tokens: int, limiter_key: str, options: dict,
+             concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+             token_provider: Optional[AzureADTokenProvider] = None)->Any:
+    """
+    Send one request attempt to a single deployment, waiting for rate limiter capacity and a concurrency permit first.
+    A request rejected with an AuthenticationError is sent once more with a new Azure AD token.
+
+    Args:
+        openai_instance (openai): The Azure OpenAI instance to use
+        deployment_id (str): The deployment id to use
+        request (Callable[..., Any]): Sends the request, see _send
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        estimated_tokens (int): The estimated tokens of the request for the rate limiter
+        limiter_key (str): The rate limiter key of the deployment
+        options (dict): The connection options of the deployment
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): The adaptive limit of the requests in flight
+        token_provider (Optional[AzureADTokenProvider]): The token provider of the api_key in options, by default the
+                                                         one of the client
+
+    Returns:
+        response (Any): The Azure OpenAI response
+    """
+    # Wait for RPM and TPM capacity
+    queued = time.perf_counter()
+    if rate_limiter is not None:
+        rate_limiter.acquire(limiter_key, estimated_tokens)
+    admitted = time.perf_counter()
+    endpoint = endpoint_of(openai_instance, options)
+    token_provider = token_provider or getattr(openai_instance, "token_provider", None)
+
+    def attempt()->Any:
+        sent = time.perf_counter()
+        try:
+            response = _request_with_token(request, openai_instance, deployment_id, options, token_provider)
+        except BaseException as exception:
+            record_attempt(limiter_key, admitted - queued, time.perf_counter() - sent, permit_time=sent - admitted)
+            if is_deployment_not_found(exception):
+                invalidate_deployment(endpoint, deployment_id)
+            raise
+        record_attempt(limiter_key, admitted - queued, time.perf_counter() - sent, response, sent - admitted)
+        return response
+
+    with ExitStack() as stack:
+        permit = None
+        if concurrency_limiter is not None:
+            # Wait for a permit of the adaptive concurrency limit of the deployment
+            permit = stack.enter_context(concurrency_limiter.permit((endpoint, deployment_id)))
+        response = attempt()
+        if permit is not None:
+            permit.responded()
+        # A stream holds its permit until it ends
+        hold_until_stream_end(response, stack)
+
+    if rate_limiter is not None:
+        _reconcile(rate_limiter, limiter_key, estimated_tokens, response)
+
+    return response
+
+def _reconcile(rate_limiter: RateLimiter, limiter_key: str, estimated_tokens: int, response: Any)->None:
+    """Replace the token estimate of a request with its usage, counted from the chunks once a stream ends"""
+    if not on_stream_end(response, lambda exception: rate_limiter.reconcile(limiter_key, estimated_tokens,
+                                                                           response.result.usage["total_tokens"])):
+        rate_limiter.reconcile(limiter_key, estimated_tokens, usage_tokens(response))
+
+def _request_with_token(request: Callable[..., Any], openai_instance: openai, deployment_id: str, options: dict,
+                        token_provider: Optional[AzureADTokenProvider])->Any:
+    """Send a request, and once more with a new token when the service rejected the cached one"""
+    try:
+        return request(openai_instance, deployment_id, **options)
+    except openai.error.AuthenticationError:
+        if token_provider is None:
+            raise
+    token_provider.invalidate()
+    if "api_key" in options:
+        # A router backend passes its token in the options, a client reads the new one itself
+        options = {**options, "api_key": token_provider.token()}
+    return request(openai_instance, deployment_id, **options)
+
+def _cache_endpoint(openai_instance: Union[openai, DeploymentRouter])->Any:
+    """Return the endpoint part of the cache key, the backends of a router or the api_base of an instance"""
+    if isinstance(openai_instance, DeploymentRouter):
+        return sorted(backend.name for backend in openai_instance.backends)
+    return endpoint_of(openai_instance)
+
+def _cache_lookup(cache: Optional[ResponseCache], openai_instance: Union[openai, DeploymentRouter], operation: str,
+                  deployment_id: str, payload: Any, **kwargs: Any)->Tuple[Optional[str], Optional[Any]]:
+    """
+    Look a request up in the response cache. It is called once per wrapper call, outside the retries of the request.
+
+    Args:
+        cache (Optional[ResponseCache]): The response cache, None when caching is off
+        openai_instance (openai | DeploymentRouter): The instance the request goes to, part of the cache key
+        operation (str): The wrapper operation, part of the cache key
+        deployment_id (str): The deployment id, part of the cache key
+        payload (Any): The prompt, messages or input of the request
+        **kwargs (Any): The generation parameters of the request
+
+    Returns:
+        key (Optional[str]): The cache key to store the response under, None when the request bypasses the cache
+        response (Optional[Any]): The cached response, None on a miss
+    """
+    if cache is None:
+        return None, None
+    # Embeddings are deterministic, completions depend on their sampling parameters
+    if operation != "embedding" and not cache.is_cacheable(**kwargs):
+        cache.bypass()
+        record_cache("bypass", deployment_id)
+        return None, None
+    key = cache_key(operation, deployment_id, payload, endpoint=_cache_endpoint(openai_instance), **kwargs)
+    cached = cache.get(key)
+    record_cache("hit" if cached is not None else "miss", deployment_id)
+    return key, cached
+
+# OpenAI Completions wrapper
+@instrumented("completion")
+@coalesced("completion")
+def get_completion(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, prompt_text: str,
+                   rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                   prompt_budget: Optional[PromptBudget] = None,
+                   concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                   retry_policy: Optional[RetryPolicy] = None,
+                   **kwargs: Any)->Union[str, CompletionStream]:
     """
     Completion method for model tuned for text interactions
         
     Args: 
-        openai_instance (openai): The Azure OpenAI instance to use
-        deployment_id (str): The base model deployment id to use
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
         prompt_text (str): The text with instructions and/or examples to present to the model
-        **kwargs (Any): Azure OpenAI parameters specified for the completion
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving deterministic requests
+        prompt_budget (Optional[PromptBudget]): Counts the prompt with the tokenizer of the model and fits it into the
+                                                context window of the deployment before it is sent
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+        single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+        **kwargs (Any): Azure OpenAI parameters specified for the completion. With stream=True the text is streamed
  
     Returns: 
-        completion_text (str): The returned text from Azure OpenAI
+        completion_text (str): The returned text from Azure OpenAI, or with stream=True a CompletionStream yielding the
+                               text deltas, whose result holds the full text, finish reason and usage once consumed
     """
+    # Serve deterministic requests from the cache
+    key, cached = _cache_lookup(cache, openai_instance, "completion", deployment_id, prompt_text, **kwargs)
+    if cached is not None:
+        return cached
+
+    # Fit the prompt into the context window, its count is charged to the rate limiter
+    prompt_tokens = estimate_tokens(prompt_text)
+    if prompt_budget is not None:
+        prompt_text, prompt_tokens = prompt_budget.fit_prompt(deployment_id, prompt_text, **kwargs)
 
     # Call OpenAI Completion API
-    response = openai_instance.Completion.create(
-            engine=deployment_id,
+    estimated_tokens = prompt_tokens + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+    def create(api: openai, engine: str, **options: Any)->Any:
+        response = api.Completion.create(
+            engine=engine,
             prompt=prompt_text,
+            **options,
             **kwargs)
+        if kwargs.get("stream"):
+            # Read the first chunk inside the retried call
+            return CompletionStream(response, completion_delta, prompt_tokens)
+        return response
+
+    response = (retry_policy or COMPLETION_RETRY_POLICY).call(_send, openai_instance, deployment_id, create,
+                                                              rate_limiter, estimated_tokens,
+                                                              concurrency_limiter=concurrency_limiter)
+    if kwargs.get("stream"):
+        return response
+    completion_text = response.choices[0].text
+
+    if key is not None:
+        cache.set(key, completion_text)
         
-    return response.choices[0].text
+    return completion_text
  
 # OpenAI ChatCompletions wrapper
-@retry(
-        exceptions=(RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout),
-        tries=DEFAULT_TRIES,
-        delay=DEFAULT_DELAY,
-        jitter=(0, 2),
-        backoff=DEFAULT_BACKOFF,
-        max_delay=DEFAULT_MAX_DELAY,
- 
-)
-def get_chatcompletion(openai_instance: openai, deployment_id: str, message_text: List, **kwargs: Any)->str:
+@instrumented("chatcompletion")
+@coalesced("chatcompletion")
+def get_chatcompletion(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, message_text: List,
+                       rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                       prompt_budget: Optional[PromptBudget] = None,
+                       hedging: Optional[HedgingPolicy] = None,
+                       concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                       retry_policy: Optional[RetryPolicy] = None,
+                       **kwargs: Any)->Union[str, CompletionStream]:
     """
     ChatCompletion method for model tuned for chat interactions. 
         
     Args: 
-        openai_instance (openai): The Azure OpenAI instance to use
-        deployment_id (str): The base model deployment id to use
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
         message_text (List): The text with the roles, instructions and/or examples to present to the model
-        **kwargs (Any): Azure OpenAI parameters specified for the ChatCompletion
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving deterministic requests
+        prompt_budget (Optional[PromptBudget]): Counts the prompt with the tokenizer of the model and fits it into the
+                                                context window of the deployment before it is sent
+        hedging (Optional[HedgingPolicy]): Sends a duplicate request, to another deployment with a router, when no
+                                           answer came back within the hedge delay of the policy. Off with stream=True
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+        single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+        **kwargs (Any): Azure OpenAI parameters specified for the ChatCompletion. With stream=True the text is streamed
  
     Returns: 
-        completion_text (str): The returned text from Azure OpenAI
+        completion_text (str): The returned text from Azure OpenAI, or with stream=True a CompletionStream yielding the
+                               text deltas, whose result holds the full text, finish reason and usage once consumed
     """
+    # Serve deterministic requests from the cache
+    key, cached = _cache_lookup(cache, openai_instance, "chatcompletion", deployment_id, message_text, **kwargs)
+    if cached is not None:
+        return cached
+
+    # Fit the messages into the context window, their count is charged to the rate limiter
+    prompt_tokens = estimate_chat_prompt_tokens(message_text)
+    if prompt_budget is not None:
+        message_text, prompt_tokens = prompt_budget.fit_messages(deployment_id, message_text, **kwargs)
+
     # Call OpenAI ChatCompletion API
-    response = openai_instance.ChatCompletion.create(
-            engine=deployment_id,
+    estimated_tokens = prompt_tokens + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+    def create(api: openai, engine: str, **options: Any)->Any:
+        response = api.ChatCompletion.create(
+            engine=engine,
             messages=message_text,
+            **options,
             **kwargs
             )
+        if kwargs.get("stream"):
+            # Read the first chunk inside the retried call
+            return CompletionStream(response, chat_delta, prompt_tokens)
+        return response
+
+    policy = retry_policy or CHATCOMPLETION_RETRY_POLICY
+    if hedging is not None and not kwargs.get("stream"):
+        response = policy.call(_send_hedged, openai_instance, deployment_id, create, rate_limiter, estimated_tokens,
+                               hedging, concurrency_limiter)
+    else:
+        response = policy.call(_send, openai_instance, deployment_id, create, rate_limiter, estimated_tokens,
+                               concurrency_limiter=concurrency_limiter)
+    if kwargs.get("stream"):
+        return response
+    completion_text = response.choices[0].message["content"]
+
+    if key is not None:
+        cache.set(key, completion_text)
  
-    return response.choices[0].message["content"]
+    return completion_text
     
 # Embeddings
-@retry(
-        exceptions=(RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout),
-        tries=DEFAULT_TRIES,
-        delay=DEFAULT_DELAY,
-        jitter=(0, 2),
-        backoff=DEFAULT_BACKOFF,
-        max_delay=DEFAULT_MAX_DELAY,
- 
-)
-def get_embedding(openai_instance: openai, deployment_id: str, input_text: str)->List:
+@instrumented("embedding")
+@coalesced("embedding")
+def get_embedding(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_text: str,
+                  rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                  as_array: bool = False, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                  retry_policy: Optional[RetryPolicy] = None, dispatcher: Optional[Any] = None)->List:
     """
     OpenAI embedding method wrapper with retries
         
     Args: 
-        openai_instance (openai): The Azure OpenAI instance to use
-        deployment_id (str): The base model deployment id to use
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
         input_text (str): The text to be presented to the model for the model to generate embedding
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs
+        as_array (bool): Request the base64 encoding and return a float32 NumPy array, needs numpy
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+        dispatcher (Optional[EmbeddingDispatcher]): Merges the text with the concurrent calls given the same
+                                                    dispatcher into one multi-input request
+        single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
  
     Returns: 
-        embedding (List): The returned embedding from Azure OpenAI
+        embedding (List): The returned embedding from Azure OpenAI, a float32 np.ndarray with as_array
     """
-    response = openai_instance.Embedding.create(deployment_id=deployment_id,
-                                     input=input_text)
+    if dispatcher is not None:
+        # The batch request of the dispatcher serves the cache and runs the retries
+        return dispatcher.submit(openai_instance, deployment_id, input_text, rate_limiter, cache, as_array,
+                                 concurrency_limiter, retry_policy).result()
+
+    # The base64 embeddings are cached apart from the lists of floats
+    encoding = {"encoding_format": ARRAY_ENCODING_FORMAT} if as_array else {}
+
+    # Serve repeated inputs from the cache
+    key, cached = _cache_lookup(cache, openai_instance, "embedding", deployment_id, input_text, **encoding)
+    if cached is not None:
+        return decode_embedding(cached) if as_array else cached
+
+    def create(api: openai, deployment: str, **options: Any)->Any:
+        return api.Embedding.create(deployment_id=deployment,
+                                    input=input_text,
+                                    **options,
+                                    **encoding)
+
+    response = (retry_policy or EMBEDDING_RETRY_POLICY).call(_send, openai_instance, deployment_id, create,
+                                                             rate_limiter, estimate_tokens(input_text),
+                                                             concurrency_limiter=concurrency_limiter)
+    embedding = response["data"][0]["embedding"]
+
+    if key is not None:
+        cache.set(key, embedding)
  
-    return response["data"][0]["embedding"]
+    return decode_embedding(embedding) if as_array else embedding
  
+# Embeddings - Batched inputs
+def _batch_inputs(input_texts: Iterable[str], batch_size: int, batch_tokens: int)->Iterator[Tuple[int, List[str]]]:
+    """
+    Split the input texts into request-sized batches, capped by item count and by estimated tokens
+
+    Args:
+        input_texts (Iterable[str]): The texts to split, consumed lazily
+        batch_size (int): The maximum number of inputs in a batch
+        batch_tokens (int): The maximum number of estimated tokens in a batch. A single text over the budget gets a batch of its own
+
+    Returns:
+        batches (Iterator[Tuple[int, List[str]]]): The position of the first text of each batch and the batch itself
+    """
+    batch, tokens, start = [], 0, 0
+    for position, text in enumerate(input_texts):
+        text_tokens = estimate_tokens(text)
+        if batch and (len(batch) >= batch_size or tokens + text_tokens > batch_tokens):
+            yield start, batch
+            batch, tokens, start = [], 0, position
+        batch.append(text)
+        tokens += text_tokens
+    if batch:
+        yield start, batch
+
+def _embeddings_in_order(response: Any)->List[List]:
+    """
+    Return the embeddings of a multi-input Embedding.create response in input order
+
+    Args:
+        response (Any): The Embedding.create response
+
+    Returns:
+        embeddings (List[List]): The embeddings sorted by their index
+    """
+    return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+def _place_batch(embeddings: List, start: int, batch_embeddings: List[List])->None:
+    """
+    Store the embeddings of a batch at their input positions, growing the result list as needed
+
+    Args:
+        embeddings (List): The result list
+        start (int): The position of the first input of the batch
+        batch_embeddings (List[List]): The embeddings of the batch
+    """
+    end = start + len(batch_embeddings)
+    if len(embeddings) < end:
+        embeddings.extend([None] * (end - len(embeddings)))
+    embeddings[start:end] = batch_embeddings
+
+@instrumented("embedding")
+def _get_embedding_batch(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_texts: List[str],
+                         rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                         encoding_format: Optional[str] = None,
+                         concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                         retry_policy: Optional[RetryPolicy] = None)->List[List]:
+    """
+    Embed one batch of inputs in a single request. The retries apply to this batch only.
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_texts (List[str]): The texts of the batch
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs, only the other inputs are sent
+        encoding_format (Optional[str]): The encoding requested from the service, "base64" returns the embeddings
+                                         as base64 strings
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the batch request
+
+    Returns:
+        embeddings (List[List]): The returned embeddings in input order
+    """
+    encoding = {"encoding_format": encoding_format} if encoding_format else {}
+
+    # Serve repeated inputs from the cache
+    lookups = [_cache_lookup(cache, openai_instance, "embedding", deployment_id, text, **encoding)
+               for text in input_texts]
+    embeddings = [cached for _, cached in lookups]
+    missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+    missing_texts = [input_texts[position] for position in missing]
+
+    def create(api: openai, deployment: str, **options: Any)->Any:
+        return api.Embedding.create(deployment_id=deployment,
+                                    input=missing_texts,
+                                    **options,
+                                    **encoding)
+
+    response = (retry_policy or EMBEDDING_RETRY_POLICY).call(_send, openai_instance, deployment_id, create,
+                                                             rate_limiter,
+                                                             sum(estimate_tokens(text) for text in missing_texts),
+                                                             concurrency_limiter=concurrency_limiter)
+
+    for position, embedding in zip(missing, _embeddings_in_order(response)):
+        embeddings[position] = embedding
+        key = lookups[position][0]
+        if key is not None:
+            cache.set(key, embedding)
+
+    return embeddings
+
+def get_embeddings(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_texts: Iterable[str],
+                   batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE, batch_tokens: int = DEFAULT_EMBEDDING_BATCH_TOKENS,
+                   max_workers: int = DEFAULT_EMBEDDING_WORKERS, rate_limiter: Optional[RateLimiter] = None,
+                   retry_policy: Optional[RetryPolicy] = None, cache: Optional[ResponseCache] = None,
+                   as_array: bool = False,
+                   concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->List[List]:
+    """
+    OpenAI embedding method wrapper for many inputs. The inputs are packed into multi-input requests which are
+    sent concurrently and retried independently, so a failed batch never resends the batches that succeeded.
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_texts (Iterable[str]): The texts to generate embeddings for, consumed lazily
+        batch_size (int): The maximum number of inputs per request
+        batch_tokens (int): The maximum number of estimated tokens per request
+        max_workers (int): The maximum number of requests in flight at once
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits every request
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of every batch request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs
+        as_array (bool): Request the base64 encoding and return one contiguous float32 matrix, needs numpy
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment,
+                                                                    max_workers still caps them
+
+    Returns:
+        embeddings (List[List]): The returned embeddings in the same order as the input texts, a (inputs, dimensions)
+                                 float32 np.ndarray with as_array
+    """
+    encoding_format = ARRAY_ENCODING_FORMAT if as_array else None
+    embeddings = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for start, batch in _batch_inputs(input_texts, batch_size, batch_tokens):
+            if len(pending) >= max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _place_batch(embeddings, pending.pop(future), future.result())
+            future = executor.submit(_get_embedding_batch, openai_instance, deployment_id, batch, rate_limiter, cache,
+                                     encoding_format, concurrency_limiter, retry_policy=retry_policy)
+            pending[future] = start
+
+        for future in wait(pending).done:
+            _place_batch(embeddings, pending[future], future.result())
+
+    return embeddings_matrix(embeddings) if as_array else embeddings
+
+def store_embeddings(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_texts: Iterable[str],
+                     store: EmbeddingStore, batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+                     batch_tokens: int = DEFAULT_EMBEDDING_BATCH_TOKENS, max_workers: int = DEFAULT_EMBEDDING_WORKERS,
+                     rate_limiter: Optional[RateLimiter] = None, retry_policy: Optional[RetryPolicy] = None,
+                     cache: Optional[ResponseCache] = None,
+                     concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->int:
+    """
+    OpenAI embedding method wrapper for many inputs that appends the embeddings to an EmbeddingStore in input order as
+    the batches finish, so only the batches in flight are held in memory. The inputs already in the store are
+    skipped, which resumes an interrupted run over the same inputs.
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_texts (Iterable[str]): The texts to generate embeddings for, consumed lazily
+        store (EmbeddingStore): The .npy store the embeddings are appended to
+        batch_size (int): The maximum number of inputs per request
+        batch_tokens (int): The maximum number of estimated tokens per request
+        max_workers (int): The maximum number of requests in flight at once
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits every request
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of every batch request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment,
+                                                                    max_workers still caps them
+
+    Returns:
+        rows (int): The number of embeddings appended by this call
+    """
+    skip = len(store)
+    remaining_texts = (text for position, text in enumerate(input_texts) if position >= skip)
+    finished, next_start, appended = {}, 0, 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for start, batch in _batch_inputs(remaining_texts, batch_size, batch_tokens):
+            # Batches that finished ahead of an earlier one wait for it, which also bounds the window
+            while len(pending) + len(finished) >= max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished[pending.pop(future)] = future.result()
+                while next_start in finished:
+                    embeddings = finished.pop(next_start)
+                    store.append(embeddings)
+                    next_start += len(embeddings)
+                    appended += len(embeddings)
+            future = executor.submit(_get_embedding_batch, openai_instance, deployment_id, batch, rate_limiter, cache,
+                                     ARRAY_ENCODING_FORMAT, concurrency_limiter, retry_policy=retry_policy)
+            pending[future] = start
+
+        wait(pending)
+        # Append in input order up to the first failed batch, so a rerun resumes after it
+        in_flight = {start: future for future, start in pending.items()}
+        for start in sorted(finished.keys() | in_flight.keys()):
+            embeddings = finished[start] if start in finished else in_flight[start].result()
+            store.append(embeddings)
+            appended += len(embeddings)
+
+    return appended
+
 # Deployments - Retrieve deployment
-@retry(
-        exceptions=(RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout),
-        tries=DEFAULT_TRIES,
-        delay=DEFAULT_DELAY,
-        jitter=(0, 2),
-        backoff=DEFAULT_BACKOFF,
-        max_delay=DEFAULT_MAX_DELAY,
- 
-)
-def deployment_retrieve(openai_instance: openai, deployment_id: str)->Union[str, str, str]:
+@instrumented("deployment")
+@retry_with_policy(DEPLOYMENT_RETRY_POLICY)
+def deployment_retrieve(openai_instance: Union[openai, DeploymentRouter], deployment_id: str,
+                        cache: Optional[DeploymentCache] = None)->Union[str, str, str]:
     """
     OpenAI Deployment.retrieve method wrapper with retries
         
     Args: 
-        openai_instance (openai): The Azure OpenAI instance to use
-        deployment_id (str): The deployment id of the model to retrieve
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The deployment id of the model to retrieve, ignored with a router
+        cache (Optional[DeploymentCache]): Answers from memory while the deployment is cached, None to always ask the service
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
         
     Returns: 
         deployment_id (str): The retrieved model deployment id
         model_name (str): The retrieved model name
         model_status (str): The retrieved model status. This is used to determine if the model is in a state so that it can be used.
     """
-    model = openai_instance.Deployment.retrieve(deployment_id)
+    def retrieve(api: openai, deployment: str, **options: Any)->Any:
+        return api.Deployment.retrieve(deployment, **options)
+
+    if cache is not None:
+        info = cache.lookup(openai_instance, deployment_id,
+                            lambda: DeploymentInfo.from_response(_send(openai_instance, deployment_id, retrieve)))
+        return info.deployment_id, info.name, info.status
+
+    model = _send(openai_instance, deployment_id, retrieve)
     
     return model.id, model.name, model.status
\ No newline at end of file
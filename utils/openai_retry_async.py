@@ -0,0 +1,654 @@
+# This Script contains the asyncio counterparts of the wrapper functions in utils/openai_retry.py.
+# The wrappers use the openai acreate/aretrieve methods and wait between retries with asyncio.sleep, so a single event loop
+# can keep many requests in flight while others are waiting on a backoff.
+# The gather_* helpers fan a list of inputs out over the async wrappers with a fixed number of workers pulling the
+# inputs, so only max_concurrency requests exist at a time, however long the list.
+
+# import the required libraries
+import asyncio
+import time
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Union
+import openai
+
+# Default parameters and retry policies shared with the synchronous wrappers
+from utils.openai_retry import (
+    CHATCOMPLETION_RETRY_POLICY,
+    COMPLETION_RETRY_POLICY,
+    DEFAULT_EMBEDDING_BATCH_SIZE,
+    DEFAULT_EMBEDDING_BATCH_TOKENS,
+    DEPLOYMENT_RETRY_POLICY,
+    EMBEDDING_RETRY_POLICY,
+    _batch_inputs,
+    _cache_lookup,
+    _can_hedge,
+    _embeddings_in_order,
+    _reconcile,
+)
+from utils.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from utils.deployment_cache import DeploymentCache, DeploymentInfo, endpoint_of, invalidate_deployment, \
+    is_deployment_not_found
+from utils.embedding_arrays import ARRAY_ENCODING_FORMAT, decode_embedding, embeddings_matrix
+from utils.hedging import HedgingPolicy
+from utils.metrics import instrumented, record_attempt
+from utils.openai_router import DeploymentRouter
+from utils.openai_stream import AsyncCompletionStream, chat_delta, completion_delta, hold_until_stream_end
+from utils.prompt_budget import PromptBudget
+from utils.response_cache import ResponseCache
+from utils.single_flight import coalesced
+from utils.token_provider import AzureADTokenProvider
+from utils.retry_policy import RetryPolicy, retry_with_policy
+from utils.rate_limiter import (
+    DEFAULT_COMPLETION_TOKENS,
+    RateLimiter,
+    estimate_chat_prompt_tokens,
+    estimate_tokens,
+)
+
+# The maximum number of requests the gather_* helpers keep in flight at once
+DEFAULT_MAX_CONCURRENCY = 100
+
+
+# Request dispatch shared by the wrappers
+async def _asend(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, request: Callable[..., Awaitable],
+                 rate_limiter: Optional[RateLimiter] = None, estimated_tokens: int = 0,
+                 tried: Optional[List] = None,
+                 concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->Any:
+    """
+    Async send one request attempt, through the router when openai_instance is a DeploymentRouter
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance or the router to use
+        deployment_id (str): The deployment id to use, ignored with a router which picks the deployment
+        request (Callable[..., Awaitable]): Sends the request, called with the openai instance, the deployment id and
+                                            the connection options of the backend as keyword arguments
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        estimated_tokens (int): The estimated tokens of the request for the rate limiter
+        tried (Optional[List]): The router backends already used by this call, the request goes to another one
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): The adaptive limit of the requests in flight
+
+    Returns:
+        response (Any): The Azure OpenAI response
+    """
+    if isinstance(openai_instance, DeploymentRouter):
+        router_limiter = rate_limiter or openai_instance.rate_limiter
+        try:
+            return await openai_instance.aexecute(
+                lambda backend: _asend_backend(backend, request, router_limiter, estimated_tokens,
+                                               concurrency_limiter),
+                tried)
+        except Exception as exception:
+            if is_deployment_not_found(exception):
+                # The lookups through the router are cached under the router, not the backend that failed
+                invalidate_deployment(endpoint_of(openai_instance), deployment_id)
+            raise
+
+    return await _asend_to(openai_instance, deployment_id, request, rate_limiter, estimated_tokens, deployment_id, {},
+                           concurrency_limiter)
+
+async def _asend_backend(backend: Any, request: Callable[..., Awaitable], rate_limiter: Optional[RateLimiter],
+                         estimated_tokens: int, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter])->Any:
+    """Async send one request attempt to a router backend, reading its token without blocking the event loop"""
+    return await _asend_to(backend.openai_instance, backend.deployment_id, request, rate_limiter, estimated_tokens,
+                           backend.name, await backend.aoptions(), concurrency_limiter, backend.token_provider)
+
+async def _asend_hedged(openai_instance: Union[openai, DeploymentRouter], deployment_id: str,
+                        request: Callable[..., Awaitable], rate_limiter: Optional[RateLimiter], estimated_tokens: int,
+                        hedging: HedgingPolicy, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->Any:
+    """
+    Async send one request attempt, and a duplicate request when no answer came back within the hedge delay of the
+    policy
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance or the router to use
+        deployment_id (str): The deployment id to use, ignored with a router which picks the deployment
+        request (Callable[..., Awaitable]): Sends the request, see _asend
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the requests
+        estimated_tokens (int): The estimated tokens of each request for the rate limiter
+        hedging (HedgingPolicy): The hedge delay and budget
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): The adaptive limit of the requests in flight
+
+    Returns:
+        response (Any): The first successful Azure OpenAI response. The other request is cancelled.
+    """
+    delay = hedging.start()
+    tried: List = []
+
+    async def attempt()->Any:
+        sent = time.perf_counter()
+        response = await _asend(openai_instance, deployment_id, request, rate_limiter, estimated_tokens, tried,
+                                concurrency_limiter)
+        hedging.record(time.perf_counter() - sent)
+        return response
+
+    requests = {asyncio.ensure_future(attempt()): False}
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(requests, timeout=delay)
+            if not done and _can_hedge(openai_instance, tried) and hedging.try_hedge():
+                requests[asyncio.ensure_future(attempt())] = True
+
+        pending, last_exception = set(requests), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    last_exception = task.exception()
+                    continue
+                if requests[task]:
+                    hedging.hedge_won()
+                return task.result()
+        raise last_exception
+    finally:
+        # Cancel the slower request, or both when the call itself is cancelled
+        for task in requests:
+            if not task.done():
+                task.cancel()
+
+async def _asend_to(openai_instance: openai, deployment_id: str, request: Callable[..., Awaitable],
+                    rate_limiter: Optional[RateLimiter], estimated_tokens: int, limiter_key: str, options: dict,
+                    concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                    token_provider: Optional[AzureADTokenProvider] = None)->Any:
+    """
+    Async send one request attempt to a single deployment, waiting for rate limiter capacity and a concurrency permit
+    first. A request rejected with an AuthenticationError is sent once more with a new Azure AD token.
+
+    Args:
+        openai_instance (openai): The Azure OpenAI instance to use
+        deployment_id (str): The deployment id to use
+        request (Callable[..., Awaitable]): Sends the request, see _asend
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        estimated_tokens (int): The estimated tokens of the request for the rate limiter
+        limiter_key (str): The rate limiter key of the deployment
+        options (dict): The connection options of the deployment
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): The adaptive limit of the requests in flight
+        token_provider (Optional[AzureADTokenProvider]): The token provider of the api_key in options, by default the
+                                                         one of the client
+
+    Returns:
+        response (Any): The Azure OpenAI response
+    """
+    # Wait for RPM and TPM capacity
+    queued = time.perf_counter()
+    if rate_limiter is not None:
+        await rate_limiter.acquire_async(limiter_key, estimated_tokens)
+    admitted = time.perf_counter()
+    endpoint = endpoint_of(openai_instance, options)
+    token_provider = token_provider or getattr(openai_instance, "token_provider", None)
+
+    async def attempt()->Any:
+        sent = time.perf_counter()
+        try:
+            response = await _arequest_with_token(request, openai_instance, deployment_id, options, token_provider)
+        except BaseException as exception:
+            record_attempt(limiter_key, admitted - queued, time.perf_counter() - sent, permit_time=sent - admitted)
+            if is_deployment_not_found(exception):
+                invalidate_deployment(endpoint, deployment_id)
+            raise
+        record_attempt(limiter_key, admitted - queued, time.perf_counter() - sent, response, sent - admitted)
+        return response
+
+    async with AsyncExitStack() as stack:
+        permit = None
+        if concurrency_limiter is not None:
+            # Wait for a permit of the adaptive concurrency limit of the deployment
+            permit = await stack.enter_async_context(concurrency_limiter.apermit((endpoint, deployment_id)))
+        response = await attempt()
+        if permit is not None:
+            permit.responded()
+        # A stream holds its permit until it ends
+        hold_until_stream_end(response, stack)
+
+    if rate_limiter is not None:
+        _reconcile(rate_limiter, limiter_key, estimated_tokens, response)
+
+    return response
+
+async def _arequest_with_token(request: Callable[..., Awaitable], openai_instance: openai, deployment_id: str,
+                               options: dict, token_provider: Optional[AzureADTokenProvider])->Any:
+    """Async send a request, and once more with a new token when the service rejected the cached one"""
+    try:
+        return await request(openai_instance, deployment_id, **options)
+    except openai.error.AuthenticationError:
+        if token_provider is None:
+            raise
+    token_provider.invalidate()
+    if "api_key" in options:
+        # A router backend passes its token in the options, a client reads the new one itself
+        options = {**options, "api_key": await token_provider.atoken()}
+    return await request(openai_instance, deployment_id, **options)
+
+# OpenAI Completions wrapper
+@instrumented("completion")
+@coalesced("completion")
+async def aget_completion(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, prompt_text: str,
+                          rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                          prompt_budget: Optional[PromptBudget] = None,
+                          concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                          retry_policy: Optional[RetryPolicy] = None,
+                          **kwargs: Any)->Union[str, AsyncCompletionStream]:
+    """
+    Async completion method for model tuned for text interactions
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        prompt_text (str): The text with instructions and/or examples to present to the model
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving deterministic requests
+        prompt_budget (Optional[PromptBudget]): Counts the prompt with the tokenizer of the model and fits it into the
+                                                context window of the deployment before it is sent
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+        single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+        **kwargs (Any): Azure OpenAI parameters specified for the completion. With stream=True the text is streamed
+
+    Returns:
+        completion_text (str): The returned text from Azure OpenAI, or with stream=True an AsyncCompletionStream yielding the
+                               text deltas, whose result holds the full text, finish reason and usage once consumed
+    """
+    # Serve deterministic requests from the cache
+    key, cached = _cache_lookup(cache, openai_instance, "completion", deployment_id, prompt_text, **kwargs)
+    if cached is not None:
+        return cached
+
+    # Fit the prompt into the context window, its count is charged to the rate limiter
+    prompt_tokens = estimate_tokens(prompt_text)
+    if prompt_budget is not None:
+        prompt_text, prompt_tokens = prompt_budget.fit_prompt(deployment_id, prompt_text, **kwargs)
+
+    # Call OpenAI Completion API
+    estimated_tokens = prompt_tokens + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+    async def create(api: openai, engine: str, **options: Any)->Any:
+        response = await api.Completion.acreate(
+            engine=engine,
+            prompt=prompt_text,
+            **options,
+            **kwargs)
+        if kwargs.get("stream"):
+            # Read the first chunk inside the retried call
+            return await AsyncCompletionStream.start(response, completion_delta, prompt_tokens)
+        return response
+
+    response = await (retry_policy or COMPLETION_RETRY_POLICY).acall(_asend, openai_instance, deployment_id, create,
+                                                                     rate_limiter, estimated_tokens,
+                                                                     concurrency_limiter=concurrency_limiter)
+    if kwargs.get("stream"):
+        return response
+    completion_text = response.choices[0].text
+
+    if key is not None:
+        cache.set(key, completion_text)
+
+    return completion_text
+
+# OpenAI ChatCompletions wrapper
+@instrumented("chatcompletion")
+@coalesced("chatcompletion")
+async def aget_chatcompletion(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, message_text: List,
+                              rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                              prompt_budget: Optional[PromptBudget] = None,
+                              hedging: Optional[HedgingPolicy] = None,
+                              concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                              retry_policy: Optional[RetryPolicy] = None,
+                              **kwargs: Any)->Union[str, AsyncCompletionStream]:
+    """
+    Async ChatCompletion method for model tuned for chat interactions.
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        message_text (List): The text with the roles, instructions and/or examples to present to the model
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving deterministic requests
+        prompt_budget (Optional[PromptBudget]): Counts the prompt with the tokenizer of the model and fits it into the
+                                                context window of the deployment before it is sent
+        hedging (Optional[HedgingPolicy]): Sends a duplicate request, to another deployment with a router, when no
+                                           answer came back within the hedge delay of the policy. Off with stream=True
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+        single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+        **kwargs (Any): Azure OpenAI parameters specified for the ChatCompletion. With stream=True the text is streamed
+
+    Returns:
+        completion_text (str): The returned text from Azure OpenAI, or with stream=True an AsyncCompletionStream yielding the
+                               text deltas, whose result holds the full text, finish reason and usage once consumed
+    """
+    # Serve deterministic requests from the cache
+    key, cached = _cache_lookup(cache, openai_instance, "chatcompletion", deployment_id, message_text, **kwargs)
+    if cached is not None:
+        return cached
+
+    # Fit the messages into the context window, their count is charged to the rate limiter
+    prompt_tokens = estimate_chat_prompt_tokens(message_text)
+    if prompt_budget is not None:
+        message_text, prompt_tokens = prompt_budget.fit_messages(deployment_id, message_text, **kwargs)
+
+    # Call OpenAI ChatCompletion API
+    estimated_tokens = prompt_tokens + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+    async def create(api: openai, engine: str, **options: Any)->Any:
+        response = await api.ChatCompletion.acreate(
+            engine=engine,
+            messages=message_text,
+            **options,
+            **kwargs
+            )
+        if kwargs.get("stream"):
+            # Read the first chunk inside the retried call
+            return await AsyncCompletionStream.start(response, chat_delta,
+                                                     prompt_tokens)
+        return response
+
+    policy = retry_policy or CHATCOMPLETION_RETRY_POLICY
+    if hedging is not None and not kwargs.get("stream"):
+        response = await policy.acall(_asend_hedged, openai_instance, deployment_id, create, rate_limiter,
+                                      estimated_tokens, hedging, concurrency_limiter)
+    else:
+        response = await policy.acall(_asend, openai_instance, deployment_id, create, rate_limiter, estimated_tokens,
+                                      concurrency_limiter=concurrency_limiter)
+    if kwargs.get("stream"):
+        return response
+    completion_text = response.choices[0].message["content"]
+
+    if key is not None:
+        cache.set(key, completion_text)
+
+    return completion_text
+
+# Embeddings
+@instrumented("embedding")
+@coalesced("embedding")
+async def aget_embedding(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_text: str,
+                         rate_limiter: Optional[RateLimiter] = None, cache: Optional[ResponseCache] = None,
+                         as_array: bool = False,
+                         concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                         retry_policy: Optional[RetryPolicy] = None, dispatcher: Optional[Any] = None)->List:
+    """
+    Async OpenAI embedding method wrapper with retries
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_text (str): The text to be presented to the model for the model to generate embedding
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs
+        as_array (bool): Request the base64 encoding and return a float32 NumPy array, needs numpy
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+        dispatcher (Optional[EmbeddingDispatcher]): Merges the text with the concurrent calls given the same
+                                                    dispatcher into one multi-input request
+        single_flight (Optional[SingleFlight]): Coalesces the call with the identical calls in flight
+
+    Returns:
+        embedding (List): The returned embedding from Azure OpenAI, a float32 np.ndarray with as_array
+    """
+    if dispatcher is not None:
+        # The batch request of the dispatcher serves the cache and runs the retries
+        return await asyncio.wrap_future(dispatcher.submit(openai_instance, deployment_id, input_text, rate_limiter,
+                                                           cache, as_array, concurrency_limiter, retry_policy))
+
+    # The base64 embeddings are cached apart from the lists of floats
+    encoding = {"encoding_format": ARRAY_ENCODING_FORMAT} if as_array else {}
+
+    # Serve repeated inputs from the cache
+    key, cached = _cache_lookup(cache, openai_instance, "embedding", deployment_id, input_text, **encoding)
+    if cached is not None:
+        return decode_embedding(cached) if as_array else cached
+
+    async def create(api: openai, deployment: str, **options: Any)->Any:
+        return await api.Embedding.acreate(deployment_id=deployment,
+                                           input=input_text,
+                                           **options,
+                                           **encoding)
+
+    response = await (retry_policy or EMBEDDING_RETRY_POLICY).acall(_asend, openai_instance, deployment_id, create,
+                                                                    rate_limiter, estimate_tokens(input_text),
+                                                                    concurrency_limiter=concurrency_limiter)
+    embedding = response["data"][0]["embedding"]
+
+    if key is not None:
+        cache.set(key, embedding)
+
+    return decode_embedding(embedding) if as_array else embedding
+
+# Embeddings - Batched inputs
+@instrumented("embedding")
+async def _aget_embedding_batch(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_texts: List[str],
+                                rate_limiter: Optional[RateLimiter] = None,
+                                cache: Optional[ResponseCache] = None,
+                                encoding_format: Optional[str] = None,
+                                concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                                retry_policy: Optional[RetryPolicy] = None)->List[List]:
+    """
+    Async embed one batch of inputs in a single request. The retries apply to this batch only.
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_texts (List[str]): The texts of the batch
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits the request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs, only the other inputs are sent
+        encoding_format (Optional[str]): The encoding requested from the service, "base64" returns the embeddings
+                                         as base64 strings
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the batch request
+
+    Returns:
+        embeddings (List[List]): The returned embeddings in input order
+    """
+    encoding = {"encoding_format": encoding_format} if encoding_format else {}
+
+    # Serve repeated inputs from the cache
+    lookups = [_cache_lookup(cache, openai_instance, "embedding", deployment_id, text, **encoding)
+               for text in input_texts]
+    embeddings = [cached for _, cached in lookups]
+    missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+    missing_texts = [input_texts[position] for position in missing]
+
+    async def create(api: openai, deployment: str, **options: Any)->Any:
+        return await api.Embedding.acreate(deployment_id=deployment,
+                                           input=missing_texts,
+                                           **options,
+                                           **encoding)
+
+    estimated_tokens = sum(estimate_tokens(text) for text in missing_texts)
+    response = await (retry_policy or EMBEDDING_RETRY_POLICY).acall(_asend, openai_instance, deployment_id, create,
+                                                                    rate_limiter, estimated_tokens,
+                                                                    concurrency_limiter=concurrency_limiter)
+
+    for position, embedding in zip(missing, _embeddings_in_order(response)):
+        embeddings[position] = embedding
+        key = lookups[position][0]
+        if key is not None:
+            cache.set(key, embedding)
+
+    return embeddings
+
+async def aget_embeddings(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_texts: Iterable[str],
+                          batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE, batch_tokens: int = DEFAULT_EMBEDDING_BATCH_TOKENS,
+                          max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                          rate_limiter: Optional[RateLimiter] = None,
+                          retry_policy: Optional[RetryPolicy] = None,
+                          cache: Optional[ResponseCache] = None,
+                          as_array: bool = False,
+                          concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None)->List[List]:
+    """
+    Async OpenAI embedding method wrapper for many inputs. The inputs are packed into multi-input requests which are
+    sent concurrently and retried independently, so a failed batch never resends the batches that succeeded.
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_texts (Iterable[str]): The texts to generate embeddings for
+        batch_size (int): The maximum number of inputs per request
+        batch_tokens (int): The maximum number of estimated tokens per request
+        max_concurrency (int): The maximum number of requests in flight at once
+        rate_limiter (Optional[RateLimiter]): The client side rate limiter that admits every request
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of every batch request
+        cache (Optional[ResponseCache]): The response cache serving repeated inputs
+        as_array (bool): Request the base64 encoding and return one contiguous float32 matrix, needs numpy
+        concurrency_limiter (Optional[AdaptiveConcurrencyLimiter]): Adapts the requests in flight to the deployment,
+                                                                    max_concurrency still caps them
+
+    Returns:
+        embeddings (List[List]): The returned embeddings in the same order as the input texts, a (inputs, dimensions)
+                                 float32 np.ndarray with as_array
+    """
+    encoding_format = ARRAY_ENCODING_FORMAT if as_array else None
+    batches = await gather_with_concurrency(
+        (_aget_embedding_batch(openai_instance, deployment_id, batch, rate_limiter, cache, encoding_format,
+                               concurrency_limiter, retry_policy=retry_policy)
+         for _, batch in _batch_inputs(input_texts, batch_size, batch_tokens)),
+        max_concurrency=max_concurrency)
+
+    embeddings = [embedding for batch in batches for embedding in batch]
+    return embeddings_matrix(embeddings) if as_array else embeddings
+
+# Deployments - Retrieve deployment
+@instrumented("deployment")
+@retry_with_policy(DEPLOYMENT_RETRY_POLICY)
+async def adeployment_retrieve(openai_instance: Union[openai, DeploymentRouter], deployment_id: str,
+                               cache: Optional[DeploymentCache] = None)->Union[str, str, str]:
+    """
+    Async OpenAI Deployment.retrieve method wrapper with retries
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The deployment id of the model to retrieve, ignored with a router
+        cache (Optional[DeploymentCache]): Answers from memory while the deployment is cached, None to always ask the service
+        retry_policy (Optional[RetryPolicy]): Replaces the retry policy of the wrapper for this call
+
+    Returns:
+        deployment_id (str): The retrieved model deployment id
+        model_name (str): The retrieved model name
+        model_status (str): The retrieved model status. This is used to determine if the model is in a state so that it can be used.
+    """
+    async def retrieve(api: openai, deployment: str, **options: Any)->Any:
+        # Deployment.aretrieve of openai 0.27 gets the /refresh operation of the deployment, which the service does not
+        # know, so the sync retrieve runs on a worker thread
+        return await asyncio.to_thread(api.Deployment.retrieve, deployment, **options)
+
+    if cache is not None:
+        async def load()->DeploymentInfo:
+            return DeploymentInfo.from_response(await _asend(openai_instance, deployment_id, retrieve))
+
+        info = await cache.alookup(openai_instance, deployment_id, load)
+        return info.deployment_id, info.name, info.status
+
+    model = await _asend(openai_instance, deployment_id, retrieve)
+
+    return model.id, model.name, model.status
+
+# Bounded concurrency helpers
+async def gather_with_concurrency(awaitables: Iterable[Awaitable], max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                  return_exceptions: bool = False)->List:
+    """
+    Await the given awaitables with at most max_concurrency of them running at the same time. max_concurrency workers
+    pull the awaitables from the iterable one at a time, so a generator creates them only as they are awaited.
+
+    Args:
+        awaitables (Iterable[Awaitable]): The awaitables to run, consumed lazily
+        max_concurrency (int): The maximum number of awaitables in flight at once
+        return_exceptions (bool): Return exceptions in the result list instead of raising the first one. Otherwise the
+                                  first exception stops the workers and the awaitables not started are discarded.
+
+    Returns:
+        results (List): The results in the same order as the awaitables
+    """
+    items = enumerate(awaitables)
+    results: List[Any] = []
+
+    async def _worker()->None:
+        for position, awaitable in items:
+            if len(results) <= position:
+                results.extend([None] * (position + 1 - len(results)))
+            try:
+                results[position] = await awaitable
+            except Exception as exception:
+                if not return_exceptions:
+                    raise
+                results[position] = exception
+
+    workers = [asyncio.ensure_future(_worker()) for _ in range(max(max_concurrency, 1))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # Close the coroutines that were never started, so they are not reported as never awaited
+        for _, awaitable in items:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+        raise
+    return results
+
+async def gather_completions(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, prompts: Iterable[str],
+                             max_concurrency: int = DEFAULT_MAX_CONCURRENCY, return_exceptions: bool = False,
+                             **kwargs: Any)->List:
+    """
+    Run aget_completion for every prompt with bounded concurrency
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        prompts (Iterable[str]): The prompts to complete
+        max_concurrency (int): The maximum number of requests in flight at once
+        return_exceptions (bool): Return exceptions in the result list instead of raising the first one
+        **kwargs (Any): Azure OpenAI parameters specified for every completion
+
+    Returns:
+        completion_texts (List): The returned texts in the same order as the prompts
+    """
+    return await gather_with_concurrency(
+        (aget_completion(openai_instance, deployment_id, prompt, **kwargs) for prompt in prompts),
+        max_concurrency=max_concurrency,
+        return_exceptions=return_exceptions)
+
+async def gather_chatcompletions(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, messages_list: Iterable[List],
+                                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, return_exceptions: bool = False,
+                                 **kwargs: Any)->List:
+    """
+    Run aget_chatcompletion for every message list with bounded concurrency
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        messages_list (Iterable[List]): The message lists to complete
+        max_concurrency (int): The maximum number of requests in flight at once
+        return_exceptions (bool): Return exceptions in the result list instead of raising the first one
+        **kwargs (Any): Azure OpenAI parameters specified for every ChatCompletion
+
+    Returns:
+        completion_texts (List): The returned texts in the same order as the message lists
+    """
+    return await gather_with_concurrency(
+        (aget_chatcompletion(openai_instance, deployment_id, messages, **kwargs) for messages in messages_list),
+        max_concurrency=max_concurrency,
+        return_exceptions=return_exceptions)
+
+async def gather_embeddings(openai_instance: Union[openai, DeploymentRouter], deployment_id: str, input_texts: Iterable[str],
+                            max_concurrency: int = DEFAULT_MAX_CONCURRENCY, return_exceptions: bool = False,
+                            **kwargs: Any)->List:
+    """
+    Run aget_embedding for every input text with bounded concurrency
+
+    Args:
+        openai_instance (openai | DeploymentRouter): The Azure OpenAI instance to use, or a router over several deployments
+        deployment_id (str): The base model deployment id to use, ignored with a router
+        input_texts (Iterable[str]): The texts to generate embeddings for
+        max_concurrency (int): The maximum number of requests in flight at once
+        return_exceptions (bool): Return exceptions in the result list instead of raising the first one
+        **kwargs (Any): Options passed to every aget_embedding call, for example rate_limiter or cache
+
+    Returns:
+        embeddings (List): The returned embeddings in the same order as the input texts
+    """
+    return await gather_with_concurrency(
+        (aget_embedding(openai_instance, deployment_id, text, **kwargs) for text in input_texts),
+        max_concurrency=max_concurrency,
+        return_exceptions=return_exceptions)
@@ -0,0 +1,267 @@
+# This Script contains a router that spreads Azure OpenAI calls over a pool of deployments, possibly in several regions.
+# A DeploymentRouter can be passed as the openai_instance of the wrapper functions in utils/openai_retry.py.
+# Each call goes to the backend with the fewest outstanding requests, or the most remaining quota, relative to its weight.
+# Backends that keep failing with throttling or server errors are taken out of rotation by a circuit breaker, and a
+# call that fails with a retryable error fails over to the next backend right away instead of waiting on the same one.
+
+# import the required libraries
+import functools
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import openai
+
+from utils.openai_stream import on_stream_end
+from utils.rate_limiter import RateLimiter
+from utils.retry_policy import RETRYABLE_ERRORS, server_delay
+from utils.token_provider import AzureADTokenProvider
+
+# The number of consecutive failures that opens the circuit of a backend
+DEFAULT_FAILURE_THRESHOLD = 3
+
+# The time an open circuit keeps a backend out of rotation
+DEFAULT_RECOVERY_TIME = 30  # seconds
+
+# The load balancing strategies
+LEAST_OUTSTANDING = "least_outstanding"
+REMAINING_QUOTA = "remaining_quota"
+
+
+class Backend:
+    """
+    One Azure OpenAI deployment served by the router
+
+    Args:
+        api_base (str): The endpoint of the Azure OpenAI instance
+        deployment_id (str): The deployment id on that instance
+        weight (float): The relative share of traffic the backend should receive. A backend of weight 0 is drained, it
+                        only gets traffic when no backend of positive weight is in rotation
+        api_key (Optional[str]): The API key or Azure AD token of the instance, None to use openai.api_key
+        api_type (Optional[str]): The API type of the instance, None to use openai.api_type
+        api_version (Optional[str]): The API version to use, None to use openai.api_version
+        name (Optional[str]): The name of the backend, also the rate limiter key. Defaults to "<api_base>#<deployment_id>"
+        token_provider (Optional[AzureADTokenProvider]): Supplies a fresh Azure AD token for every call, used instead
+                                                         of api_key. The api_type defaults to "azure_ad" with it.
+    """
+
+    def __init__(self, api_base: str, deployment_id: str, weight: float = 1, api_key: Optional[str] = None,
+                 api_type: Optional[str] = None, api_version: Optional[str] = None, name: Optional[str] = None,
+                 token_provider: Optional[AzureADTokenProvider] = None):
+        if weight < 0:
+            raise ValueError("Backend needs a weight of at least 0")
+        self.api_base = api_base
+        self.deployment_id = deployment_id
+        self.weight = weight
+        self.api_key = api_key
+        self.api_type = api_type or ("azure_ad" if token_provider is not None else None)
+        self.token_provider = token_provider
+        self.api_version = api_version
+        self.name = name or f"{api_base}#{deployment_id}"
+        self.openai_instance = openai
+
+        # Load and health state, guarded by the router lock
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.unavailable_until = 0.0
+
+    def options(self)->Dict[str, str]:
+        """
+        Return the connection parameters passed to the openai create and retrieve methods
+
+        Returns:
+            options (Dict[str, str]): The api_base, api_key, api_type and api_version that are set
+        """
+        api_key = self.token_provider.token() if self.token_provider is not None else self.api_key
+        return self._with_key(api_key)
+
+    async def aoptions(self)->Dict[str, str]:
+        """
+        Async options, the token is read with atoken so that a refresh does not block the event loop
+
+        Returns:
+            options (Dict[str, str]): The api_base, api_key, api_type and api_version that are set
+        """
+        api_key = await self.token_provider.atoken() if self.token_provider is not None else self.api_key
+        return self._with_key(api_key)
+
+    def _with_key(self, api_key: Optional[str])->Dict[str, str]:
+        options = {"api_base": self.api_base, "api_key": api_key,
+                   "api_type": self.api_type, "api_version": self.api_version}
+        return {key: value for key, value in options.items() if value is not None}
+
+    def __repr__(self)->str:
+        return f"Backend({self.name!r})"
+
+
+class DeploymentRouter:
+    """
+    Load balancer with health-aware failover over a pool of Azure OpenAI deployments
+
+    Args:
+        backends (List[Backend]): The deployments to spread the calls over
+        strategy (str): LEAST_OUTSTANDING or REMAINING_QUOTA. REMAINING_QUOTA needs a rate limiter and otherwise
+                        behaves as LEAST_OUTSTANDING
+        rate_limiter (Optional[RateLimiter]): The limiter tracking the quota of each backend, keyed by backend name.
+                                              The wrappers use it when they are not given a rate limiter of their own.
+        failure_threshold (int): The number of consecutive failures that takes a backend out of rotation
+        recovery_time (float): The seconds a failing backend stays out of rotation before it is tried again
+    """
+
+    def __init__(self, backends: List[Backend], strategy: str = LEAST_OUTSTANDING,
+                 rate_limiter: Optional[RateLimiter] = None, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 recovery_time: float = DEFAULT_RECOVERY_TIME):
+        if not backends:
+            raise ValueError("DeploymentRouter needs at least one backend")
+        if strategy not in (LEAST_OUTSTANDING, REMAINING_QUOTA):
+            raise ValueError(f"Unknown load balancing strategy {strategy}")
+        self.backends = list(backends)
+        self.strategy = strategy
+        self.rate_limiter = rate_limiter
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._lock = threading.Lock()
+
+    def _score(self, backend: Backend)->float:
+        # Drained backends are only compared with each other, by their load alone
+        weight = backend.weight or 1
+        if self.strategy == REMAINING_QUOTA and self.rate_limiter is not None:
+            return -self.rate_limiter.remaining_tokens(backend.name) * weight
+        return backend.outstanding / weight
+
+    def acquire(self, exclude: Optional[List[Backend]] = None)->Optional[Backend]:
+        """
+        Pick the backend for the next request and count the request as outstanding on it
+
+        Args:
+            exclude (Optional[List[Backend]]): The backends already tried for this call
+
+        Returns:
+            backend (Optional[Backend]): The chosen backend, None when every backend in rotation was tried
+        """
+        exclude = exclude or []
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in exclude]
+            if not candidates:
+                return None
+            now = time.monotonic()
+            available = [backend for backend in candidates if backend.unavailable_until <= now]
+            if available:
+                # A drained backend only takes the traffic no weighted backend can
+                available = [backend for backend in available if backend.weight > 0] or available
+                scores = [self._score(backend) for backend in available]
+                best = min(scores)
+                backend = random.choice([backend for backend, score in zip(available, scores) if score == best])
+            elif not exclude:
+                # Every backend is out of rotation, probe the one that recovers first
+                backend = min(candidates, key=lambda backend: backend.unavailable_until)
+            else:
+                return None
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend: Backend, exception: Optional[BaseException] = None)->None:
+        """
+        Record the outcome of a request sent to a backend
+
+        Args:
+            backend (Backend): The backend the request was sent to
+            exception (Optional[BaseException]): The error of the request, None if it succeeded
+        """
+        with self._lock:
+            backend.outstanding -= 1
+            if exception is None:
+                backend.consecutive_failures = 0
+                backend.unavailable_until = 0.0
+                return
+            if not isinstance(exception, RETRYABLE_ERRORS):
+                # The request itself was rejected, the backend is healthy
+                return
+
+            backend.consecutive_failures += 1
+            now = time.monotonic()
+            hint = server_delay(exception)
+            if hint is not None:
+                # The backend asked for a pause, send the traffic elsewhere until then
+                backend.unavailable_until = max(backend.unavailable_until, now + hint)
+            if backend.consecutive_failures >= self.failure_threshold:
+                backend.unavailable_until = max(backend.unavailable_until, now + self.recovery_time)
+
+    def healthy_backends(self)->List[Backend]:
+        """
+        Return the backends currently in rotation
+
+        Returns:
+            backends (List[Backend]): The backends whose circuit is closed
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [backend for backend in self.backends if backend.unavailable_until <= now]
+
+    def execute(self, request: Callable[[Backend], Any], tried: Optional[List[Backend]] = None)->Any:
+        """
+        Send a request, failing over to the next backend when a backend fails with a retryable error
+
+        Args:
+            request (Callable[[Backend], Any]): Sends the request to the given backend
+            tried (Optional[List[Backend]]): The backends already tried for this call, extended with the backends tried
+                                             here. Requests sharing it go to different backends.
+
+        Returns:
+            response (Any): The response of the first backend that succeeded. The last error is raised when every
+                            backend failed, so the retry policy of the caller can wait before the next round.
+        """
+        tried = [] if tried is None else tried
+        last_exception = None
+        while True:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                raise last_exception or RuntimeError("Every backend was already tried for this call")
+            tried.append(backend)
+            try:
+                response = request(backend)
+            except RETRYABLE_ERRORS as exception:
+                self.release(backend, exception)
+                last_exception = exception
+                continue
+            except BaseException as exception:
+                self.release(backend, exception)
+                raise
+            # A stream stays outstanding on its backend until it ends
+            if not on_stream_end(response, functools.partial(self.release, backend)):
+                self.release(backend)
+            return response
+
+    async def aexecute(self, request: Callable[[Backend], Awaitable], tried: Optional[List[Backend]] = None)->Any:
+        """
+        Async send a request, failing over to the next backend when a backend fails with a retryable error
+
+        Args:
+            request (Callable[[Backend], Awaitable]): Sends the request to the given backend
+            tried (Optional[List[Backend]]): The backends already tried for this call, extended with the backends tried
+                                             here. Requests sharing it go to different backends.
+
+        Returns:
+            response (Any): The response of the first backend that succeeded. The last error is raised when every
+                            backend failed, so the retry policy of the caller can wait before the next round.
+        """
+        tried = [] if tried is None else tried
+        last_exception = None
+        while True:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                raise last_exception or RuntimeError("Every backend was already tried for this call")
+            tried.append(backend)
+            try:
+                response = await request(backend)
+            except RETRYABLE_ERRORS as exception:
+                self.release(backend, exception)
+                last_exception = exception
+                continue
+            except BaseException as exception:
+                self.release(backend, exception)
+                raise
+            # A stream stays outstanding on its backend until it ends
+            if not on_stream_end(response, functools.partial(self.release, backend)):
+                self.release(backend)
+            return response
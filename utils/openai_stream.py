@@ -0,0 +1,351 @@
+# This Script contains the stream objects returned by the completion wrappers when they are called with stream=True.
+# A stream yields the content deltas as they arrive and builds an aggregate result with the full text, the finish
+# reason and the token usage once it is exhausted.
+# The first chunk is read when the stream is created, inside the retried call, so throttling and connection errors
+# raised before any content reaches the caller are retried. Errors after the first chunk are raised to the caller,
+# as a retry would deliver the same content twice.
+# A stream holds what its request holds, the concurrency permit, the scheduler slot, the router load and the call
+# record, until it ends: when it is exhausted, fails, is closed or the caller leaves the loop early. The rate limiter
+# is then reconciled with the tokens counted from the chunks.
+
+# import the required libraries
+import inspect
+import logging
+from contextlib import AsyncExitStack, ExitStack
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+# Marks a stream that ended before its first chunk
+_EXHAUSTED = object()
+
+logger = logging.getLogger(__name__)
+
+
+def chat_delta(chunk: Any)->Optional[str]:
+    """Return the content delta of a ChatCompletion chunk, None when the chunk carries no content"""
+    choices = chunk.get("choices") or []
+    return choices[0].get("delta", {}).get("content") if choices else None
+
+def completion_delta(chunk: Any)->Optional[str]:
+    """Return the text delta of a Completion chunk, None when the chunk carries no text"""
+    choices = chunk.get("choices") or []
+    return choices[0].get("text") if choices else None
+
+
+class StreamResult:
+    """
+    Aggregate of a finished stream
+
+    Args:
+        text (str): The full returned text
+        finish_reason (Optional[str]): The reason the model stopped, for example "stop" or "length"
+        usage (Dict[str, int]): The prompt, completion and total tokens. Azure OpenAI does not send usage on streams,
+                                in that case the prompt tokens are estimated and each content chunk counts as one token.
+    """
+
+    def __init__(self, text: str, finish_reason: Optional[str], usage: Dict[str, int]):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage = usage
+
+    def __repr__(self)->str:
+        return f"StreamResult(finish_reason={self.finish_reason!r}, usage={self.usage!r}, text={self.text!r})"
+
+
+class _StreamAggregator:
+    """Collects the deltas, the finish reason and the usage of the chunks of a stream"""
+
+    def __init__(self, extract: Callable[[Any], Optional[str]], prompt_tokens: int):
+        self.extract = extract
+        self.prompt_tokens = prompt_tokens
+        self.parts: List[str] = []
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk: Any)->Optional[str]:
+        choices = chunk.get("choices") or []
+        if choices and choices[0].get("finish_reason"):
+            self.finish_reason = choices[0]["finish_reason"]
+        if chunk.get("usage"):
+            self.usage = dict(chunk["usage"])
+        delta = self.extract(chunk)
+        if delta:
+            self.parts.append(delta)
+        return delta
+
+    def result(self)->StreamResult:
+        usage = self.usage or {"prompt_tokens": self.prompt_tokens, "completion_tokens": len(self.parts),
+                               "total_tokens": self.prompt_tokens + len(self.parts)}
+        return StreamResult("".join(self.parts), self.finish_reason, usage)
+
+
+class _StreamEnd:
+    """The callbacks of a stream, run once when the stream ends"""
+
+    def __init__(self):
+        self.ended = False
+        self.exception: Optional[BaseException] = None
+        self.callbacks: List[Callable[[Optional[BaseException]], Any]] = []
+
+    def add(self, callback: Callable[[Optional[BaseException]], Any])->bool:
+        """Keep a callback, False when the stream already ended and the caller runs it"""
+        if self.ended:
+            return False
+        self.callbacks.append(callback)
+        return True
+
+    def end(self, exception: Optional[BaseException])->List[Callable[[Optional[BaseException]], Any]]:
+        """Mark the stream ended and return the callbacks to run"""
+        self.ended, self.exception = True, exception
+        callbacks, self.callbacks = self.callbacks, []
+        return callbacks
+
+
+class CompletionStream:
+    """
+    Generator of the content deltas of a streamed Completion or ChatCompletion. Iterate it to the end, or close it,
+    so that the request gives back its concurrency permit; leaving the loop early closes it.
+
+    Args:
+        chunks (Iterator): The chunks returned by the openai create method with stream=True
+        extract (Callable[[Any], Optional[str]]): Returns the content delta of a chunk, chat_delta or completion_delta
+        prompt_tokens (int): The estimated prompt tokens, used when the service does not report usage
+    """
+
+    def __init__(self, chunks: Iterator, extract: Callable[[Any], Optional[str]], prompt_tokens: int = 0):
+        self._source = chunks
+        self._chunks = iter(chunks)
+        self._aggregator = _StreamAggregator(extract, prompt_tokens)
+        self._end = _StreamEnd()
+        self.result: Optional[StreamResult] = None
+
+        # Read the first chunk now so that errors before any content is delivered are raised to the retry policy
+        self._first = next(self._chunks, _EXHAUSTED)
+
+    def __iter__(self)->Iterator[str]:
+        exception = None
+        try:
+            if self._first is not _EXHAUSTED:
+                first, self._first = self._first, _EXHAUSTED
+                delta = self._aggregator.add(first)
+                if delta:
+                    yield delta
+            for chunk in self._chunks:
+                delta = self._aggregator.add(chunk)
+                if delta:
+                    yield delta
+        except GeneratorExit:
+            # The caller left the loop early
+            raise
+        except BaseException as error:
+            exception = error
+            raise
+        finally:
+            self._finish(exception)
+
+    def collect(self)->StreamResult:
+        """
+        Consume the rest of the stream
+
+        Returns:
+            result (StreamResult): The aggregate of the stream
+        """
+        for _ in self:
+            pass
+        return self.result
+
+    def add_done_callback(self, callback: Callable[[Optional[BaseException]], Any])->None:
+        """
+        Run a callback once the stream ends: exhausted, failed or closed. It runs at once when the stream already ended.
+
+        Args:
+            callback (Callable[[Optional[BaseException]], Any]): Called with the error that ended the stream, None when
+                                                                 it was exhausted or closed
+        """
+        if not self._end.add(callback):
+            callback(self._end.exception)
+
+    def close(self)->None:
+        """Stop reading the stream and give back what its request holds. The result holds the chunks read so far."""
+        self._finish(None)
+
+    def _finish(self, exception: Optional[BaseException])->None:
+        if self._end.ended:
+            return
+        close = getattr(self._source, "close", None)
+        if close is not None:
+            close()
+        if self._first is not _EXHAUSTED:
+            # The first chunk was read when the request was sent
+            self._aggregator.add(self._first)
+            self._first = _EXHAUSTED
+        self.result = self._aggregator.result()
+        for callback in self._end.end(exception):
+            try:
+                callback(exception)
+            except Exception:
+                logger.exception("Stream callback %r failed", callback)
+
+    def __enter__(self)->"CompletionStream":
+        return self
+
+    def __exit__(self, *exc_info: Any)->None:
+        self.close()
+
+    def __del__(self)->None:
+        # A stream dropped before it ended gives back what its request holds
+        if hasattr(self, "_end") and not self._end.ended:
+            self.close()
+
+
+class AsyncCompletionStream:
+    """
+    Async generator of the content deltas of a streamed Completion or ChatCompletion. Create it with
+    AsyncCompletionStream.start so that the first chunk is read inside the retried call. Iterate it to the end, or
+    await aclose, so that the request gives back its concurrency permit; leaving the loop early closes it.
+
+    Args:
+        chunks (AsyncIterator): The chunks returned by the openai acreate method with stream=True
+        extract (Callable[[Any], Optional[str]]): Returns the content delta of a chunk, chat_delta or completion_delta
+        prompt_tokens (int): The estimated prompt tokens, used when the service does not report usage
+    """
+
+    def __init__(self, chunks: AsyncIterator, extract: Callable[[Any], Optional[str]], prompt_tokens: int = 0):
+        self._source = chunks
+        self._chunks = chunks.__aiter__()
+        self._aggregator = _StreamAggregator(extract, prompt_tokens)
+        self._end = _StreamEnd()
+        self._first = _EXHAUSTED
+        self.result: Optional[StreamResult] = None
+
+    @classmethod
+    async def start(cls, chunks: AsyncIterator, extract: Callable[[Any], Optional[str]],
+                    prompt_tokens: int = 0)->"AsyncCompletionStream":
+        """
+        Create the stream and read its first chunk
+
+        Args:
+            chunks (AsyncIterator): The chunks returned by the openai acreate method with stream=True
+            extract (Callable[[Any], Optional[str]]): Returns the content delta of a chunk
+            prompt_tokens (int): The estimated prompt tokens, used when the service does not report usage
+
+        Returns:
+            stream (AsyncCompletionStream): The stream, ready to be iterated with async for
+        """
+        stream = cls(chunks, extract, prompt_tokens)
+        try:
+            stream._first = await stream._chunks.__anext__()
+        except StopAsyncIteration:
+            pass
+        return stream
+
+    async def __aiter__(self)->AsyncIterator[str]:
+        exception = None
+        try:
+            if self._first is not _EXHAUSTED:
+                first, self._first = self._first, _EXHAUSTED
+                delta = self._aggregator.add(first)
+                if delta:
+                    yield delta
+            async for chunk in self._chunks:
+                delta = self._aggregator.add(chunk)
+                if delta:
+                    yield delta
+        except GeneratorExit:
+            # The caller left the loop early
+            raise
+        except BaseException as error:
+            exception = error
+            raise
+        finally:
+            await self._finish(exception)
+
+    async def collect(self)->StreamResult:
+        """
+        Consume the rest of the stream
+
+        Returns:
+            result (StreamResult): The aggregate of the stream
+        """
+        async for _ in self:
+            pass
+        return self.result
+
+    def add_done_callback(self, callback: Callable[[Optional[BaseException]], Any])->None:
+        """
+        Run a callback once the stream ends: exhausted, failed or closed. A callback returning an awaitable is awaited.
+        It runs at once when the stream already ended, an awaitable it returns is then left to the caller.
+
+        Args:
+            callback (Callable[[Optional[BaseException]], Any]): Called with the error that ended the stream, None when
+                                                                 it was exhausted or closed
+        """
+        if not self._end.add(callback):
+            callback(self._end.exception)
+
+    async def aclose(self)->None:
+        """Stop reading the stream and give back what its request holds. The result holds the chunks read so far."""
+        await self._finish(None)
+
+    async def _finish(self, exception: Optional[BaseException])->None:
+        if self._end.ended:
+            return
+        aclose = getattr(self._source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        if self._first is not _EXHAUSTED:
+            # The first chunk was read when the request was sent
+            self._aggregator.add(self._first)
+            self._first = _EXHAUSTED
+        self.result = self._aggregator.result()
+        for callback in self._end.end(exception):
+            try:
+                outcome = callback(exception)
+                if inspect.isawaitable(outcome):
+                    await outcome
+            except Exception:
+                logger.exception("Stream callback %r failed", callback)
+
+    async def __aenter__(self)->"AsyncCompletionStream":
+        return self
+
+    async def __aexit__(self, *exc_info: Any)->None:
+        await self.aclose()
+
+
+def _exc_info(exception: Optional[BaseException])->Tuple:
+    return (type(exception), exception, exception.__traceback__) if exception is not None else (None, None, None)
+
+def on_stream_end(response: Any, callback: Callable[[Optional[BaseException]], Any])->bool:
+    """
+    Run a callback when response is a stream and once it ends
+
+    Args:
+        response (Any): The response of a request
+        callback (Callable[[Optional[BaseException]], Any]): Called with the error that ended the stream, None when it
+                                                             was exhausted or closed
+
+    Returns:
+        streamed (bool): True when response is a stream and the callback is registered, False otherwise
+    """
+    if not isinstance(response, (CompletionStream, AsyncCompletionStream)):
+        return False
+    response.add_done_callback(callback)
+    return True
+
+def hold_until_stream_end(response: Any, stack: Union[ExitStack, AsyncExitStack])->Any:
+    """
+    Move the contexts entered for a request, such as a concurrency permit or a scheduler slot, to the stream it
+    returned, so that they are exited when the stream ends instead of when its first chunk arrived
+
+    Args:
+        response (Any): The response of the request
+        stack (ExitStack | AsyncExitStack): The contexts of the request, left as they are when response is not a stream
+
+    Returns:
+        response (Any): The response
+    """
+    if isinstance(response, (CompletionStream, AsyncCompletionStream)):
+        contexts = stack.pop_all()
+        exit_contexts = contexts.__aexit__ if isinstance(contexts, AsyncExitStack) else contexts.__exit__
+        response.add_done_callback(lambda exception: exit_contexts(*_exc_info(exception)))
+    return response
@@ -0,0 +1,318 @@
+# This Script contains the prompt budgeting of the completion wrapper functions.
+# The prompt of a request is counted with the tokenizer of its model before it is sent, so a prompt over the context
+# window of the deployment is truncated locally, or rejected, instead of failing after a full round trip, and the rate
+# limiter is charged with the real prompt size instead of a character based estimate.
+# Tokens are counted with tiktoken, whose encoders are loaded once per model and reused by every request. Without
+# tiktoken, or when its encoders cannot be loaded, for example on a host that cannot download them, the counts fall
+# back to the estimates of utils.rate_limiter.
+
+# import the required libraries
+import functools
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.rate_limiter import DEFAULT_COMPLETION_TOKENS, estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# The truncation strategies: shorten the middle of the longest text, drop the oldest chat turns first, or refuse
+TRUNCATE_MIDDLE = "truncate_middle"
+DROP_OLDEST = "drop_oldest"
+RAISE = "raise"
+
+# The context windows of the Azure OpenAI models, prompt and completion tokens together
+DEFAULT_CONTEXT_LIMITS = {
+    "text-davinci-002": 4097,
+    "text-davinci-003": 4097,
+    "code-davinci-002": 8001,
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-instruct": 4097,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+
+# The context window assumed for unknown models
+DEFAULT_CONTEXT_LIMIT = 4096
+
+# The model assumed for deployments that are not mapped to a model
+DEFAULT_MODEL = "gpt-35-turbo"
+
+# The encoding of models unknown to tiktoken
+DEFAULT_ENCODING = "cl100k_base"
+
+# The tokens added per chat message for the role and the separators, per message name, and to prime the reply
+CHAT_TOKENS_PER_MESSAGE = 3
+CHAT_TOKENS_PER_NAME = 1
+CHAT_REPLY_TOKENS = 3
+
+# The text standing in for the removed middle of a truncated text
+TRUNCATION_MARKER = "\n...\n"
+
+logger = logging.getLogger(__name__)
+
+# Set once a tiktoken load failure was logged, later failures fall back silently
+_load_failure_logged = False
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str)->Any:
+    """
+    Load the tiktoken encoder of a model once and reuse it
+
+    Args:
+        model (str): The model name, for example "gpt-35-turbo"
+
+    Returns:
+        encoding (Any): The tiktoken Encoding, None when tiktoken is not installed or cannot load the encoder
+    """
+    global _load_failure_logged
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as exception:
+        # tiktoken downloads the encoder files on first use
+        if not _load_failure_logged:
+            _load_failure_logged = True
+            logger.warning("tiktoken cannot load the encoder of %s, token counts are estimated: %s", model, exception)
+        return None
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL)->int:
+    """
+    Count the tokens of a text
+
+    Args:
+        text (str): The text to count
+        model (str): The model whose tokenizer is used
+
+    Returns:
+        tokens (int): The number of tokens, estimated when tiktoken is not installed
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(message: Dict[str, Any], model: str = DEFAULT_MODEL)->int:
+    """
+    Count the tokens of one chat message, its content, role, name and separators
+
+    Args:
+        message (Dict[str, Any]): The chat message
+        model (str): The model whose tokenizer is used
+
+    Returns:
+        tokens (int): The number of tokens
+    """
+    tokens = CHAT_TOKENS_PER_MESSAGE
+    for field, value in message.items():
+        if isinstance(value, str):
+            tokens += count_tokens(value, model)
+        if field == "name":
+            tokens += CHAT_TOKENS_PER_NAME
+    return tokens
+
+def count_chat_tokens(message_text: List, model: str = DEFAULT_MODEL)->int:
+    """
+    Count the prompt tokens of a list of chat messages
+
+    Args:
+        message_text (List): The messages of the chat completion
+        model (str): The model whose tokenizer is used
+
+    Returns:
+        tokens (int): The number of prompt tokens
+    """
+    return sum(count_message_tokens(message, model) for message in message_text) + CHAT_REPLY_TOKENS
+
+def truncate_middle(text: str, max_tokens: int, model: str = DEFAULT_MODEL)->str:
+    """
+    Shorten a text to at most max_tokens tokens by replacing its middle with TRUNCATION_MARKER, keeping its start and
+    its end, where the instructions and the question of a prompt usually are
+
+    Args:
+        text (str): The text to shorten
+        max_tokens (int): The maximum number of tokens of the result
+        model (str): The model whose tokenizer is used
+
+    Returns:
+        text (str): The text itself when it fits, the shortened text otherwise, empty when even the marker does not fit
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = get_encoding(model)
+    tokens = None if encoding is None else encoding.encode(text, disallowed_special=())
+    # Tokens can merge across the cut, keep one token less until the result fits
+    for keep in range(max_tokens - count_tokens(TRUNCATION_MARKER, model), 0, -1):
+        if encoding is None:
+            # The estimate counts about 4 characters per token
+            head, tail = _split(text, (keep - 1) * 4)
+        else:
+            head, tail = _split(tokens, keep)
+            head, tail = encoding.decode(head), encoding.decode(tail)
+        shortened = head + TRUNCATION_MARKER + tail
+        if count_tokens(shortened, model) <= max_tokens:
+            return shortened
+    return ""
+
+def _split(sequence: Any, keep: int)->Tuple[Any, Any]:
+    """Return the start and the end of a sequence holding keep items together"""
+    head = (keep + 1) // 2
+    tail = keep - head
+    return sequence[:head], sequence[len(sequence) - tail:]
+
+
+class PromptBudget:
+    """
+    Context window budget of the completion wrappers. Pass it as the prompt_budget argument of get_completion,
+    get_chatcompletion or their async versions: the prompt is counted, shortened to fit the context window of the
+    deployment next to the requested max_tokens, and its count is charged to the rate limiter.
+
+    Args:
+        models (Optional[Dict[str, str]]): The model of every deployment id, deployments named after their model and
+                                           unknown deployments use it directly or fall back to default_model
+        context_limits (Optional[Dict[str, int]]): The context window of every deployment id, overriding the window
+                                                   of its model
+        strategy (str): What to do with a prompt over the budget. TRUNCATE_MIDDLE shortens the middle of the prompt,
+                        or of the longest chat message, DROP_OLDEST drops the oldest chat turns after the system
+                        messages and shortens the middle of a prompt string, RAISE raises a ValueError
+        default_model (str): The model of the deployments missing from models
+    """
+
+    def __init__(self, models: Optional[Dict[str, str]] = None, context_limits: Optional[Dict[str, int]] = None,
+                 strategy: str = DROP_OLDEST, default_model: str = DEFAULT_MODEL):
+        if strategy not in (TRUNCATE_MIDDLE, DROP_OLDEST, RAISE):
+            raise ValueError(f"Unknown truncation strategy {strategy}")
+        self.models = dict(models or {})
+        self.context_limits = dict(context_limits or {})
+        self.strategy = strategy
+        self.default_model = default_model
+        self.truncated = 0
+        self._lock = threading.Lock()
+
+    def model(self, deployment_id: str)->str:
+        """Return the model of a deployment"""
+        if deployment_id in self.models:
+            return self.models[deployment_id]
+        return deployment_id if deployment_id in DEFAULT_CONTEXT_LIMITS else self.default_model
+
+    def context_limit(self, deployment_id: str)->int:
+        """Return the context window of a deployment in tokens"""
+        if deployment_id in self.context_limits:
+            return self.context_limits[deployment_id]
+        return DEFAULT_CONTEXT_LIMITS.get(self.model(deployment_id), DEFAULT_CONTEXT_LIMIT)
+
+    def prompt_budget(self, deployment_id: str, **kwargs: Any)->int:
+        """
+        Return the tokens left for the prompt once the completion is reserved
+
+        Args:
+            deployment_id (str): The deployment id the request is sent to
+            **kwargs (Any): Azure OpenAI parameters specified for the completion, max_tokens is reserved
+
+        Returns:
+            tokens (int): The maximum number of prompt tokens. A ValueError is raised when the completion alone fills
+                          the context window.
+        """
+        context_limit = self.context_limit(deployment_id)
+        max_tokens = kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        if max_tokens >= context_limit:
+            raise ValueError(f"max_tokens of {max_tokens} leaves no room for the prompt in the context window of "
+                             f"{context_limit} tokens of deployment {deployment_id}")
+        return context_limit - max_tokens
+
+    def fit_prompt(self, deployment_id: str, prompt_text: str, **kwargs: Any)->Tuple[str, int]:
+        """
+        Fit a completion prompt into the budget of a deployment
+
+        Args:
+            deployment_id (str): The deployment id the request is sent to
+            prompt_text (str): The prompt of the completion
+            **kwargs (Any): Azure OpenAI parameters specified for the completion
+
+        Returns:
+            prompt_text (str): The prompt itself when it fits, the shortened prompt otherwise
+            tokens (int): The number of prompt tokens
+        """
+        model = self.model(deployment_id)
+        budget = self.prompt_budget(deployment_id, **kwargs)
+        tokens = count_tokens(prompt_text, model)
+        if tokens <= budget:
+            return prompt_text, tokens
+        self._check(deployment_id, tokens, budget)
+        prompt_text = truncate_middle(prompt_text, budget, model)
+        self._count_truncation()
+        return prompt_text, count_tokens(prompt_text, model)
+
+    def fit_messages(self, deployment_id: str, message_text: List, **kwargs: Any)->Tuple[List, int]:
+        """
+        Fit the messages of a chat completion into the budget of a deployment. The system messages and the last
+        message are never dropped.
+
+        Args:
+            deployment_id (str): The deployment id the request is sent to
+            message_text (List): The messages of the chat completion
+            **kwargs (Any): Azure OpenAI parameters specified for the ChatCompletion
+
+        Returns:
+            message_text (List): The messages themselves when they fit, a shortened copy otherwise
+            tokens (int): The number of prompt tokens
+        """
+        model = self.model(deployment_id)
+        budget = self.prompt_budget(deployment_id, **kwargs)
+        counts = [count_message_tokens(message, model) for message in message_text]
+        tokens = sum(counts) + CHAT_REPLY_TOKENS
+        if tokens <= budget:
+            return message_text, tokens
+        self._check(deployment_id, tokens, budget)
+        messages = list(message_text)
+
+        if self.strategy == DROP_OLDEST:
+            position = 0
+            while tokens > budget and position < len(messages) - 1:
+                if messages[position].get("role") == "system":
+                    position += 1
+                    continue
+                tokens -= counts.pop(position)
+                del messages[position]
+
+        # Shorten the longest message until the messages fit, skipping the messages that cannot get shorter
+        shrinkable = set(range(len(messages)))
+        while tokens > budget and shrinkable:
+            longest = max(shrinkable, key=counts.__getitem__)
+            content = messages[longest].get("content") or ""
+            content_tokens = count_tokens(content, model)
+            shortened = truncate_middle(content, max(content_tokens - (tokens - budget), 0), model)
+            message = dict(messages[longest], content=shortened)
+            count = count_message_tokens(message, model)
+            if count >= counts[longest]:
+                shrinkable.discard(longest)
+                continue
+            messages[longest] = message
+            tokens += count - counts[longest]
+            counts[longest] = count
+        if tokens > budget:
+            raise ValueError(f"The messages cannot be shortened below {tokens} tokens, over the budget of {budget} "
+                             f"tokens of deployment {deployment_id}")
+
+        self._count_truncation()
+        return messages, tokens
+
+    def _count_truncation(self)->None:
+        """Count a shortened prompt, the budget is shared by the threads of a batch"""
+        with self._lock:
+            self.truncated += 1
+
+    def _check(self, deployment_id: str, tokens: int, budget: int)->None:
+        """Raise when the strategy refuses prompts over the budget"""
+        if self.strategy == RAISE:
+            raise ValueError(f"The prompt of {tokens} tokens exceeds the budget of {budget} tokens of deployment "
+                             f"{deployment_id}")
@@ -0,0 +1,239 @@
+# This Script contains a client side rate limiter for the Azure OpenAI requests-per-minute and tokens-per-minute quotas.
+# Every deployment gets two token buckets, one for requests and one for tokens. A request is admitted only when both
+# buckets hold enough capacity, so calls wait locally instead of being rejected with a RateLimitError by the service.
+# The token cost of a request is estimated before it is sent and reconciled with the usage field of the response.
+# The limiter is shared across threads and asyncio tasks.
+
+# import the required libraries
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# The default max_tokens of the Completions API, used to estimate the completion tokens when max_tokens is not set
+DEFAULT_COMPLETION_TOKENS = 16
+
+# The tokens added per chat message for the role and the message separators
+CHAT_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str)->int:
+    """
+    Rough token count estimate used when no tokenizer is available, about 4 characters per token
+
+    Args:
+        text (str): The text to estimate
+
+    Returns:
+        tokens (int): The estimated number of tokens
+    """
+    return len(text) // 4 + 1
+
+def estimate_completion_tokens(prompt_text: str, **kwargs: Any)->int:
+    """
+    Estimate the quota cost of a completion request: the prompt tokens plus the requested max_tokens
+
+    Args:
+        prompt_text (str): The prompt of the completion
+        **kwargs (Any): Azure OpenAI parameters specified for the completion
+
+    Returns:
+        tokens (int): The estimated number of tokens
+    """
+    return estimate_tokens(prompt_text) + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+def estimate_chat_prompt_tokens(message_text: List)->int:
+    """
+    Estimate the prompt tokens of a list of chat messages
+
+    Args:
+        message_text (List): The messages of the chat completion
+
+    Returns:
+        tokens (int): The estimated number of tokens
+    """
+    return sum(estimate_tokens(message.get("content") or "") + CHAT_MESSAGE_OVERHEAD_TOKENS for message in message_text)
+
+def estimate_chat_tokens(message_text: List, **kwargs: Any)->int:
+    """
+    Estimate the quota cost of a chat completion request: the message tokens plus the requested max_tokens
+
+    Args:
+        message_text (List): The messages of the chat completion
+        **kwargs (Any): Azure OpenAI parameters specified for the ChatCompletion
+
+    Returns:
+        tokens (int): The estimated number of tokens
+    """
+    return estimate_chat_prompt_tokens(message_text) + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+def usage_tokens(response: Any)->Optional[int]:
+    """
+    Read the total tokens charged for a request from the usage field of its response
+
+    Args:
+        response (Any): The Azure OpenAI response
+
+    Returns:
+        tokens (Optional[int]): The total tokens, None if the response has no usage field
+    """
+    try:
+        return response["usage"]["total_tokens"]
+    except (KeyError, TypeError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously up to its capacity. It is not thread safe on its own, RateLimiter guards it.
+
+    Args:
+        capacity (float): The maximum number of units held by the bucket
+        refill_per_second (float): The number of units added every second
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.available = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float)->None:
+        """Add the units accumulated since the last update"""
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float)->float:
+        """Return the seconds until the bucket holds amount units, 0 if it holds them now"""
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0) / self.refill_per_second
+
+    def take(self, amount: float)->None:
+        """Remove amount units, a negative amount gives units back. A reconciliation may leave the balance negative."""
+        self.available = min(self.capacity, self.available - amount)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter keyed by deployment id
+
+    Args:
+        requests_per_minute (Optional[int]): The default RPM quota of a deployment, None for no request limit
+        tokens_per_minute (Optional[int]): The default TPM quota of a deployment, None for no token limit
+        limits (Optional[Dict[str, Tuple[Optional[int], Optional[int]]]]): The (RPM, TPM) quotas of specific deployments
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 limits: Optional[Dict[str, Tuple[Optional[int], Optional[int]]]] = None):
+        self.default_limits = (requests_per_minute, tokens_per_minute)
+        self.limits = dict(limits or {})
+        self._buckets: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        self._lock = threading.Lock()
+
+    def set_limits(self, deployment_id: str, requests_per_minute: Optional[int], tokens_per_minute: Optional[int])->None:
+        """
+        Set the quotas of a deployment, replacing its current buckets
+
+        Args:
+            deployment_id (str): The deployment id
+            requests_per_minute (Optional[int]): The RPM quota, None for no request limit
+            tokens_per_minute (Optional[int]): The TPM quota, None for no token limit
+        """
+        with self._lock:
+            self.limits[deployment_id] = (requests_per_minute, tokens_per_minute)
+            self._buckets.pop(deployment_id, None)
+
+    def _get_buckets(self, deployment_id: str)->Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        buckets = self._buckets.get(deployment_id)
+        if buckets is None:
+            requests_per_minute, tokens_per_minute = self.limits.get(deployment_id, self.default_limits)
+            buckets = tuple(TokenBucket(limit, limit / 60) if limit else None
+                            for limit in (requests_per_minute, tokens_per_minute))
+            self._buckets[deployment_id] = buckets
+        return buckets
+
+    def try_acquire(self, deployment_id: str, tokens: int = 0)->float:
+        """
+        Admit a request if both buckets of the deployment hold enough capacity
+
+        Args:
+            deployment_id (str): The deployment id the request is sent to
+            tokens (int): The estimated tokens of the request
+
+        Returns:
+            wait_time (float): 0 if the request was admitted, otherwise the seconds to wait before trying again
+        """
+        with self._lock:
+            request_bucket, token_bucket = self._get_buckets(deployment_id)
+            now = time.monotonic()
+            wait_time = 0.0
+            for bucket, amount in ((request_bucket, 1), (token_bucket, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait_time = max(wait_time, bucket.wait_time(amount))
+            if wait_time == 0:
+                for bucket, amount in ((request_bucket, 1), (token_bucket, tokens)):
+                    if bucket is not None:
+                        bucket.take(amount)
+            return wait_time
+
+    def acquire(self, deployment_id: str, tokens: int = 0)->None:
+        """
+        Block the calling thread until the request is admitted
+
+        Args:
+            deployment_id (str): The deployment id the request is sent to
+            tokens (int): The estimated tokens of the request
+        """
+        while True:
+            wait_time = self.try_acquire(deployment_id, tokens)
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self, deployment_id: str, tokens: int = 0)->None:
+        """
+        Wait without blocking the event loop until the request is admitted
+
+        Args:
+            deployment_id (str): The deployment id the request is sent to
+            tokens (int): The estimated tokens of the request
+        """
+        while True:
+            wait_time = self.try_acquire(deployment_id, tokens)
+            if wait_time == 0:
+                return
+            await asyncio.sleep(wait_time)
+
+    def remaining_tokens(self, deployment_id: str)->float:
+        """
+        Return the tokens currently available to a deployment
+
+        Args:
+            deployment_id (str): The deployment id
+
+        Returns:
+            tokens (float): The available tokens, infinite when the deployment has no token limit
+        """
+        with self._lock:
+            token_bucket = self._get_buckets(deployment_id)[1]
+            if token_bucket is None:
+                return float("inf")
+            token_bucket.refill(time.monotonic())
+            return token_bucket.available
+
+    def reconcile(self, deployment_id: str, estimated_tokens: int, actual_tokens: Optional[int])->None:
+        """
+        Correct the token bucket of the deployment once the actual usage of a request is known
+
+        Args:
+            deployment_id (str): The deployment id the request was sent to
+            estimated_tokens (int): The tokens charged when the request was admitted
+            actual_tokens (Optional[int]): The total tokens reported by the response, None leaves the estimate in place
+        """
+        if actual_tokens is None:
+            return
+        with self._lock:
+            token_bucket = self._get_buckets(deployment_id)[1]
+            if token_bucket is not None:
+                token_bucket.take(actual_tokens - estimated_tokens)
@@ -0,0 +1,226 @@
+# This Script contains an opt-in response cache for the Azure OpenAI wrapper functions.
+# Responses are keyed on a hash of the deployment id, the prompt, messages or input and the generation parameters.
+# Two backends are provided: an in-memory LRU with a time to live, and a SQLite file that can be shared by processes.
+# Completions with non-deterministic settings (a temperature above 0, which is the API default, or n above 1) bypass
+# the cache unless it is forced.
+
+# import the required libraries
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# The default number of entries kept by the in-memory cache
+DEFAULT_MAX_ENTRIES = 10000
+
+# The default time to live of a cache entry, None to keep entries until evicted
+DEFAULT_TTL = None  # seconds
+
+# The default temperature of the Completions and ChatCompletions APIs
+DEFAULT_TEMPERATURE = 1
+
+
+def cache_key(operation: str, deployment_id: Optional[str], payload: Any, endpoint: Any = None,
+              **kwargs: Any)->str:
+    """
+    Canonical hash of a request
+
+    Args:
+        operation (str): The wrapper operation, for example "completion", "chatcompletion" or "embedding"
+        deployment_id (Optional[str]): The deployment id the request is sent to
+        payload (Any): The prompt, messages or input of the request
+        endpoint (Any): The endpoint the request is sent to, so that deployments of the same name on different
+                        instances do not share entries
+        **kwargs (Any): The generation parameters of the request
+
+    Returns:
+        key (str): The hex digest identifying the request
+    """
+    canonical = json.dumps([operation, endpoint, deployment_id, payload, kwargs], sort_keys=True, separators=(",", ":"),
+                           default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(**kwargs: Any)->bool:
+    """
+    Tell whether a completion with the given parameters returns the same answer every time
+
+    Args:
+        **kwargs (Any): Azure OpenAI parameters specified for the completion
+
+    Returns:
+        deterministic (bool): True when the temperature is 0, a single choice is returned and the answer is not streamed
+    """
+    if kwargs.get("stream"):
+        return False
+    return kwargs.get("temperature", DEFAULT_TEMPERATURE) == 0 and kwargs.get("n", 1) == 1
+
+
+class MemoryCache:
+    """
+    Thread safe in-memory LRU cache with a time to live
+
+    Args:
+        max_entries (int): The maximum number of entries, the least recently used entry is evicted beyond it
+        ttl (Optional[float]): The seconds an entry stays valid, None for no expiry
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: Optional[float] = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str)->Optional[Any]:
+        """Return the value stored under key, None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any)->None:
+        """Store value under key, evicting the least recently used entry when the cache is full"""
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self)->int:
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    On-disk cache in a SQLite file, shared by every process that opens the same path. Values are stored as JSON.
+
+    Args:
+        path (str): The path of the SQLite database file
+        ttl (Optional[float]): The seconds an entry stays valid, None for no expiry
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+
+    def get(self, key: str)->Optional[Any]:
+        """Return the value stored under key, None if it is missing or expired"""
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value: Any)->None:
+        """Store value under key"""
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)",
+                                     (key, json.dumps(value), expires))
+
+    def purge_expired(self)->None:
+        """Delete the expired entries from the file"""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+
+    def close(self)->None:
+        """Close the database connection"""
+        with self._lock:
+            self._connection.close()
+
+
+class ResponseCache:
+    """
+    Response cache used by the wrapper functions, with counters to size it. A hit is a response served from the cache,
+    a miss a response fetched from the service and stored, so retried attempts are not counted twice.
+
+    Args:
+        backend (Optional[MemoryCache | SQLiteCache]): The store of the cached responses, a MemoryCache by default
+        force (bool): Cache completions even when their settings are non-deterministic
+    """
+
+    def __init__(self, backend: Optional[Any] = None, force: bool = False):
+        self.backend = backend if backend is not None else MemoryCache()
+        self.force = force
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, **kwargs: Any)->bool:
+        """
+        Tell whether a completion with the given parameters returns the same answer every time
+
+        Args:
+            **kwargs (Any): Azure OpenAI parameters specified for the completion
+
+        Returns:
+            cacheable (bool): True when the response can be served from the cache
+        """
+        if kwargs.get("stream"):
+            return False
+        return self.force or is_deterministic(**kwargs)
+
+    def get(self, key: str)->Optional[Any]:
+        """
+        Return the cached response for a request key and count the hit
+
+        Args:
+            key (str): The request key, see cache_key
+
+        Returns:
+            response (Optional[Any]): The cached response, None on a miss
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any)->None:
+        """
+        Store the response fetched from the service for a request key and count the miss
+
+        Args:
+            key (str): The request key, see cache_key
+            value (Any): The response returned by the wrapper
+        """
+        self.backend.set(key, value)
+        with self._lock:
+            self.misses += 1
+
+    def bypass(self)->None:
+        """Count a request that skipped the cache because of its settings"""
+        with self._lock:
+            self.bypassed += 1
+
+    def stats(self)->Dict[str, float]:
+        """
+        Return the cache counters
+
+        Returns:
+            stats (Dict[str, float]): The hits, misses, bypassed requests and the hit ratio
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,259 @@
+# This Script contains the retry policy used by the Azure OpenAI wrapper functions.
+# The policy waits for the time the service asks for through the Retry-After, retry-after-ms and x-ratelimit-reset-*
+# headers of the error when they are present, and falls back to exponential backoff with decorrelated jitter otherwise.
+# A policy can cap the total time spent on a call with a deadline, and every wrapper can use its own policy.
+
+# import the required libraries
+import asyncio
+import datetime
+import email.utils
+import functools
+import logging
+import random
+import re
+import time
+from typing import Any, Callable, Optional, Tuple
+
+# Error codes handled by the retry logic
+from openai.error import RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout
+
+from utils.metrics import record_retry
+
+# The errors that trigger a retry
+RETRYABLE_ERRORS = (RateLimitError, ServiceUnavailableError, TryAgain, APIError, Timeout)
+
+# Default parameters for the retry logic
+
+# The number of times to retry the API call
+DEFAULT_TRIES = 4
+
+# The delay between retries
+DEFAULT_DELAY = 2  # seconds
+
+# The backoff factor to increase the delay between retries
+DEFAULT_BACKOFF = 2
+
+# The maximum delay between retries
+DEFAULT_MAX_DELAY = 20  # seconds
+
+# The x-ratelimit-reset-* duration format, for example "1s", "6m0s" or "250ms"
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+logger = logging.getLogger(__name__)
+
+
+def _header(headers: Any, name: str)->Optional[str]:
+    """Case insensitive header lookup that works for plain dicts as well as the requests and aiohttp header types"""
+    if not headers:
+        return None
+    value = headers.get(name)
+    if value is None:
+        value = next((value for key, value in headers.items() if key.lower() == name), None)
+    return value
+
+def _parse_duration(value: str)->Optional[float]:
+    """Parse a duration such as "20", "1.5s", "6m0s" or "250ms" into seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        parts = _DURATION_PART.findall(value)
+        if not parts:
+            return None
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+def _retry_date_delay(value: str)->Optional[float]:
+    """Parse a Retry-After HTTP date into the seconds left until that date, None when it is malformed"""
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date is None:
+        return None
+    if retry_date.tzinfo is None:
+        # HTTP dates are in GMT
+        retry_date = retry_date.replace(tzinfo=datetime.timezone.utc)
+    return max(retry_date.timestamp() - time.time(), 0)
+
+def server_delay(exception: BaseException)->Optional[float]:
+    """
+    Read the wait time requested by the service from the headers of an Azure OpenAI error
+
+    Args:
+        exception (BaseException): The error raised by the call
+
+    Returns:
+        delay (Optional[float]): The seconds to wait before the next attempt, None if the error carries no hint
+    """
+    headers = getattr(exception, "headers", None)
+
+    retry_after_ms = _header(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = _header(headers, "retry-after")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return _retry_date_delay(retry_after)
+
+    # When a quota is exhausted, wait until that quota resets
+    delays = []
+    for quota in _exhausted_quotas(headers):
+        reset = _header(headers, f"x-ratelimit-reset-{quota}")
+        if reset is not None:
+            delay = _parse_duration(str(reset))
+            if delay is not None:
+                delays.append(delay)
+    return max(delays) if delays else None
+
+def _exhausted_quotas(headers: Any)->list:
+    """Return the quotas, "requests" or "tokens", whose x-ratelimit-remaining-* header is 0"""
+    return [quota for quota in ("requests", "tokens") if _header(headers, f"x-ratelimit-remaining-{quota}") in ("0", 0)]
+
+def quota_exhausted(exception: BaseException)->bool:
+    """
+    Tell whether an Azure OpenAI error reports an exhausted requests-per-minute or tokens-per-minute quota
+
+    Args:
+        exception (BaseException): The error raised by the call
+
+    Returns:
+        exhausted (bool): True when an x-ratelimit-remaining-* header of the error is 0
+    """
+    return bool(_exhausted_quotas(getattr(exception, "headers", None)))
+
+
+class RetryPolicy:
+    """
+    Retry policy for the Azure OpenAI calls
+
+    Args:
+        exceptions (Tuple): The exceptions that trigger a retry
+        tries (int): The maximum number of attempts
+        delay (float): The base delay between attempts in seconds
+        max_delay (float): The maximum backoff delay between attempts in seconds. Server wait hints are not capped.
+        backoff (float): The growth factor of the decorrelated jitter backoff
+        deadline (Optional[float]): The total seconds a call may take including retries, None for no deadline
+        use_server_hints (bool): Wait for the time requested in the headers of the error when it is present
+    """
+
+    def __init__(self, exceptions: Tuple = RETRYABLE_ERRORS, tries: int = DEFAULT_TRIES, delay: float = DEFAULT_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY, backoff: float = DEFAULT_BACKOFF,
+                 deadline: Optional[float] = None, use_server_hints: bool = True):
+        self.exceptions = exceptions
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.deadline = deadline
+        self.use_server_hints = use_server_hints
+
+    def next_delay(self, previous_delay: float, exception: BaseException)->float:
+        """
+        Compute the wait before the next attempt
+
+        Args:
+            previous_delay (float): The wait before the previous attempt, 0 before the first retry
+            exception (BaseException): The error raised by the last attempt
+
+        Returns:
+            delay (float): The seconds to wait
+        """
+        if self.use_server_hints:
+            hint = server_delay(exception)
+            if hint is not None:
+                return hint
+
+        # Decorrelated jitter: a random delay between the base delay and a multiple of the previous delay
+        upper = max(previous_delay, self.delay) * self.backoff
+        return min(self.max_delay, random.uniform(self.delay, upper))
+
+    def _should_retry(self, attempt: int, started: float, delay: float)->bool:
+        if attempt >= self.tries:
+            return False
+        if self.deadline is not None and time.monotonic() + delay - started > self.deadline:
+            return False
+        return True
+
+    def call(self, func: Callable, *args: Any, **kwargs: Any)->Any:
+        """
+        Call func with the retry policy, sleeping between attempts
+
+        Args:
+            func (Callable): The function to call
+            *args (Any): The positional arguments of the call
+            **kwargs (Any): The keyword arguments of the call
+
+        Returns:
+            result (Any): The result of the first successful attempt
+        """
+        started, delay, attempt = time.monotonic(), 0.0, 0
+        while True:
+            attempt += 1
+            try:
+                return func(*args, **kwargs)
+            except self.exceptions as exception:
+                delay = self.next_delay(delay, exception)
+                if not self._should_retry(attempt, started, delay):
+                    raise
+                logger.warning("%s, retrying in %.2f seconds...", exception, delay)
+                record_retry(exception, delay)
+            time.sleep(delay)
+
+    async def acall(self, func: Callable, *args: Any, **kwargs: Any)->Any:
+        """
+        Await func with the retry policy, waiting between attempts without blocking the event loop
+
+        Args:
+            func (Callable): The coroutine function to call
+            *args (Any): The positional arguments of the call
+            **kwargs (Any): The keyword arguments of the call
+
+        Returns:
+            result (Any): The result of the first successful attempt
+        """
+        started, delay, attempt = time.monotonic(), 0.0, 0
+        while True:
+            attempt += 1
+            try:
+                return await func(*args, **kwargs)
+            except self.exceptions as exception:
+                delay = self.next_delay(delay, exception)
+                if not self._should_retry(attempt, started, delay):
+                    raise
+                logger.warning("%s, retrying in %.2f seconds...", exception, delay)
+                record_retry(exception, delay)
+            await asyncio.sleep(delay)
+
+
+def retry_with_policy(policy: RetryPolicy)->Callable:
+    """
+    Decorator applying a retry policy to a function or a coroutine function. The decorated function accepts an extra
+    retry_policy keyword argument that replaces the policy for a single call.
+
+    Args:
+        policy (RetryPolicy): The default policy of the decorated function
+
+    Returns:
+        decorator (Callable): The decorator to apply
+    """
+    def decorator(func: Callable)->Callable:
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, retry_policy: Optional[RetryPolicy] = None, **kwargs: Any)->Any:
+                return await (retry_policy or policy).acall(func, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, retry_policy: Optional[RetryPolicy] = None, **kwargs: Any)->Any:
+            return (retry_policy or policy).call(func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,309 @@
+# This Script contains a scheduler admitting the calls of the wrapper functions by priority, for deployments shared by
+# interactive and batch traffic. At most max_concurrency calls run at once. When a slot frees up it goes to the most
+# urgent priority class with waiting calls, and within a class the tenants take turns, so one busy tenant or one bulk
+# job cannot starve the others. Slots can be reserved for the most urgent class so that interactive calls never wait
+# behind a full batch load.
+# A call given a deadline is dropped with a TimeoutError once it can no longer finish in time, judged from the average
+# duration of the calls of its class, instead of being sent late. Every class has a bounded queue: a full queue
+# rejects new calls with queue.Full, and producers can read the pressure or wait for capacity to slow down.
+# The scheduler is shared across threads and asyncio tasks.
+
+# import the required libraries
+import asyncio
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, ExitStack, asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, Optional
+
+from utils.openai_stream import hold_until_stream_end
+
+# The priority classes, a lower value is more urgent
+INTERACTIVE = 0
+BATCH = 1
+
+# The number of calls running at once
+DEFAULT_MAX_CONCURRENCY = 16
+
+# The number of calls waiting in each priority class
+DEFAULT_MAX_QUEUE = 1000
+
+# The tenant of the calls that do not name one
+DEFAULT_TENANT = "default"
+
+# The weight of the last call in the average call duration of a class
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class _Ticket:
+    """A call waiting for a slot"""
+
+    def __init__(self, priority: int, tenant: str, deadline: Optional[float], loop: Any = None):
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.exception: Optional[BaseException] = None
+        self.cancelled = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def resolve(self)->None:
+        """Wake the waiting caller, called with the scheduler lock held"""
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+
+
+def _resolve_future(future: asyncio.Future)->None:
+    if not future.done():
+        future.set_result(None)
+
+
+class RequestScheduler:
+    """
+    Priority and fair-queuing admission in front of the wrapper functions. Run a call through call or acall, or hold a
+    slot around any code with slot or aslot.
+
+    Args:
+        max_concurrency (int): The number of calls running at once
+        max_queue (int): The number of calls waiting in each priority class before new calls are rejected
+        reserved_slots (int): The slots only the most urgent class, INTERACTIVE, may use
+    """
+
+    def __init__(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, max_queue: int = DEFAULT_MAX_QUEUE,
+                 reserved_slots: int = 0):
+        if reserved_slots >= max_concurrency:
+            raise ValueError("RequestScheduler needs more slots than reserved_slots")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.reserved_slots = reserved_slots
+        self.active = 0
+        self.granted = 0
+        self.dropped = 0
+        self.rejected = 0
+        # The waiting tickets of every priority class, per tenant in turn order
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Ticket]]"] = {}
+        self._queued: Dict[int, int] = {}
+        self._service_time: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._capacity = threading.Condition(self._lock)
+
+    def queued(self, priority: Optional[int] = None)->int:
+        """Return the number of calls waiting in a priority class, or in all of them"""
+        with self._lock:
+            if priority is None:
+                return sum(self._queued.values())
+            return self._queued.get(priority, 0)
+
+    def pressure(self, priority: int = BATCH)->float:
+        """Return the fill ratio of the queue of a priority class, 1 when new calls are rejected"""
+        return self.queued(priority) / self.max_queue
+
+    def wait_for_capacity(self, priority: int = BATCH, timeout: Optional[float] = None)->bool:
+        """
+        Block a producer until the queue of its priority class accepts new calls
+
+        Args:
+            priority (int): The priority class of the producer
+            timeout (Optional[float]): The seconds to wait at most, None to wait as long as needed
+
+        Returns:
+            ready (bool): True when the queue has room, False on timeout
+        """
+        with self._capacity:
+            return self._capacity.wait_for(lambda: self._queued.get(priority, 0) < self.max_queue, timeout)
+
+    def _enqueue(self, ticket: _Ticket)->None:
+        """Queue a ticket and grant it at once when a slot is free, called with the lock held"""
+        if self._queued.get(ticket.priority, 0) >= self.max_queue:
+            self.rejected += 1
+            raise queue.Full(f"The queue of priority class {ticket.priority} is full")
+        tenants = self._queues.setdefault(ticket.priority, OrderedDict())
+        tenants.setdefault(ticket.tenant, deque()).append(ticket)
+        self._queued[ticket.priority] = self._queued.get(ticket.priority, 0) + 1
+        self._dispatch()
+
+    def _next(self, now: float)->Optional[_Ticket]:
+        """Remove the next ticket to run from the queues, called with the lock held"""
+        free = self.max_concurrency - self.active
+        for priority in sorted(self._queues):
+            if priority != INTERACTIVE and free <= self.reserved_slots:
+                break
+            tenants = self._queues[priority]
+            while tenants:
+                # Take the first ticket of the tenant whose turn it is and move the tenant to the back
+                tenant, tickets = next(iter(tenants.items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    tenants.move_to_end(tenant)
+                else:
+                    del tenants[tenant]
+                if ticket.cancelled:
+                    continue
+                self._queued[priority] -= 1
+                self._capacity.notify_all()
+                if ticket.deadline is not None and now + self._service_time.get(priority, 0.0) > ticket.deadline:
+                    # The call would finish after its deadline, drop it instead of sending it
+                    ticket.exception = TimeoutError(f"The call of tenant {ticket.tenant} cannot meet its deadline")
+                    self.dropped += 1
+                    ticket.resolve()
+                    continue
+                return ticket
+        return None
+
+    def _dispatch(self)->None:
+        """Grant the free slots to the waiting tickets, called with the lock held"""
+        now = time.monotonic()
+        while self.active < self.max_concurrency:
+            ticket = self._next(now)
+            if ticket is None:
+                return
+            ticket.granted = True
+            self.active += 1
+            self.granted += 1
+            ticket.resolve()
+
+    def _abandon(self, ticket: _Ticket)->bool:
+        """Withdraw a waiting ticket, False when it was granted or dropped meanwhile, called with the lock held"""
+        if ticket.granted or ticket.exception is not None:
+            return False
+        ticket.cancelled = True
+        self._queued[ticket.priority] -= 1
+        self._capacity.notify_all()
+        return True
+
+    def _release(self, ticket: _Ticket, started: float)->None:
+        """Free the slot of a ticket and record the duration of its call"""
+        duration = time.monotonic() - started
+        with self._lock:
+            self.active -= 1
+            previous = self._service_time.get(ticket.priority)
+            self._service_time[ticket.priority] = duration if previous is None else \
+                previous + SERVICE_TIME_SMOOTHING * (duration - previous)
+            self._dispatch()
+
+    def _ticket(self, priority: int, tenant: str, deadline: Optional[float], loop: Any = None)->_Ticket:
+        """Create and queue a ticket"""
+        absolute = None if deadline is None else time.monotonic() + deadline
+        ticket = _Ticket(priority, tenant, absolute, loop)
+        with self._lock:
+            self._enqueue(ticket)
+        return ticket
+
+    @contextmanager
+    def slot(self, priority: int = INTERACTIVE, tenant: str = DEFAULT_TENANT,
+             deadline: Optional[float] = None)->Iterator[None]:
+        """
+        Wait for a slot and hold it for the duration of the with block
+
+        Args:
+            priority (int): The priority class of the call, INTERACTIVE or BATCH
+            tenant (str): The tenant of the call, tenants of a class take turns
+            deadline (Optional[float]): The seconds within which the call must finish, None for no deadline
+
+        Raises:
+            queue.Full: The queue of the priority class is full
+            TimeoutError: The call cannot meet its deadline
+        """
+        ticket = self._ticket(priority, tenant, deadline)
+        timeout = None if ticket.deadline is None else max(ticket.deadline - time.monotonic(), 0.0)
+        if not ticket.event.wait(timeout):
+            with self._lock:
+                if self._abandon(ticket):
+                    self.dropped += 1
+                    raise TimeoutError(f"The call of tenant {tenant} waited past its deadline")
+        if ticket.exception is not None:
+            raise ticket.exception
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(ticket, started)
+
+    @asynccontextmanager
+    async def aslot(self, priority: int = INTERACTIVE, tenant: str = DEFAULT_TENANT,
+                    deadline: Optional[float] = None)->AsyncIterator[None]:
+        """
+        Async wait for a slot and hold it for the duration of the async with block
+
+        Args:
+            priority (int): The priority class of the call, INTERACTIVE or BATCH
+            tenant (str): The tenant of the call, tenants of a class take turns
+            deadline (Optional[float]): The seconds within which the call must finish, None for no deadline
+
+        Raises:
+            queue.Full: The queue of the priority class is full
+            TimeoutError: The call cannot meet its deadline
+        """
+        ticket = self._ticket(priority, tenant, deadline, asyncio.get_running_loop())
+        timeout = None if ticket.deadline is None else max(ticket.deadline - time.monotonic(), 0.0)
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if self._abandon(ticket):
+                    self.dropped += 1
+                    raise TimeoutError(f"The call of tenant {tenant} waited past its deadline") from None
+        except BaseException:
+            # A cancelled caller gives its ticket, or the slot it was just granted, back
+            with self._lock:
+                self._abandon(ticket)
+            if ticket.granted:
+                self._release(ticket, time.monotonic())
+            raise
+        if ticket.exception is not None:
+            raise ticket.exception
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(ticket, started)
+
+    def call(self, func: Callable, *args: Any, priority: int = INTERACTIVE, tenant: str = DEFAULT_TENANT,
+             deadline: Optional[float] = None, **kwargs: Any)->Any:
+        """
+        Run a wrapper function call once the scheduler grants it a slot
+
+        Args:
+            func (Callable): The wrapper function, for example get_chatcompletion
+            *args (Any): The positional arguments of the call
+            priority (int): The priority class of the call, INTERACTIVE or BATCH
+            tenant (str): The tenant of the call, tenants of a class take turns
+            deadline (Optional[float]): The seconds within which the call must finish, None for no deadline
+            **kwargs (Any): The keyword arguments of the call
+
+        Returns:
+            result (Any): The result of the call
+        """
+        with ExitStack() as stack:
+            stack.enter_context(self.slot(priority, tenant, deadline))
+            # A stream keeps its slot until it ends
+            return hold_until_stream_end(func(*args, **kwargs), stack)
+
+    async def acall(self, func: Callable, *args: Any, priority: int = INTERACTIVE, tenant: str = DEFAULT_TENANT,
+                    deadline: Optional[float] = None, **kwargs: Any)->Any:
+        """
+        Await an async wrapper function call once the scheduler grants it a slot
+
+        Args:
+            func (Callable): The async wrapper function, for example aget_chatcompletion
+            *args (Any): The positional arguments of the call
+            priority (int): The priority class of the call, INTERACTIVE or BATCH
+            tenant (str): The tenant of the call, tenants of a class take turns
+            deadline (Optional[float]): The seconds within which the call must finish, None for no deadline
+            **kwargs (Any): The keyword arguments of the call
+
+        Returns:
+            result (Any): The result of the call
+        """
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(self.aslot(priority, tenant, deadline))
+            # A stream keeps its slot until it ends
+            return hold_until_stream_end(await func(*args, **kwargs), stack)
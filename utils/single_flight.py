@@ -0,0 +1,181 @@
+# This Script contains request coalescing for the Azure OpenAI wrapper functions.
+# When several threads or tasks make the same deterministic call at the same time, only the first one, the leader,
+# sends it, and the others, the followers, wait for the leader and return its result. Calls are identical when they go
+# to the same openai instance with the same operation, deployment id, payload and generation parameters, the key used
+# by the response cache. Embeddings are always coalesced, completions only when they are deterministic.
+# When the leader fails, the followers raise the same error, or with share_errors=False one of them becomes the new
+# leader and sends the call again. Coalescing only covers calls in flight, pair it with a ResponseCache to reuse results.
+
+# import the required libraries
+import asyncio
+import functools
+import inspect
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from utils.response_cache import cache_key, is_deterministic
+
+# The wrapper keyword arguments that configure the call rather than the request
+_CALL_OPTIONS = ("rate_limiter", "cache", "retry_policy", "concurrency_limiter", "dispatcher")
+
+
+class _Call:
+    """A call in flight, with its outcome once the leader has finished"""
+
+    def __init__(self, done: Any):
+        self.done = done
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Registry of the calls in flight, shared by the threads or tasks whose identical calls should be coalesced.
+    Pass it as the single_flight argument of get_completion, get_chatcompletion, get_embedding or their async versions.
+
+    Args:
+        share_errors (bool): Raise the error of the leader in its followers. When False, a follower becomes the new
+                             leader and sends the call again. A cancelled leader always hands over to a follower.
+    """
+
+    def __init__(self, share_errors: bool = True):
+        self.share_errors = share_errors
+        self.coalesced = 0
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def _hand_over(self, exception: Optional[BaseException])->bool:
+        """Tell whether the followers of a failed leader should send the call again"""
+        return exception is not None and (not self.share_errors or isinstance(exception, asyncio.CancelledError))
+
+    def do(self, key: str, func: Callable, *args: Any, **kwargs: Any)->Any:
+        """
+        Call func, or wait for the identical call in flight in another thread and return its result
+
+        Args:
+            key (str): The key identifying identical calls
+            func (Callable): The function to call
+            *args (Any): The positional arguments of the call
+            **kwargs (Any): The keyword arguments of the call
+
+        Returns:
+            result (Any): The result of the call
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call(threading.Event())
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                try:
+                    call.result = func(*args, **kwargs)
+                    return call.result
+                except BaseException as exception:
+                    call.exception = exception
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call.done.set()
+
+            call.done.wait()
+            if call.exception is None:
+                return call.result
+            if not self._hand_over(call.exception):
+                raise call.exception
+
+    async def ado(self, key: str, func: Callable, *args: Any, **kwargs: Any)->Any:
+        """
+        Await func, or wait for the identical call in flight in another task and return its result. The tasks sharing
+        a SingleFlight must run on the same event loop.
+
+        Args:
+            key (str): The key identifying identical calls
+            func (Callable): The coroutine function to call
+            *args (Any): The positional arguments of the call
+            **kwargs (Any): The keyword arguments of the call
+
+        Returns:
+            result (Any): The result of the call
+        """
+        while True:
+            call = self._async_calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._async_calls[key] = _Call(asyncio.Event())
+            else:
+                self.coalesced += 1
+
+            if leader:
+                try:
+                    call.result = await func(*args, **kwargs)
+                    return call.result
+                except BaseException as exception:
+                    call.exception = exception
+                    raise
+                finally:
+                    del self._async_calls[key]
+                    call.done.set()
+
+            await call.done.wait()
+            if call.exception is None:
+                return call.result
+            if not self._hand_over(call.exception):
+                raise call.exception
+
+
+def coalesced(operation: str)->Callable:
+    """
+    Decorator adding a single_flight keyword argument to a wrapper function or coroutine function. It is applied above
+    the retries of the call so that the leader retries on behalf of its followers.
+
+    Args:
+        operation (str): The wrapper operation, part of the key of the call
+
+    Returns:
+        decorator (Callable): The decorator to apply
+    """
+    def decorator(func: Callable)->Callable:
+        signature = inspect.signature(func)
+        # The wrappers take the openai instance, the deployment id and the payload first
+        instance_name, deployment_name, payload_name = list(signature.parameters)[:3]
+
+        def key_of(args: tuple, kwargs: dict)->Optional[str]:
+            request = {name: value for name, value in kwargs.items() if name not in _CALL_OPTIONS}
+            arguments = signature.bind(*args, **request).arguments
+            params = arguments.get("kwargs", {})
+            if operation != "embedding" and not is_deterministic(**params):
+                return None
+            # Named arguments such as as_array change the result as much as the generation parameters, an argument
+            # given its default value keys the same as an argument left out
+            named = {name: value for name, value in arguments.items()
+                     if name not in (instance_name, deployment_name, payload_name, "kwargs") + _CALL_OPTIONS
+                     and value is not signature.parameters[name].default}
+            key = cache_key(operation, arguments[deployment_name], arguments[payload_name], **named, **params)
+            return f"{id(arguments[instance_name])}:{key}"
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, single_flight: Optional[SingleFlight] = None, **kwargs: Any)->Any:
+                key = key_of(args, kwargs) if single_flight is not None else None
+                if key is None:
+                    return await func(*args, **kwargs)
+                return await single_flight.ado(key, func, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, single_flight: Optional[SingleFlight] = None, **kwargs: Any)->Any:
+            key = key_of(args, kwargs) if single_flight is not None else None
+            if key is None:
+                return func(*args, **kwargs)
+            return single_flight.do(key, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,128 @@
+# This Script contains a token provider that keeps an Azure AD access token for Azure OpenAI fresh.
+# The token is fetched once and cached, and a background timer refreshes it a few minutes before it expires, so calls
+# read the cached token without a round trip to the credential and long runs do not fail with 401 after an hour.
+# When the cached token is about to expire anyway, for example because the background refresh failed, a single caller
+# refreshes it while the other threads wait for that refresh instead of each asking the credential for a new token.
+
+# import the required libraries
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Optional
+
+# The scope of the Azure AD tokens accepted by Azure OpenAI
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# The time before expiry at which the token is refreshed
+DEFAULT_REFRESH_MARGIN = 300  # seconds
+
+# The wait before a failed background refresh is tried again
+DEFAULT_RETRY_INTERVAL = 30  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class AzureADTokenProvider:
+    """
+    Cached Azure AD token for Azure OpenAI, refreshed in the background before it expires. It can be shared by every
+    thread, async task, client and router backend of a process. Pass it as the token_provider of an AzureOpenAIClient
+    or a router Backend.
+
+    Args:
+        credential (Any): The azure.identity credential, for example DefaultAzureCredential()
+        scope (str): The scope of the token
+        refresh_margin (float): The seconds before expiry at which the token is refreshed
+        background (bool): Refresh the token on a background timer rather than on the first call within the margin
+    """
+
+    def __init__(self, credential: Any, scope: str = COGNITIVE_SERVICES_SCOPE,
+                 refresh_margin: float = DEFAULT_REFRESH_MARGIN, background: bool = True):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self._token: Optional[str] = None
+        self._expires_on = 0.0
+        self._refresh_at = 0.0
+        self._refresh_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._closed = False
+
+        # Fetch the first token now so that credential errors are raised by the constructor
+        self.refresh()
+
+    def _is_fresh(self)->bool:
+        return self._token is not None and time.time() < self._refresh_at
+
+    def token(self)->str:
+        """
+        Return a valid access token, refreshing it first when it is within the refresh margin of its expiry
+
+        Returns:
+            token (str): The access token
+        """
+        if self._is_fresh():
+            return self._token
+        with self._refresh_lock:
+            # Another caller may have refreshed the token while this one waited for the lock
+            if not self._is_fresh():
+                self._fetch()
+            return self._token
+
+    async def atoken(self)->str:
+        """
+        Async token, a refresh runs on a worker thread so that the credential does not block the event loop
+
+        Returns:
+            token (str): The access token
+        """
+        if self._is_fresh():
+            return self._token
+        return await asyncio.to_thread(self.token)
+
+    def refresh(self)->None:
+        """Fetch a new token now, whatever the expiry of the cached one"""
+        with self._refresh_lock:
+            self._fetch()
+
+    def invalidate(self)->None:
+        """Drop the cached token, for example after the service rejected it, so the next call fetches a new one"""
+        with self._refresh_lock:
+            self._refresh_at = 0.0
+
+    def _fetch(self)->None:
+        access_token = self.credential.get_token(self.scope)
+        self._token = access_token.token
+        self._expires_on = float(access_token.expires_on)
+        # Short-lived tokens are refreshed halfway through their lifetime
+        now = time.time()
+        self._refresh_at = self._expires_on - min(self.refresh_margin, (self._expires_on - now) / 2)
+        self._schedule(self._refresh_at - now)
+
+    def _schedule(self, delay: float)->None:
+        if not self.background or self._closed:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self)->None:
+        try:
+            self.refresh()
+        except Exception as exception:
+            # Keep serving the cached token while it is valid and try again shortly
+            delay = min(DEFAULT_RETRY_INTERVAL, max((self._expires_on - time.time()) / 2, 1))
+            logger.warning("Azure AD token refresh failed: %s, retrying in %.0f seconds", exception, delay)
+            with self._refresh_lock:
+                self._schedule(delay)
+
+    def close(self)->None:
+        """Stop the background refresh"""
+        with self._refresh_lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None